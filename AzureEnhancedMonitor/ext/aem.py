@@ -15,10 +15,12 @@
 
 import os
 import re
+import json
 import socket
 import traceback
 import time
 import datetime
+import threading
 import psutil
 import urlparse
 import xml.dom.minidom as minidom
@@ -125,14 +127,29 @@ def getAzureDiagnosticKeyRange():
     endKey = getMDSPartitionKey(identity, getMDSTimestamp(endTime))
     return startKey, endKey
 
+TableServices = {}
+
+def getTableService(accountName, accountKey, hostBase):
+    """
+    Table clients are kept for the lifetime of the daemon and only created
+    again if the account key changes.
+    """
+    key = (accountName, hostBase)
+    cached = TableServices.get(key)
+    if cached is None or cached[0] != accountKey:
+        tableService = TableService(account_name = accountName,
+                                    account_key = accountKey,
+                                    host_base = hostBase)
+        cached = (accountKey, tableService)
+        TableServices[key] = cached
+    return cached[1]
+
 def getAzureDiagnosticCPUData(accountName, accountKey, hostBase,
                               startKey, endKey, deploymentId):
     try:
         waagent.Log("Retrieve diagnostic data(CPU).")
         table = "LinuxCpuVer2v0"
-        tableService = TableService(account_name = accountName, 
-                                    account_key = accountKey,
-                                    host_base = hostBase)
+        tableService = getTableService(accountName, accountKey, hostBase)
         ofilter = ("PartitionKey ge '{0}' and PartitionKey lt '{1}' "
                    "and DeploymentId eq '{2}'").format(startKey, endKey, deploymentId)
         oselect = ("PercentProcessorTime,DeploymentId")
@@ -154,9 +171,7 @@ def getAzureDiagnosticMemoryData(accountName, accountKey, hostBase,
     try:
         waagent.Log("Retrieve diagnostic data: Memory")
         table = "LinuxMemoryVer2v0"
-        tableService = TableService(account_name = accountName, 
-                                    account_key = accountKey,
-                                    host_base = hostBase)
+        tableService = getTableService(accountName, accountKey, hostBase)
         ofilter = ("PartitionKey ge '{0}' and PartitionKey lt '{1}' "
                    "and DeploymentId eq '{2}'").format(startKey, endKey, deploymentId)
         oselect = ("PercentAvailableMemory,DeploymentId")
@@ -201,9 +216,9 @@ class AzureDiagnosticData(object):
         return self.memoryPercent
 
 class AzureDiagnosticMetric(object):
-    def __init__(self, config):
+    def __init__(self, config, cpuInfo=None):
         self.config = config
-        self.linux = LinuxMetric(self.config)
+        self.linux = LinuxMetric(self.config, cpuInfo)
         self.azure = AzureDiagnosticData(self.config)
         self.timestamp = int(time.time()) - AzureTableDelay
 
@@ -278,53 +293,128 @@ class AzureDiagnosticMetric(object):
 
     def getNetworkPacketRetransmitted(self):
         return self.linux.getNetworkPacketRetransmitted()
+
+    def getNetworkProtocolStat(self, protocol, field):
+        return self.linux.getNetworkProtocolStat(protocol, field)
   
     def getLastHardwareChange(self):
         return self.linux.getLastHardwareChange()
 
+CPUSysDir = "/sys/devices/system/cpu"
+CPUInfoFile = "/proc/cpuinfo"
+
+def readSysFile(path):
+    try:
+        with open(path) as F:
+            return F.read().strip()
+    except IOError:
+        return None
+
+def parseCPUList(cpuList):
+    """
+    Parse a kernel cpu list, e.g. "0-3,8", into a list of cpu ids.
+    """
+    cpus = []
+    for item in cpuList.split(","):
+        item = item.strip()
+        if item == "":
+            continue
+        if "-" in item:
+            first, last = item.split("-", 1)
+            cpus.extend(range(int(first), int(last) + 1))
+        else:
+            cpus.append(int(item))
+    return cpus
+
+def readFirstCPUInfo(cpuinfoFile):
+    """
+    Read the fields of the first processor in /proc/cpuinfo. The other
+    processors are not read, the file can be megabytes on large VMs.
+    """
+    fields = {}
+    try:
+        with open(cpuinfoFile) as F:
+            for line in F:
+                if line.strip() == "":
+                    if fields:
+                        break
+                    continue
+                key, sep, value = line.partition(":")
+                if sep:
+                    fields[key.strip()] = value.strip()
+    except IOError:
+        pass
+    return fields
+
 class CPUInfo(object):
+    cached = None
 
     @staticmethod
-    def getCPUInfo():
-        cpuinfo = waagent.GetFileContents("/proc/cpuinfo")
-        ret, lscpu = waagent.RunGetOutput("lscpu")
-        return CPUInfo(cpuinfo, lscpu)
-
-    def __init__(self, cpuinfo, lscpu):
-        self.cpuinfo = cpuinfo
-        self.lscpu = lscpu
-        self.cores = 1;
-        self.coresPerCpu = 1;
-        self.threadsPerCore = 1;
-        
-        coresMatch = re.search("CPU(s):\s+(\d+)", self.lscpu)
-        if coresMatch:
-            self.cores = int(coresMatch.group(1))
-        
-        coresPerCpuMatch = re.search("Core(s) per socket:\s+(\d+)", self.lscpu)
-        if coresPerCpuMatch:
-            self.coresPerCpu = int(coresPerCpuMatch.group(1))
-        
-        threadsPerCoreMatch = re.search("Core(s) per socket:\s+(\d+)", self.lscpu)
-        if threadsPerCoreMatch:
-            self.threadsPerCore = int(threadsPerCoreMatch.group(1))
-        
-        model = re.search("model name\s+:\s+(.*)\s", self.cpuinfo)
-        vendorId = re.search("vendor_id\s+:\s+(.*)\s", self.cpuinfo)
+    def getCPUInfo(cpuDir=None, cpuinfoFile=None):
+        """
+        The topology is read from sysfs once and reused until the set of
+        online CPUs changes, e.g. after a CPU hotplug event.
+        """
+        if cpuDir is None:
+            cpuDir = CPUSysDir
+        if cpuinfoFile is None:
+            cpuinfoFile = CPUInfoFile
+        online = readSysFile(os.path.join(cpuDir, "online"))
+        cached = CPUInfo.cached
+        if cached is None or cached.online != online or \
+                cached.cpuDir != cpuDir:
+            cached = CPUInfo(online, cpuDir, cpuinfoFile)
+            CPUInfo.cached = cached
+        return cached
+
+    def __init__(self, online, cpuDir=None, cpuinfoFile=None):
+        if cpuDir is None:
+            cpuDir = CPUSysDir
+        if cpuinfoFile is None:
+            cpuinfoFile = CPUInfoFile
+        self.online = online
+        self.cpuDir = cpuDir
+        self.cores = 1
+        self.coresPerCpu = 1
+        self.threadsPerCore = 1
+
+        cpus = parseCPUList(online) if online else []
+        if len(cpus) == 0:
+            cpus = [0]
+        self.cores = len(cpus)
+        physCores = set()
+        for cpu in cpus:
+            topology = os.path.join(cpuDir, "cpu{0}".format(cpu), "topology")
+            package = readSysFile(os.path.join(topology,
+                                               "physical_package_id"))
+            core = readSysFile(os.path.join(topology, "core_id"))
+            if package is None or core is None:
+                physCores = None
+                break
+            physCores.add((package, core))
+        if physCores:
+            sockets = len(set(map(lambda c : c[0], physCores)))
+            self.coresPerCpu = len(physCores) / sockets
+            self.threadsPerCore = self.cores / len(physCores)
+        else:
+            self.coresPerCpu = self.cores
+
+        cpuinfo = readFirstCPUInfo(cpuinfoFile)
+        model = cpuinfo.get("model name")
+        vendorId = cpuinfo.get("vendor_id")
         if model and vendorId:
-            self.processorType = "{0}, {1}".format(model.group(1), 
-                                                   vendorId.group(1))
+            self.processorType = "{0}, {1}".format(model, vendorId)
         else:
             self.processorType = None
-        
-        freqMatch = re.search("CPU MHz:\s+(.*)\s", self.lscpu)
-        if freqMatch:
-            self.frequency = float(freqMatch.group(1))
-        else:
-            self.frequency = None
 
-        ht = re.match("flags\s.*\sht\s", self.cpuinfo)
-        self.isHTon = ht is not None
+        self.freqFile = os.path.join(cpuDir, "cpu{0}".format(cpus[0]),
+                                     "cpufreq/scaling_cur_freq")
+        try:
+            self.nominalFrequency = float(cpuinfo.get("cpu MHz"))
+        except (TypeError, ValueError):
+            self.nominalFrequency = None
+
+        self.isHTon = self.threadsPerCore > 1
 
     def getNumOfCoresPerCPU(self):
         return self.coresPerCpu
@@ -339,7 +429,14 @@ class CPUInfo(object):
         return self.processorType
    
     def getFrequency(self):
-        return self.frequency
+        #Most VMs don't expose cpufreq, fall back to /proc/cpuinfo.
+        freq = readSysFile(self.freqFile)
+        if freq is not None:
+            try:
+                return float(freq) / 1000 #kHz to MHz
+            except ValueError:
+                pass
+        return self.nominalFrequency
 
     def isHyperThreadingOn(self):
         return self.isHTon
@@ -357,8 +454,10 @@ class MemoryInfo(object):
     def getMemPercent(self):
         return self.memInfo[2] #%
 
+SysNetDir = "/sys/class/net"
+
 def getMacAddress(adapterId):
-    nicAddrPath = os.path.join("/sys/class/net", adapterId, "address")
+    nicAddrPath = os.path.join(SysNetDir, adapterId, "address")
     mac = waagent.GetFileContents(nicAddrPath)
     mac = mac.strip()
     mac = mac.replace(":", "-")
@@ -374,6 +473,142 @@ def sameList(l1, l2):
             return False
     return True
 
+NetworkSnapshotFile = os.path.join(LibDir, "NetworkSnapshot")
+CounterWrap32 = 1 << 32
+#Snapshots older than this are not used as a baseline, the rate would be an
+#average over the time the daemon was not running.
+MaxSnapshotAge = 10 * MonitoringInterval
+
+def getMonotonicTime():
+    """
+    Seconds since boot. It is not affected by wall clock changes and, unlike a
+    process local clock, can be compared across daemon restarts.
+    """
+    try:
+        with open("/proc/uptime") as F:
+            return float(F.read().split()[0])
+    except (IOError, ValueError, IndexError):
+        return None
+
+def counterDelta(oldVal, newVal):
+    if newVal >= oldVal:
+        return newVal - oldVal
+    if CounterWrap32 / 2 <= oldVal < CounterWrap32:
+        #32-bit counter wrapped around
+        return CounterWrap32 - oldVal + newVal
+    #Counter was reset, e.g. the NIC was re-created. Count from zero.
+    return newVal
+
+def loadCounterSnapshot(snapshotFile):
+    """
+    Load a snapshot saved by saveCounterSnapshot. Return (timestamp,
+    {name : (value, ...)}), or (None, {}) if there is no usable snapshot.
+    """
+    if not os.path.isfile(snapshotFile):
+        return None, {}
+    try:
+        lines = waagent.GetFileContents(snapshotFile).split("\n")
+        timestamp = float(lines[0])
+        snapshot = {}
+        for line in lines[1:]:
+            fields = line.split()
+            if len(fields) > 1:
+                snapshot[fields[0]] = tuple(map(int, fields[1:]))
+        return timestamp, snapshot
+    except (AttributeError, ValueError, IndexError):
+        waagent.Warn("Ignore corrupted counter snapshot: {0}".format(
+                     snapshotFile))
+        return None, {}
+
+def saveCounterSnapshot(snapshotFile, timestamp, snapshot):
+    content = [str(timestamp)]
+    for name, values in snapshot.iteritems():
+        content.append(" ".join([name] + map(str, values)))
+    waagent.SetFileContents(snapshotFile, "\n".join(content))
+
+def getSnapshotInterval(oldTime, newTime):
+    """
+    Seconds between two snapshots, or None if the old snapshot can't be used
+    as a baseline.
+    """
+    if oldTime is None or newTime is None:
+        return None
+    interval = newTime - oldTime
+    #A negative interval means the VM was rebooted since the last sample.
+    if interval <= 0 or interval > MaxSnapshotAge:
+        return None
+    return interval
+
+class NetworkSampler(object):
+    """
+    Computes per NIC byte rates from one counter snapshot per cycle. The
+    previous snapshot is persisted so no sleep is needed to get a delta.
+    """
+    def __init__(self, nics, snapshotFile=None):
+        self.nics = nics
+        self.timestamp = getMonotonicTime()
+        if snapshotFile is None:
+            snapshotFile = NetworkSnapshotFile
+        self.snapshotFile = snapshotFile
+        self.rates = None
+
+    def loadSnapshot(self):
+        return loadCounterSnapshot(self.snapshotFile)
+
+    def saveSnapshot(self):
+        snapshot = {}
+        for nicName, stat in self.nics.iteritems():
+            snapshot[nicName] = (stat.bytes_recv, stat.bytes_sent)
+        saveCounterSnapshot(self.snapshotFile, self.timestamp, snapshot)
+
+    def getRates(self):
+        if self.rates is not None:
+            return self.rates
+        self.rates = {}
+        if self.timestamp is None:
+            return self.rates
+        oldTime, oldSnapshot = self.loadSnapshot()
+        self.saveSnapshot()
+        interval = getSnapshotInterval(oldTime, self.timestamp)
+        if interval is None:
+            return self.rates
+        for nicName, stat in self.nics.iteritems():
+            if len(oldSnapshot.get(nicName, ())) != 2:
+                continue
+            oldRecv, oldSent = oldSnapshot[nicName]
+            recv = counterDelta(oldRecv, stat.bytes_recv) / interval
+            sent = counterDelta(oldSent, stat.bytes_sent) / interval
+            self.rates[nicName] = (recv, sent)
+        return self.rates
+
+ProcNetStatFiles = ["/proc/net/snmp", "/proc/net/netstat"]
+
+def parseProcNetStat(content):
+    """
+    Parse /proc/net/snmp or /proc/net/netstat. Each protocol has a line of
+    field names followed by a line of values, both prefixed by "<Proto>:".
+    Return a dict of protocol -> {field : value}.
+    """
+    stats = {}
+    headers = {}
+    for line in content.split("\n"):
+        protocol, sep, fields = line.partition(":")
+        if not sep:
+            continue
+        fields = fields.split()
+        if protocol not in headers:
+            headers[protocol] = fields
+            continue
+        names = headers.pop(protocol)
+        values = {}
+        for name, value in zip(names, fields):
+            try:
+                values[name] = int(value)
+            except ValueError:
+                pass
+        stats[protocol] = values
+    return stats
+
 class NetworkInfo(object):
     def __init__(self):
         self.nics = psutil.net_io_counters(pernic=True)
@@ -381,60 +616,39 @@ class NetworkInfo(object):
         for nicName, stat in self.nics.iteritems():
             if nicName != 'lo':
                 self.nicNames.append(nicName)
+        self.sampler = NetworkSampler(self.nics)
+        self.protocolStats = None
 
     def getAdapterIds(self):
         return self.nicNames
 
     def getNetworkReadBytes(self, adapterId):
-        net = psutil.net_io_counters(pernic=True)
-        if net[adapterId] != None:
-            bytes_recv1 = net[adapterId][1]
-            time1 = time.time()
-            
-            time.sleep(0.2)
-            
-            net = psutil.net_io_counters(pernic=True)
-            bytes_recv2 = net[adapterId][1]
-            time2 = time.time()
-            
-            interval = (time2 - time1)
-            
-            return (bytes_recv2 - bytes_recv1) / interval
-        else:
-            return 0
+        rate = self.sampler.getRates().get(adapterId)
+        return rate[0] if rate is not None else 0
 
     def getNetworkWriteBytes(self, adapterId):
-        net = psutil.net_io_counters(pernic=True)
-        if net[adapterId] != None:
-            bytes_sent1 = net[adapterId][0]
-            time1 = time.time()
-            
-            time.sleep(0.2)
-            
-            net = psutil.net_io_counters(pernic=True)
-            bytes_sent2 = net[adapterId][0]
-            time2 = time.time()
-            
-            interval = (time2 - time1)
-            
-            return (bytes_sent2 - bytes_sent1) / interval
-        else:
-            return 0
+        rate = self.sampler.getRates().get(adapterId)
+        return rate[1] if rate is not None else 0
+
+    def getProtocolStats(self):
+        if self.protocolStats is None:
+            self.protocolStats = {}
+            for path in ProcNetStatFiles:
+                content = waagent.GetFileContents(path)
+                if content is not None:
+                    self.protocolStats.update(parseProcNetStat(content))
+        return self.protocolStats
 
-    def getNetstat(self):
-        retCode, output = waagent.RunGetOutput("netstat -s", chk_err=False)
-        return output
+    def getProtocolStat(self, protocol, field):
+        return self.getProtocolStats().get(protocol, {}).get(field)
 
     def getNetworkPacketRetransmitted(self):
-        netstat = self.getNetstat()
-        match = re.search("(\d+)\s*segments retransmited", netstat)
-        if match != None:
-            return int(match.group(1))
-        else:
-            waagent.Error("Failed to parse netstat output: {0}".format(netstat))
+        retrans = self.getProtocolStat("Tcp", "RetransSegs")
+        if retrans is None:
+            waagent.Error("Failed to read RetransSegs from /proc/net/snmp")
             updateLatestErrorRecord(FAILED_TO_RETRIEVE_LOCAL_DATA)
             AddExtensionEvent(message=FAILED_TO_RETRIEVE_LOCAL_DATA)
-            return None
+        return retrans
 
 
 HwInfoFile = os.path.join(LibDir, "HwInfo")
@@ -471,10 +685,12 @@ class HardwareChangeInfo(object):
             return oldTime
 
 class LinuxMetric(object):
-    def __init__(self, config):
+    def __init__(self, config, cpuInfo=None):
         self.config = config
         #CPU
-        self.cpuInfo = CPUInfo.getCPUInfo()
+        if cpuInfo is None:
+            cpuInfo = CPUInfo.getCPUInfo()
+        self.cpuInfo = cpuInfo
         #Memory
         self.memInfo = MemoryInfo()
         #Network
@@ -560,20 +776,52 @@ class LinuxMetric(object):
 
     def getNetworkPacketRetransmitted(self):
         return self.networkInfo.getNetworkPacketRetransmitted()
+
+    def getNetworkProtocolStat(self, protocol, field):
+        return self.networkInfo.getProtocolStat(protocol, field)
   
     def getLastHardwareChange(self):
         return self.hwChangeInfo.getLastHardwareChange()
 
+#Protocol counters from /proc/net/snmp and /proc/net/netstat, reported as
+#(protocol, field, counter name, unit). Values are totals since boot.
+NetworkProtocolCounters = [
+    ("Tcp", "ActiveOpens", "TCP Active Opens", "connections"),
+    ("Tcp", "PassiveOpens", "TCP Passive Opens", "connections"),
+    ("Tcp", "AttemptFails", "TCP Failed Connection Attempts", "connections"),
+    ("Tcp", "EstabResets", "TCP Established Resets", "connections"),
+    ("Tcp", "CurrEstab", "TCP Connections Established", "connections"),
+    ("Tcp", "InSegs", "TCP Segments Received", "segments"),
+    ("Tcp", "OutSegs", "TCP Segments Sent", "segments"),
+    ("Tcp", "InErrs", "TCP Segments Received in Error", "segments"),
+    ("Tcp", "OutRsts", "TCP Resets Sent", "segments"),
+    ("TcpExt", "TCPTimeouts", "TCP Timeouts", "none"),
+    ("TcpExt", "ListenOverflows", "TCP Listen Overflows", "none"),
+    ("TcpExt", "ListenDrops", "TCP Listen Drops", "none"),
+    ("Udp", "InDatagrams", "UDP Datagrams Received", "datagrams"),
+    ("Udp", "OutDatagrams", "UDP Datagrams Sent", "datagrams"),
+    ("Udp", "NoPorts", "UDP No Port Datagrams", "datagrams"),
+    ("Udp", "InErrors", "UDP Receive Errors", "datagrams"),
+    ("Udp", "RcvbufErrors", "UDP Receive Buffer Errors", "datagrams"),
+    ("Udp", "SndbufErrors", "UDP Send Buffer Errors", "datagrams"),
+]
+
 class VMDataSource(object):
     def __init__(self, config):
         self.config = config
+        self.phases = []
 
     def collect(self):
         counters = []
+        self.phases = []
+        #Cached until a CPU is hot-plugged
+        cpuInfo = timePhase(self.phases, "CPUInfo", CPUInfo.getCPUInfo)
         if self.config.isLADEnabled():
-            metrics = AzureDiagnosticMetric(self.config)
+            metrics = timePhase(self.phases, "AzureDiagnosticMetric",
+                                AzureDiagnosticMetric, self.config, cpuInfo)
         else:
-            metrics = LinuxMetric(self.config)
+            metrics = timePhase(self.phases, "LinuxMetric",
+                                LinuxMetric, self.config, cpuInfo)
 
         #CPU
         counters.append(self.createCounterCurrHwFrequency(metrics))
@@ -596,7 +844,8 @@ class VMDataSource(object):
         counters.append(self.createCounterVMMemConsumption(metrics))
 
         #Network
-        adapterIds = metrics.getNetworkAdapterIds()
+        adapterIds = timePhase(self.phases, "NetworkAdapterIds",
+                               metrics.getNetworkAdapterIds)
         for adapterId in adapterIds:
             if adapterId.startswith('eth'):
                 counters.append(self.createCounterAdapterId(adapterId))
@@ -606,6 +855,12 @@ class VMDataSource(object):
                 counters.append(self.createCounterNetworkReadBytes(metrics, adapterId))
                 counters.append(self.createCounterNetworkWriteBytes(metrics, adapterId))
         counters.append(self.createCounterNetworkPacketRetransmitted(metrics))
+        for protocol, field, name, unit in NetworkProtocolCounters:
+            counters.append(self.createCounterNetworkProtocolStat(metrics,
+                                                                  protocol,
+                                                                  field,
+                                                                  name,
+                                                                  unit))
         
         #Hardware change
         counters.append(self.createCounterLastHardwareChange(metrics))
@@ -792,6 +1047,15 @@ class VMDataSource(object):
                            value = metrics.getNetworkPacketRetransmitted(),
                            unit = "packets/min")
 
+    def createCounterNetworkProtocolStat(self, metrics, protocol, field, name,
+                                         unit):
+        return PerfCounter(counterType = PerfCounterType.COUNTER_TYPE_LARGE,
+                           category = "network",
+                           name = name,
+                           value = metrics.getNetworkProtocolStat(protocol,
+                                                                  field),
+                           unit = unit)
+
 def getStorageTimestamp(unixTimestamp):
     tformat = "{0:0>4d}{1:0>2d}{2:0>2d}T{3:0>2d}{4:0>2d}"
     ts = time.gmtime(unixTimestamp)
@@ -812,9 +1076,7 @@ def getStorageTableKeyRange():
 def getStorageMetrics(account, key, hostBase, table, startKey, endKey):
     try:
         waagent.Log("Retrieve storage metrics data.")
-        tableService = TableService(account_name = account, 
-                                    account_key = key,
-                                    host_base = hostBase)
+        tableService = getTableService(account, key, hostBase)
         ofilter = ("PartitionKey ge '{0}' and PartitionKey lt '{1}'"
                    "").format(startKey, endKey)
         oselect = ("TotalRequests,TotalIngress,TotalEgress,AverageE2ELatency,"
@@ -829,15 +1091,249 @@ def getStorageMetrics(account, key, hostBase, table, startKey, endKey):
         AddExtensionEvent(message=FAILED_TO_RETRIEVE_STORAGE_DATA)
         return None
 
-def getDataDisks():
-    blockDevs = os.listdir('/sys/block')
-    dataDisks = filter(lambda d : re.match("sd[c-z]", d), blockDevs)
-    return dataDisks
+DiskStatsFile = "/proc/diskstats"
+DiskSnapshotFile = os.path.join(LibDir, "DiskSnapshot")
+#The sector counts of /proc/diskstats are always in 512 byte units.
+DiskStatsSectorSize = 512
+#Fields of /proc/diskstats after major, minor and device name
+DiskStatsFieldCount = 11
+
+def parseDiskStats(content, devices):
+    """
+    Return {device : (reads, readsMerged, sectorsRead, msReading, writes,
+    writesMerged, sectorsWritten, msWriting, iosInProgress, msDoingIO,
+    weightedMsDoingIO)} for the given devices.
+    """
+    stats = {}
+    for line in content.split("\n"):
+        fields = line.split()
+        if len(fields) < 3 + DiskStatsFieldCount or fields[2] not in devices:
+            continue
+        stats[fields[2]] = tuple(map(int, fields[3:3 + DiskStatsFieldCount]))
+    return stats
+
+def getDiskRates(oldStat, newStat, interval):
+    delta = map(lambda v : counterDelta(v[0], v[1]), zip(oldStat, newStat))
+    ios = delta[0] + delta[4]
+    return {
+        "readIops" : delta[0] / interval,
+        "writeIops" : delta[4] / interval,
+        "readThroughput" : (delta[2] * DiskStatsSectorSize / 1024.0 / 1024.0
+                            / interval),
+        "writeThroughput" : (delta[6] * DiskStatsSectorSize / 1024.0 / 1024.0
+                             / interval),
+        #Weighted time doing I/O grows by the number of requests in flight
+        "queueDepth" : delta[10] / (interval * 1000.0),
+        "latency" : float(delta[3] + delta[7]) / ios if ios != 0 else 0.0,
+    }
+
+class DiskSampler(object):
+    """
+    Per device I/O rates from one read of /proc/diskstats per cycle,
+    computed against the snapshot persisted by the previous cycle.
+    """
+    def __init__(self, devices, snapshotFile=None, statsFile=None):
+        self.devices = devices
+        self.snapshotFile = snapshotFile or DiskSnapshotFile
+        self.statsFile = statsFile or DiskStatsFile
+
+    def getRates(self):
+        rates = {}
+        timestamp = getMonotonicTime()
+        content = waagent.GetFileContents(self.statsFile)
+        if content is None or timestamp is None:
+            return rates
+        stats = parseDiskStats(content, self.devices)
+        oldTime, oldStats = loadCounterSnapshot(self.snapshotFile)
+        saveCounterSnapshot(self.snapshotFile, timestamp, stats)
+        interval = getSnapshotInterval(oldTime, timestamp)
+        if interval is None:
+            return rates
+        for dev, stat in stats.iteritems():
+            oldStat = oldStats.get(dev)
+            if oldStat is None or len(oldStat) != len(stat):
+                continue
+            rates[dev] = getDiskRates(oldStat, stat, interval)
+        return rates
+
+#Bounds for fetching the storage metrics of several accounts at once
+MaxStorageQueryWorkers = 8
+StorageQueryTimeout = 30 #seconds
+
+class QueryTimeoutError(Exception):
+    pass
+
+#Keys of timed out queries whose abandoned threads are still running
+AbandonedQueries = set()
+AbandonedQueriesLock = threading.Lock()
+
+def runQueries(queries, maxWorkers=MaxStorageQueryWorkers,
+               timeout=StorageQueryTimeout):
+    """
+    Run queries, a list of (key, func) tuples, on at most maxWorkers threads.
+    Each query must finish within timeout seconds after it has been started.
+    Return a dict of key -> (result, error). A query that misses its deadline
+    gets a QueryTimeoutError, and its thread is abandoned and replaced by a
+    new worker so the remaining queries are not held up. A key whose
+    abandoned query is still running is not queried again, so a hung
+    account holds at most one thread, and gets a QueryTimeoutError too.
+    Only the first query of a key is run.
+    """
+    results = {}
+    keys = set()
+    uniqueQueries = []
+    for key, func in queries:
+        if key not in keys:
+            keys.add(key)
+            uniqueQueries.append((key, func))
+    queries = uniqueQueries
+    with AbandonedQueriesLock:
+        skipped = [key for key, func in queries if key in AbandonedQueries]
+    for key in skipped:
+        waagent.Warn(("Skip query {0}, its previous query is still "
+                      "running.").format(key))
+        results[key] = (None, QueryTimeoutError(("Previous query still "
+                                                 "running: {0}").format(key)))
+    queries = [(key, func) for key, func in queries if key not in results]
+    if len(queries) == 0:
+        return results
+    total = len(results) + len(queries)
+    pending = list(reversed(queries))
+    running = {}
+    cond = threading.Condition()
+
+    def worker():
+        while True:
+            with cond:
+                if len(pending) == 0:
+                    return
+                key, func = pending.pop()
+                running[key] = time.time()
+            try:
+                result = (func(), None)
+            except Exception as e:
+                result = (None, e)
+            with cond:
+                if key not in running:
+                    #Timed out, a new worker has taken over.
+                    with AbandonedQueriesLock:
+                        AbandonedQueries.discard(key)
+                    return
+                del running[key]
+                results[key] = result
+                cond.notify()
+
+    def startWorker():
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+
+    with cond:
+        for i in range(0, min(maxWorkers, len(queries))):
+            startWorker()
+        while len(results) < total:
+            now = time.time()
+            waitTime = timeout
+            for key, startTime in running.items():
+                if now - startTime >= timeout:
+                    del running[key]
+                    with AbandonedQueriesLock:
+                        AbandonedQueries.add(key)
+                    results[key] = (None, QueryTimeoutError(("Query timed "
+                                    "out after {0}s: {1}").format(timeout,
+                                                                  key)))
+                    startWorker()
+                else:
+                    waitTime = min(waitTime, startTime + timeout - now)
+            if len(results) < total:
+                cond.wait(waitTime)
+    return results
+
+SysBlockDir = "/sys/block"
+ScsiDiskPattern = re.compile("^sd[a-z]+$")
+NvmeDiskPattern = re.compile("^nvme\\d+n(\\d+)$")
+#Model of the NVMe controller that serves the OS disk and remote data disks.
+#Local NVMe disks have a different model and are not mapped.
+AzureNvmeModel = "NVMe Accelerator"
 
 def getFirstLun(dev):
-    path = os.path.join("/sys/block", dev, "device/scsi_disk")
-    for lun in os.listdir(path):
-        return int(lun[-1])
+    """
+    LUN of a SCSI disk, from its H:C:T:L address in sysfs.
+    """
+    path = os.path.join(SysBlockDir, dev, "device/scsi_disk")
+    for addr in os.listdir(path):
+        return int(addr.split(":")[-1])
+
+def getNvmeLun(dev, nsid):
+    """
+    LUN of an Azure NVMe data disk. Namespace 1 is the OS disk and data disk
+    LUN n is namespace n + 2. Return -1 for the OS disk and None for disks
+    that are not Azure remote disks.
+    """
+    model = readSysFile(os.path.join(SysBlockDir, dev, "device/model"))
+    if model is None or AzureNvmeModel not in model:
+        return None
+    return nsid - 2 if nsid >= 2 else -1
+
+class DiskTopology(object):
+    """
+    Maps LUNs to block devices. Walking /sys/block is only done again when
+    the set of block devices changes, e.g. after a disk is attached.
+    """
+    cached = None
+
+    @staticmethod
+    def getDiskTopology():
+        devices = sorted(os.listdir(SysBlockDir))
+        cached = DiskTopology.cached
+        if cached is None or cached.devices != devices or \
+                cached.sysBlockDir != SysBlockDir:
+            cached = DiskTopology(devices)
+            DiskTopology.cached = cached
+        return cached
+
+    def __init__(self, devices):
+        self.devices = devices
+        self.sysBlockDir = SysBlockDir
+        self.osDisk = None
+        self.lunToDev = {}
+        self.devToLun = {}
+        for dev in devices:
+            lun = None
+            try:
+                if ScsiDiskPattern.match(dev):
+                    #sda is the OS disk and sdb the resource disk
+                    if dev == "sda":
+                        lun = -1
+                    elif dev != "sdb":
+                        lun = getFirstLun(dev)
+                else:
+                    match = NvmeDiskPattern.match(dev)
+                    if match:
+                        lun = getNvmeLun(dev, int(match.group(1)))
+            except (OSError, ValueError) as e:
+                waagent.Warn("Failed to get lun of {0}: {1}".format(dev, e))
+            if lun == -1:
+                if self.osDisk is None or dev.startswith("nvme"):
+                    self.osDisk = dev
+            elif lun is not None:
+                self.lunToDev[lun] = dev
+                self.devToLun[dev] = lun
+
+    def getOSDisk(self):
+        return self.osDisk
+
+    def getDataDisks(self):
+        return sorted(self.devToLun.keys())
+
+    def getDevByLun(self, lun):
+        return self.lunToDev.get(lun)
+
+    def getLun(self, dev):
+        return self.devToLun.get(dev)
+
+def getDataDisks():
+    return DiskTopology.getDiskTopology().getDataDisks()
 
 class DiskInfo(object):
     def __init__(self, config):
@@ -854,18 +1350,14 @@ class DiskInfo(object):
                 "throughput": self.config.getOSDiskSLAThroughput(),
         }
 
+        topology = DiskTopology.getDiskTopology()
+        osDev = topology.getOSDisk() or "sda"
         diskMapping = {
-                "/dev/sda": osdisk,
+                os.path.join("/dev", osDev): osdisk,
         }
 
-        dataDisks = getDataDisks()
-        if dataDisks is None or len(dataDisks) == 0:
+        if len(topology.getDataDisks()) == 0:
             return diskMapping
-        
-        lunToDevMap = {}
-        for dev in dataDisks:
-            lun = getFirstLun(dev)
-            lunToDevMap[lun] = dev
 
         diskCount = self.config.getDataDiskCount()
         for i in range(0, diskCount):
@@ -879,63 +1371,107 @@ class DiskInfo(object):
                     "iops": self.config.getDataDiskSLAIOPS(i),
                     "throughput": self.config.getDataDiskSLAThroughput(i),
             }
-            if lun in lunToDevMap:
-                dev = lunToDevMap[lun]
+            try:
+                dev = topology.getDevByLun(int(lun))
+            except (TypeError, ValueError):
+                dev = None
+            if dev is not None:
                 diskMapping[dev] = datadisk
             else:
                 waagent.Warn("Couldn't find disk with lun: {0}".format(lun))
 
         return diskMapping 
 
-def isUserRead(op):
-    if not op.startswith("user;"):
-        return False
-    op = op[5:]
-    for prefix in ["Get", "List", "Preflight"]:
-        if op.startswith(prefix):
-            return True
-    return False
-
-def isUserWrite(op):
-    if not op.startswith("user;"):
-        return False
-    op = op[5:]
-    for prefix in ["Put" ,"Set" ,"Clear" ,"Delete" ,"Create" ,"Snapshot"]:    
-        if op.startswith(prefix):
-            return True
-    return False
-
-def storageStat(metrics, opFilter):
-    stat = {}
-    stat['bytes'] = None
-    stat['ops'] = None
-    stat['e2eLatency'] = None
-    stat['serverLatency'] = None
-    stat['throughput'] = None
-    if metrics is None:
+#RowKey of user operations is "user;<Operation>". Read and write operations
+#are told apart by the operation name prefix.
+UserOperationPattern = re.compile(("user;(?:(Get|List|Preflight)|"
+                                   "(Put|Set|Clear|Delete|Create|Snapshot))"))
+OperationTypes = {}
+
+def getOperationType(rowKey):
+    """
+    Return "read", "write" or None. The result is cached by RowKey, there
+    are only as many of them as there are storage API operations.
+    """
+    if rowKey in OperationTypes:
+        return OperationTypes[rowKey]
+    opType = None
+    match = UserOperationPattern.match(rowKey)
+    if match:
+        opType = "read" if match.group(1) else "write"
+    OperationTypes[rowKey] = opType
+    return opType
+
+class StorageStat(object):
+    def __init__(self):
+        self.bytes = 0
+        self.ops = 0
+        self.e2eLatency = 0
+        self.serverLatency = 0
+
+    def add(self, metric):
+        self.bytes += metric.TotalIngress + metric.TotalEgress
+        self.ops += metric.TotalRequests
+        self.e2eLatency += metric.TotalRequests * metric.AverageE2ELatency
+        self.serverLatency += metric.TotalRequests * metric.AverageServerLatency
+
+    def toDict(self):
+        stat = {}
+        stat['bytes'] = self.bytes
+        stat['ops'] = self.ops
+        stat['e2eLatency'] = None
+        stat['serverLatency'] = None
+        if self.ops != 0:
+            stat['e2eLatency'] = self.e2eLatency / self.ops
+            stat['serverLatency'] = self.serverLatency / self.ops
+        #Convert to MB/s
+        stat['throughput'] = float(self.bytes) / (1024 * 1024) / 60
         return stat
 
-    metrics = filter(lambda x : opFilter(x.RowKey), metrics)
-    stat['bytes'] = sum(map(lambda x : x.TotalIngress + x.TotalEgress, 
-                            metrics))
-    stat['ops'] = sum(map(lambda x : x.TotalRequests, metrics))
-    if stat['ops'] != 0:
-        stat['e2eLatency'] = sum(map(lambda x : x.TotalRequests * \
-                                                x.AverageE2ELatency, 
-                                     metrics)) / stat['ops']
-        stat['serverLatency'] = sum(map(lambda x : x.TotalRequests * \
-                                                   x.AverageServerLatency, 
-                                        metrics)) / stat['ops']
-    #Convert to MB/s
-    stat['throughput'] = float(stat['bytes']) / (1024 * 1024) / 60 
-    return stat
+EmptyStorageStat = {
+    'bytes' : None,
+    'ops' : None,
+    'e2eLatency' : None,
+    'serverLatency' : None,
+    'throughput' : None,
+}
+
+def aggregateStorageMetrics(metrics):
+    """
+    Aggregate read, write and per operation statistics in one pass over the
+    metrics. Return (readStat, writeStat, {operation : stat}).
+    """
+    if metrics is None:
+        return dict(EmptyStorageStat), dict(EmptyStorageStat), {}
+    rStat = StorageStat()
+    wStat = StorageStat()
+    opStats = {}
+    for metric in metrics:
+        opType = getOperationType(metric.RowKey)
+        if opType is None:
+            continue
+        if opType == "read":
+            rStat.add(metric)
+        else:
+            wStat.add(metric)
+        op = metric.RowKey[5:]
+        if op not in opStats:
+            opStats[op] = StorageStat()
+        opStats[op].add(metric)
+    opStats = dict((op, stat.toDict()) for op, stat in opStats.iteritems())
+    return rStat.toDict(), wStat.toDict(), opStats
 
 class AzureStorageStat(object):
 
     def __init__(self, metrics):
         self.metrics = metrics
-        self.rStat = storageStat(metrics, isUserRead)
-        self.wStat = storageStat(metrics, isUserWrite)
+        self.rStat, self.wStat, self.opStats = aggregateStorageMetrics(metrics)
+
+    def getOperations(self):
+        return sorted(self.opStats.keys())
+
+    def getOpStat(self, op):
+        return self.opStats.get(op, EmptyStorageStat)
 
     def getReadBytes(self):
         return self.rStat['bytes']
@@ -968,18 +1504,113 @@ class AzureStorageStat(object):
         return self.wStat['throughput']
 
 
+class DiskDataSource(object):
+    """
+    Local I/O counters of the OS disk and the data disks. Unlike the storage
+    metrics they don't depend on the table service and aren't delayed.
+    """
+    def __init__(self, config):
+        self.config = config
+        self.phases = []
+
+    def collect(self):
+        counters = []
+        self.phases = []
+        topology = timePhase(self.phases, "DiskTopology",
+                             DiskTopology.getDiskTopology)
+        devices = {topology.getOSDisk() or "sda" : None}
+        for dev in topology.getDataDisks():
+            devices[dev] = topology.getLun(dev)
+        rates = timePhase(self.phases, "DiskSampler",
+                          DiskSampler(devices.keys()).getRates)
+        for dev in sorted(devices.keys()):
+            instance = os.path.join("/dev", dev)
+            rate = rates.get(dev, {})
+            if devices[dev] is not None:
+                counters.append(self.createCounterLun(instance, devices[dev]))
+            counters.append(self.createCounterReadIops(instance, rate))
+            counters.append(self.createCounterWriteIops(instance, rate))
+            counters.append(self.createCounterReadThroughput(instance, rate))
+            counters.append(self.createCounterWriteThroughput(instance, rate))
+            counters.append(self.createCounterQueueDepth(instance, rate))
+            counters.append(self.createCounterLatency(instance, rate))
+        return counters
+
+    def createCounterLun(self, instance, lun):
+        return PerfCounter(counterType = PerfCounterType.COUNTER_TYPE_INT,
+                           category = "disk",
+                           name = "LUN",
+                           instance = instance,
+                           value = lun)
+
+    def createCounterReadIops(self, instance, rate):
+        return PerfCounter(counterType = PerfCounterType.COUNTER_TYPE_DOUBLE,
+                           category = "disk",
+                           name = "Read Ops",
+                           instance = instance,
+                           value = rate.get("readIops"),
+                           unit = "Ops/sec",
+                           refreshInterval = 60)
+
+    def createCounterWriteIops(self, instance, rate):
+        return PerfCounter(counterType = PerfCounterType.COUNTER_TYPE_DOUBLE,
+                           category = "disk",
+                           name = "Write Ops",
+                           instance = instance,
+                           value = rate.get("writeIops"),
+                           unit = "Ops/sec",
+                           refreshInterval = 60)
+
+    def createCounterReadThroughput(self, instance, rate):
+        return PerfCounter(counterType = PerfCounterType.COUNTER_TYPE_DOUBLE,
+                           category = "disk",
+                           name = "Read Throughput",
+                           instance = instance,
+                           value = rate.get("readThroughput"),
+                           unit = "MB/sec",
+                           refreshInterval = 60)
+
+    def createCounterWriteThroughput(self, instance, rate):
+        return PerfCounter(counterType = PerfCounterType.COUNTER_TYPE_DOUBLE,
+                           category = "disk",
+                           name = "Write Throughput",
+                           instance = instance,
+                           value = rate.get("writeThroughput"),
+                           unit = "MB/sec",
+                           refreshInterval = 60)
+
+    def createCounterQueueDepth(self, instance, rate):
+        return PerfCounter(counterType = PerfCounterType.COUNTER_TYPE_DOUBLE,
+                           category = "disk",
+                           name = "Average Queue Depth",
+                           instance = instance,
+                           value = rate.get("queueDepth"),
+                           refreshInterval = 60)
+
+    def createCounterLatency(self, instance, rate):
+        return PerfCounter(counterType = PerfCounterType.COUNTER_TYPE_DOUBLE,
+                           category = "disk",
+                           name = "Average Latency",
+                           instance = instance,
+                           value = rate.get("latency"),
+                           unit = "ms",
+                           refreshInterval = 60)
+
 class StorageDataSource(object):
     def __init__(self, config):
         self.config = config
+        self.phases = []
 
     def collect(self):
         counters = []
+        self.phases = []
 
         #Add disk mapping for resource disk
         counters.append(self.createCounterDiskMapping("/dev/sdb", 
                                                       "not mapped to vhd"))
         #Add disk mapping for osdisk and data disk
-        diskMapping = DiskInfo(self.config).getDiskMapping()
+        diskMapping = timePhase(self.phases, "DiskInfo",
+                                DiskInfo(self.config).getDiskMapping)
         for dev, disk in diskMapping.iteritems():
             counters.append(self.createCounterDiskMapping(dev, disk.get("vhd")))
             counters.append(self.createCounterDiskType(dev, disk.get("type")))
@@ -988,24 +1619,45 @@ class StorageDataSource(object):
                 counters.append(self.createCounterDiskIOPS(dev, disk.get("iops")))
                 counters.append(self.createCounterDiskThroughput(dev, disk.get("throughput")))
 
-        accounts = self.config.getStorageAccountNames()
+        accounts = filter(lambda a : \
+                          self.config.getStorageAccountType(a) == "Standard",
+                          self.config.getStorageAccountNames())
+        #Query all accounts for the same time range, in parallel, so that
+        #one slow account doesn't delay the others.
+        startKey, endKey = getStorageTableKeyRange()
+        queries = map(lambda a : (a, self.createMetricsQuery(a,
+                                                             startKey,
+                                                             endKey)),
+                      accounts)
+        results = timePhase(self.phases, "StorageMetrics", runQueries, queries)
         for account in accounts:
-            if self.config.getStorageAccountType(account) == "Standard":
-                counters.extend(self.collectMetrixForStandardStorage(account))
+            metrics, error = results[account]
+            if error is not None:
+                waagent.Error((u"Failed to retrieve storage metrics data of "
+                               "{0}: {1}").format(account, error))
+                updateLatestErrorRecord(FAILED_TO_RETRIEVE_STORAGE_DATA)
+                AddExtensionEvent(message=FAILED_TO_RETRIEVE_STORAGE_DATA)
+            counters.extend(self.collectMetrixForStandardStorage(account,
+                                                                 metrics))
         return counters
 
-    def collectMetrixForStandardStorage(self, account):
-        counters = []
-        startKey, endKey = getStorageTableKeyRange()
+    def createMetricsQuery(self, account, startKey, endKey):
         tableName = self.config.getStorageAccountMinuteTable(account)
         accountKey = self.config.getStorageAccountKey(account)
         hostBase = self.config.getStorageHostBase(account)
-        metrics = getStorageMetrics(account, 
-                                    accountKey,
-                                    hostBase,
-                                    tableName,
-                                    startKey,
-                                    endKey)
+        return lambda : getStorageMetrics(account,
+                                          accountKey,
+                                          hostBase,
+                                          tableName,
+                                          startKey,
+                                          endKey)
+
+    def collectMetrixForStandardStorage(self, account, metrics):
+        """
+        Counters of an account without metrics are written with the error
+        flag set, the other accounts are not affected.
+        """
+        counters = []
         stat = AzureStorageStat(metrics)
         counters.append(self.createCounterStorageId(account))
         counters.append(self.createCounterReadBytes(account, stat))
@@ -1018,6 +1670,10 @@ class StorageDataSource(object):
         counters.append(self.createCounterWriteOpE2ELatency(account, stat))
         counters.append(self.createCounterWriteOpServerLatency(account, stat))
         counters.append(self.createCounterWriteOpThroughput(account, stat))
+        for op in stat.getOperations():
+            counters.append(self.createCounterOpCount(account, op, stat))
+            counters.append(self.createCounterOpBytes(account, op, stat))
+            counters.append(self.createCounterOpE2ELatency(account, op, stat))
         return counters
 
     def createCounterDiskType(self, dev, diskType):
@@ -1139,6 +1795,32 @@ class StorageDataSource(object):
                            refreshInterval = 60)
 
 
+    def createCounterOpCount(self, account, op, stat):
+        return PerfCounter(counterType = PerfCounterType.COUNTER_TYPE_INT,
+                           category = "storage",
+                           name = "Storage Op Count",
+                           instance = "{0}/{1}".format(account, op),
+                           value = stat.getOpStat(op)['ops'],
+                           refreshInterval = 60)
+
+    def createCounterOpBytes(self, account, op, stat):
+        return PerfCounter(counterType = PerfCounterType.COUNTER_TYPE_LARGE,
+                           category = "storage",
+                           name = "Storage Op Bytes",
+                           instance = "{0}/{1}".format(account, op),
+                           value = stat.getOpStat(op)['bytes'],
+                           unit = 'byte',
+                           refreshInterval = 60)
+
+    def createCounterOpE2ELatency(self, account, op, stat):
+        return PerfCounter(counterType = PerfCounterType.COUNTER_TYPE_DOUBLE,
+                           category = "storage",
+                           name = "Storage Op Latency E2E msec",
+                           instance = "{0}/{1}".format(account, op),
+                           value = stat.getOpStat(op)['e2eLatency'],
+                           unit = 'ms',
+                           refreshInterval = 60)
+
     def createCounterStorageId(self, account):
         return PerfCounter(counterType = PerfCounterType.COUNTER_TYPE_STRING,
                            category = "storage",
@@ -1176,10 +1858,15 @@ class HvInfo(object):
 class StaticDataSource(object):
     def __init__(self, config):
         self.config = config
+        self.hvInfo = None
+        self.phases = []
 
     def collect(self):
         counters = []
-        hvInfo = HvInfo()
+        self.phases = []
+        if self.hvInfo is None:
+            self.hvInfo = timePhase(self.phases, "HvInfo", HvInfo)
+        hvInfo = self.hvInfo
         counters.append(self.createCounterCloudProvider())
         counters.append(self.createCounterCpuOverCommitted())
         counters.append(self.createCounterMemoryOverCommitted())
@@ -1269,6 +1956,9 @@ class PerfCounterType(object):
     COUNTER_TYPE_LARGE = 3
     COUNTER_TYPE_STRING = 4
 
+def formatCounter(prefix, counter):
+    return u"{0}{1};{2};\n".format(prefix, counter.timestamp, counter.machine)
+
 class PerfCounter(object):
     def __init__(self, 
                  counterType, 
@@ -1286,14 +1976,30 @@ class PerfCounter(object):
         self.value = value
         self.unit = unit
         self.refreshInterval = refreshInterval
+        #Used to tell how long it took to get the value, see CollectionTimings
+        self.createTime = time.time()
         if(timestamp):
             self.timestamp = timestamp
         else:
-            self.timestamp = int(time.time())
+            self.timestamp = int(self.createTime)
         self.machine = socket.gethostname()
 
-    def __str__(self):
-        return (u"{0};{1};{2};{3};{4};{5};{6};{7};{8};{9};\n"
+    def getKey(self):
+        """
+        Everything that is serialized except the timestamp and machine. The
+        value type is part of the key since 1 and 1.0 are formatted apart.
+        """
+        return (self.counterType,
+                self.category,
+                self.name,
+                self.instance,
+                type(self.value),
+                self.value,
+                self.unit,
+                self.refreshInterval)
+
+    def formatPrefix(self):
+        return (u"{0};{1};{2};{3};{4};{5};{6};{7};"
                  "").format(self.counterType,
                             self.category,
                             self.name,
@@ -1301,37 +2007,161 @@ class PerfCounter(object):
                             0 if self.value is not None else 1,
                             self.value if self.value is not None else "",
                             self.unit,
-                            self.refreshInterval,
-                            self.timestamp,
-                            self.machine)
+                            self.refreshInterval)
+
+    def __str__(self):
+        return formatCounter(self.formatPrefix(), self)
 
     __repr__ = __str__
 
 class EnhancedMonitor(object):
     def __init__(self, config):
-        self.dataSources = []
-        self.dataSources.append(VMDataSource(config))
-        self.dataSources.append(StorageDataSource(config))
-        self.dataSources.append(StaticDataSource(config))
+        self.config = config
+        self.dataSources = self.createDataSources(config)
         self.writer = PerfCounterWriter()
+        self.timings = None
+
+    def createDataSources(self, config):
+        dataSources = []
+        dataSources.append(VMDataSource(config))
+        dataSources.append(StorageDataSource(config))
+        dataSources.append(DiskDataSource(config))
+        dataSources.append(StaticDataSource(config))
+        return dataSources
 
     def run(self):
+        #Data sources cache static data. Start over if the config changed.
+        if self.config.refresh():
+            waagent.Log("Shared config changed, reload data sources.")
+            self.dataSources = self.createDataSources(self.config)
         counters = []
+        timings = CollectionTimings()
         for dataSource in self.dataSources:
-            counters.extend(dataSource.collect())
+            startTime = time.time()
+            dataSourceCounters = dataSource.collect()
+            timings.addDataSource(dataSource.__class__.__name__,
+                                  startTime,
+                                  dataSourceCounters,
+                                  dataSource.phases)
+            counters.extend(dataSourceCounters)
         clearLastErrorRecord()
         self.writer.write(counters)
+        timings.finish()
+        timings.write()
+        self.timings = timings
+
+def timePhase(phases, name, func, *args):
+    """
+    Call func(*args) and record (name, startTime, endTime) in phases. Used by
+    the data sources for the work that several counters share.
+    """
+    startTime = time.time()
+    try:
+        return func(*args)
+    finally:
+        phases.append((name, startTime, time.time()))
+
+TimingsFile = os.path.join(LibDir, "Timings")
+class CollectionTimings(object):
+    """
+    Time spent in each data source, in the phases a data source shares
+    between its counters, and on each counter of one collection. The value of
+    a counter is retrieved right before the counter is created, so a counter
+    is charged the time since the previous counter was created, minus the
+    phases that ran in between.
+    """
+    def __init__(self):
+        self.startTime = time.time()
+        self.cycle = None
+        self.dataSources = {}
+        self.phases = {}
+        self.counters = {}
+
+    def addDataSource(self, name, startTime, counters, phases=None):
+        self.dataSources[name] = time.time() - startTime
+        phases = phases or []
+        for phase, phaseStart, phaseEnd in phases:
+            key = "{0}/{1}".format(name, phase)
+            self.phases[key] = self.phases.get(key, 0) + phaseEnd - phaseStart
+        prevTime = startTime
+        for counter in counters:
+            key = "{0}/{1}/{2}".format(counter.category,
+                                       counter.name,
+                                       counter.instance)
+            elapsed = counter.createTime - prevTime
+            for phase, phaseStart, phaseEnd in phases:
+                elapsed -= max(0, min(phaseEnd, counter.createTime) - \
+                                  max(phaseStart, prevTime))
+            self.counters[key] = self.counters.get(key, 0) + elapsed
+            prevTime = counter.createTime
+
+    def finish(self):
+        self.cycle = time.time() - self.startTime
+
+    def toJson(self):
+        return json.dumps({
+            "timestamp" : int(self.startTime),
+            "cycle" : self.cycle,
+            "dataSources" : self.dataSources,
+            "phases" : self.phases,
+            "counters" : self.counters,
+        }, sort_keys=True)
+
+    def write(self, timingsFile=None):
+        if timingsFile is None:
+            timingsFile = TimingsFile
+        tmpFile = timingsFile + ".tmp"
+        try:
+            with open(tmpFile, "w+") as F:
+                F.write(self.toJson())
+            os.rename(tmpFile, timingsFile)
+        except (IOError, OSError) as e:
+            #Timings are diagnostics only, don't fail the collection.
+            waagent.Warn(u"Failed to write timings: {0}".format(e))
+
+class CollectionScheduler(object):
+    """
+    Fires at fixed interval boundaries. A collection that overruns skips the
+    missed slots instead of queuing them up.
+    """
+    def __init__(self, interval=MonitoringInterval, clock=time.time,
+                 sleep=time.sleep):
+        self.interval = interval
+        self.clock = clock
+        self.sleep = sleep
+        self.nextRun = None
+
+    def wait(self):
+        now = self.clock()
+        #Start over on the first run or if the clock was set backwards.
+        if self.nextRun is None or self.nextRun - now > self.interval:
+            self.nextRun = now
+        if self.nextRun > now:
+            self.sleep(self.nextRun - now)
+        else:
+            missed = int((now - self.nextRun) / self.interval)
+            if missed > 0:
+                waagent.Warn(("Collection overran the interval, skip {0} "
+                              "cycle(s).").format(missed))
+                self.nextRun += missed * self.interval
+        self.nextRun += self.interval
 
 EventFile=os.path.join(LibDir, "PerfCounters")
 class PerfCounterWriter(object):
-    def write(self, counters, maxRetry = 3, eventFile=EventFile):
+    def __init__(self):
+        #Serialized counters of the last write, see PerfCounter.getKey
+        self.cache = {}
+
+    def write(self, counters, maxRetry = 3, eventFile=None):
+        if eventFile is None:
+            eventFile = EventFile
         for i in range(0, maxRetry):
             try:
                 self._write(counters, eventFile)
                 waagent.Log(("Write {0} counters to event file."
                              "").format(len(counters)))
                 return
-            except IOError as e:
+            except (IOError, OSError) as e:
                 waagent.Warn((u"Write to perf counters file failed: {0}"
                               "").format(e))
                 waagent.Log("Retry: {0}".format(i))
@@ -1343,15 +2173,42 @@ class PerfCounterWriter(object):
         AddExtensionEvent(message=FAILED_TO_SERIALIZE_PERF_COUNTERS)
         raise
 
+    def serialize(self, counters):
+        """
+        Only counters whose value changed since the last write are formatted
+        again. The cache is rebuilt on every call so stale entries go away.
+        """
+        cache = {}
+        lines = []
+        for counter in counters:
+            key = counter.getKey()
+            prefix = self.cache.get(key)
+            if prefix is None:
+                prefix = counter.formatPrefix()
+            cache[key] = prefix
+            lines.append(formatCounter(prefix, counter))
+        self.cache = cache
+        return u"".join(lines)
+
     def _write(self, counters, eventFile):
-        with open(eventFile, "w+") as F:
-            F.write("".join(map(lambda c : str(c), counters)).encode("utf8"))
+        #Write to a temp file and rename it, so that the reader never sees a
+        #partially written file.
+        tmpFile = eventFile + ".tmp"
+        with open(tmpFile, "w+") as F:
+            F.write(self.serialize(counters).encode("utf8"))
+        os.rename(tmpFile, eventFile)
+
+SharedConfigFile = "/var/lib/waagent/SharedConfig.xml"
+
+def getFileMtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
 
 class EnhancedMonitorConfig(object):
     def __init__(self, publicConfig, privateConfig):
-        xmldoc = minidom.parse('/var/lib/waagent/SharedConfig.xml')
-        self.deployment = xmldoc.getElementsByTagName('Deployment')
-        self.role = xmldoc.getElementsByTagName('Role')
+        self.loadSharedConfig()
         self.configData = {}
         diskCount = 0
         accountNames = []
@@ -1368,6 +2225,21 @@ class EnhancedMonitorConfig(object):
         self.configData["disk.count"] = diskCount
         self.configData["account.names"] = accountNames
 
+    def loadSharedConfig(self):
+        self.sharedConfigMtime = getFileMtime(SharedConfigFile)
+        xmldoc = minidom.parse(SharedConfigFile)
+        self.deployment = xmldoc.getElementsByTagName('Deployment')
+        self.role = xmldoc.getElementsByTagName('Role')
+
+    def refresh(self):
+        """
+        Parse SharedConfig.xml again if it has been modified since it was
+        last loaded. Return True if the config was reloaded.
+        """
+        if getFileMtime(SharedConfigFile) == self.sharedConfigMtime:
+            return False
+        self.loadSharedConfig()
+        return True
 
     def getVmSize(self):
         return self.configData.get("vmsize")
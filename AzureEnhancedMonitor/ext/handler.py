@@ -86,9 +86,10 @@ def daemon(hutil):
     monitor = aem.EnhancedMonitor(config)
     hutil.set_verbose_log(config.isVerbose())
     InitExtensionEventLog(hutil.get_name())
+    scheduler = aem.CollectionScheduler()
     while True:
+        scheduler.wait()
         waagent.Log("Collecting performance counter.")
-        startTime = time.time()
         try:
             monitor.run()
             message = ("deploymentId={0} roleInstance={1} OK"
@@ -101,11 +102,6 @@ def daemon(hutil):
                                            traceback.format_exc()))
             hutil.do_status_report("Enable", "error", 0, "{0}".format(e))
         waagent.Log("Finished collection.")
-        timeElapsed = time.time() - startTime
-        timeToWait = (aem.MonitoringInterval - timeElapsed)
-        #Make sure timeToWait is in the range [0, aem.MonitoringInterval)
-        timeToWait = timeToWait % aem.MonitoringInterval
-        time.sleep(timeToWait)
 
 def grace_exit(operation, status, msg):
     hutil = parse_context(operation)
@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+#
+# Copyright 2014 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Benchmark of a full collection cycle, EnhancedMonitor.run, against fake
+/proc, /sys and table service fixtures.
+
+Usage: python benchmark_aem.py [--report FILE] [--baseline FILE]
+                                [--tolerance PCT]
+                                [cycles] [cpus] [nics] [disks] [accounts]
+
+Cycle latency percentiles, per data source, phase and slowest counter timings
+and object allocations are printed and written to the report file,
+"Benchmark" in the current directory by default.
+
+With --baseline, the report of an earlier run with the same parameters, the
+median cycle and data source latencies are compared against it and the
+benchmark exits with 1 if any of them is more than --tolerance percent
+(default 20) slower.
+"""
+
+import argparse
+import collections
+import gc
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import env
+import aem
+import test_aem
+from Utils.WAAgentUtil import waagent
+
+#Simulated round trip of one table query
+TableQueryLatency = 0.02
+
+DefaultReportFile = "Benchmark"
+DefaultTolerance = 20
+
+SharedConfig = """\
+<?xml version="1.0" encoding="utf-8"?>
+<SharedConfig version="1.0.0.0" goalStateIncarnation="1">
+  <Deployment name="cd98461b43364478a908d03d0c3135a7" incarnation="0">
+    <Service name="osupdate" />
+  </Deployment>
+  <Role name="osupdate" settleTimeSeconds="0" />
+</SharedConfig>
+"""
+
+ProcNetSnmp = """\
+Tcp: RtoAlgorithm RtoMin RtoMax MaxConn ActiveOpens PassiveOpens AttemptFails EstabResets CurrEstab InSegs OutSegs RetransSegs InErrs OutRsts InCsumErrors
+Tcp: 1 200 120000 -1 40 30 0 22 2 6205 6204 7 0 5 0
+Udp: InDatagrams NoPorts InErrors OutDatagrams RcvbufErrors SndbufErrors InCsumErrors IgnoredMulti MemErrors
+Udp: 24 0 0 24 0 0 0 0 0
+"""
+
+ProcNetNetstat = """\
+TcpExt: ListenOverflows ListenDrops TCPTimeouts
+TcpExt: 0 0 3
+"""
+
+snetio = collections.namedtuple('snetio', ['bytes_sent', 'bytes_recv'])
+
+class ObjectView(object):
+    def __init__(self, data):
+        self.__dict__ = data
+
+class FakeTableService(object):
+    def __init__(self, account_name=None, account_key=None, host_base=None):
+        self.accountName = account_name
+
+    def query_entities(self, table, ofilter=None, oselect=None, top=None):
+        time.sleep(TableQueryLatency)
+        if table.startswith("Linux"):
+            return [ObjectView({"PercentProcessorTime" : 10.0,
+                                "PercentAvailableMemory" : 50.0})]
+        return test_aem.mock_getStorageMetrics()
+
+class FakeHvInfo(object):
+    def getHvName(self):
+        return "Microsoft Hyper-V"
+
+    def getHvVersion(self):
+        return "6.2"
+
+def getScsiDevName(index):
+    """
+    sda, ..., sdz, sdaa, ... like the kernel names SCSI disks.
+    """
+    name = ""
+    index += 1
+    while index > 0:
+        index, rem = divmod(index - 1, 26)
+        name = chr(ord("a") + rem) + name
+    return "sd" + name
+
+def writeFile(path, content):
+    dirName = os.path.dirname(path)
+    if not os.path.isdir(dirName):
+        os.makedirs(dirName)
+    waagent.SetFileContents(path, content)
+
+def setUpFixtures(root, cpus, nics, disks):
+    libDir = os.path.join(root, "lib")
+    os.makedirs(libDir)
+    aem.LibDir = libDir
+    aem.EventFile = os.path.join(libDir, "PerfCounters")
+    aem.TimingsFile = os.path.join(libDir, "Timings")
+    aem.HwInfoFile = os.path.join(libDir, "HwInfo")
+    aem.NetworkSnapshotFile = os.path.join(libDir, "NetworkSnapshot")
+    aem.DiskSnapshotFile = os.path.join(libDir, "DiskSnapshot")
+
+    aem.SharedConfigFile = os.path.join(root, "SharedConfig.xml")
+    writeFile(aem.SharedConfigFile, SharedConfig)
+
+    aem.CPUSysDir = os.path.join(root, "sys/devices/system/cpu")
+    aem.CPUInfoFile = os.path.join(root, "proc/cpuinfo")
+    writeFile(os.path.join(aem.CPUSysDir, "online"), "0-{0}".format(cpus - 1))
+    cpuinfo = []
+    for cpu in range(0, cpus):
+        topology = os.path.join(aem.CPUSysDir, "cpu{0}".format(cpu),
+                                "topology")
+        writeFile(os.path.join(topology, "physical_package_id"), "0")
+        writeFile(os.path.join(topology, "core_id"), str(cpu / 2))
+        cpuinfo.append(("processor\t: {0}\nvendor_id\t: GenuineIntel\n"
+                        "model name\t: Intel(R) Xeon(R)\n"
+                        "cpu MHz\t\t: 2394.454\n"
+                        "flags\t\t: fpu vme de pse tsc msr pae mce\n"
+                        "").format(cpu))
+    writeFile(aem.CPUInfoFile, "\n".join(cpuinfo))
+
+    aem.ProcNetStatFiles = [os.path.join(root, "proc/net/snmp"),
+                            os.path.join(root, "proc/net/netstat")]
+    writeFile(aem.ProcNetStatFiles[0], ProcNetSnmp)
+    writeFile(aem.ProcNetStatFiles[1], ProcNetNetstat)
+
+    aem.SysNetDir = os.path.join(root, "sys/class/net")
+    nicNames = ["eth{0}".format(i) for i in range(0, nics)]
+    for i, nicName in enumerate(nicNames):
+        writeFile(os.path.join(aem.SysNetDir, nicName, "address"),
+                  "00:0d:3a:00:00:{0:0>2x}\n".format(i))
+    samples = [0]
+    def net_io_counters(pernic=False):
+        samples[0] += 1
+        stats = {"lo" : snetio(0, 0)}
+        for nicName in nicNames:
+            stats[nicName] = snetio(samples[0] * 1000, samples[0] * 2000)
+        return stats
+    aem.psutil.net_io_counters = net_io_counters
+
+    aem.SysBlockDir = os.path.join(root, "sys/block")
+    for lun in range(0, disks):
+        #sda is the OS disk and sdb the resource disk
+        dev = getScsiDevName(lun + 2)
+        os.makedirs(os.path.join(aem.SysBlockDir, dev, "device/scsi_disk",
+                                 "5:0:0:{0}".format(lun)))
+    os.makedirs(os.path.join(aem.SysBlockDir, "sda"))
+    aem.DiskStatsFile = os.path.join(root, "proc/diskstats")
+    diskstats = []
+    for lun in range(-1, disks):
+        dev = getScsiDevName(lun + 2) if lun >= 0 else "sda"
+        diskstats.append(("   8       0 {0} 9814 3047 889316 4080 7283 "
+                          "7473 316538 14474 0 10204 18554 0 0 0 0"
+                          "").format(dev))
+    writeFile(aem.DiskStatsFile, "\n".join(diskstats))
+
+    aem.TableService = FakeTableService
+    aem.TableServices.clear()
+    aem.HvInfo = FakeHvInfo
+
+def createConfig(disks, accounts):
+    publicConfig = json.loads(test_aem.TestPublicConfig)
+    privateConfig = json.loads(test_aem.TestPrivateConfig)
+    for lun in range(0, disks):
+        publicConfig["cfg"].extend([
+            {"key" : "disk.lun.{0}".format(lun), "value" : lun},
+            {"key" : "disk.name.{0}".format(lun), "value" : "d.vhd"},
+            {"key" : "disk.account.{0}".format(lun), "value" : "asdf"},
+            {"key" : "disk.type.{0}".format(lun), "value" : "Standard"},
+        ])
+    for i in range(0, accounts):
+        name = "acct{0}".format(i)
+        uri = ("https://{0}.table.core.windows.net/"
+               "$metricsminuteprimarytransactionsblob").format(name)
+        publicConfig["cfg"].extend([
+            {"key" : "{0}.minute.name".format(name), "value" : name},
+            {"key" : "{0}.minute.uri".format(name), "value" : uri},
+        ])
+        privateConfig["cfg"].append({"key" : "{0}.minute.key".format(name),
+                                     "value" : "qwer"})
+    return aem.EnhancedMonitorConfig(publicConfig, privateConfig)
+
+def percentile(values, pct):
+    values = sorted(values)
+    index = int(round(pct / 100.0 * (len(values) - 1)))
+    return values[index]
+
+def summarize(values):
+    return {
+        "p50" : percentile(values, 50),
+        "p90" : percentile(values, 90),
+        "p99" : percentile(values, 99),
+        "max" : max(values),
+    }
+
+def benchmark(cycles, cpus, nics, disks, accounts):
+    root = tempfile.mkdtemp()
+    try:
+        setUpFixtures(root, cpus, nics, disks)
+        #Make sure the collection sees the fixture, not the host
+        cores = aem.CPUInfo.getCPUInfo().getNumOfCores()
+        if cores != cpus:
+            raise ValueError(("Benchmark sees {0} CPUs instead of the {1} of "
+                              "the fixture").format(cores, cpus))
+        monitor = aem.EnhancedMonitor(createConfig(disks, accounts))
+        cycleTimes = []
+        dataSourceTimes = collections.defaultdict(list)
+        phaseTimes = collections.defaultdict(list)
+        counterTimes = collections.defaultdict(list)
+        allocated = []
+        for i in range(0, cycles):
+            gc.collect()
+            objects = len(gc.get_objects())
+            startTime = time.time()
+            monitor.run()
+            cycleTimes.append(time.time() - startTime)
+            allocated.append(len(gc.get_objects()) - objects)
+            for name, elapsed in monitor.timings.dataSources.items():
+                dataSourceTimes[name].append(elapsed)
+            for name, elapsed in monitor.timings.phases.items():
+                phaseTimes[name].append(elapsed)
+            for name, elapsed in monitor.timings.counters.items():
+                counterTimes[name].append(elapsed)
+
+        slowest = sorted(counterTimes.items(),
+                         key=lambda c : -percentile(c[1], 50))[:10]
+        report = {
+            "parameters" : {"cycles" : cycles, "cpus" : cpus, "nics" : nics,
+                            "disks" : disks, "accounts" : accounts},
+            "cycle" : summarize(cycleTimes),
+            "dataSources" : dict((name, summarize(values))
+                                 for name, values in dataSourceTimes.items()),
+            "phases" : dict((name, summarize(values))
+                            for name, values in phaseTimes.items()),
+            "slowestCounters" : dict((name, summarize(values))
+                                     for name, values in slowest),
+            "objectsRetainedPerCycle" : summarize(allocated),
+            "maxRssKB" : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        }
+        return report
+    finally:
+        shutil.rmtree(root)
+
+def compareToBaseline(report, baseline, tolerance):
+    """
+    Return the regressions of report against baseline, a list of
+    (name, baseline p50, p50) for the cycle and the data sources whose median
+    is more than tolerance percent slower.
+    """
+    if report["parameters"] != baseline["parameters"]:
+        raise ValueError(("Baseline parameters {0} don't match {1}"
+                          "").format(baseline["parameters"],
+                                     report["parameters"]))
+    limit = 1 + tolerance / 100.0
+    timings = [("cycle", baseline["cycle"], report["cycle"])]
+    for name, values in sorted(report["dataSources"].items()):
+        if name in baseline["dataSources"]:
+            timings.append((name, baseline["dataSources"][name], values))
+    regressions = []
+    for name, old, new in timings:
+        if new["p50"] > old["p50"] * limit:
+            regressions.append((name, old["p50"], new["p50"]))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark EnhancedMonitor.run")
+    parser.add_argument("--report", default=DefaultReportFile,
+                        help="file the report is written to")
+    parser.add_argument("--baseline",
+                        help="report of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=DefaultTolerance,
+                        help="allowed slowdown against the baseline, percent")
+    parser.add_argument("sizes", type=int, nargs="*",
+                        help="cycles, cpus, nics, disks, accounts")
+    options = parser.parse_args()
+
+    waagent.LoggerInit("/dev/null", "/dev/null")
+    defaults = [20, 64, 4, 16, 4]
+    args = options.sizes + defaults[len(options.sizes):]
+    report = benchmark(*args)
+    content = json.dumps(report, indent=2, sort_keys=True)
+    print(content)
+    with open(options.report, "w") as F:
+        F.write(content)
+
+    if options.baseline is not None:
+        with open(options.baseline) as F:
+            baseline = json.loads(F.read())
+        regressions = compareToBaseline(report, baseline, options.tolerance)
+        for name, old, new in regressions:
+            print(("{0}: median {1:.4f}s, baseline {2:.4f}s, more than {3}% "
+                   "slower").format(name, new, old, options.tolerance))
+        if len(regressions) > 0:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
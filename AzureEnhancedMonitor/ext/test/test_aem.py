@@ -17,7 +17,10 @@
 # limitations under the License.
 
 import datetime
+import time
 import os
+import shutil
+import tempfile
 import json
 import unittest
 
@@ -169,6 +172,58 @@ class TestAEM(unittest.TestCase):
         self.assertEquals(float, type(percent))
         self.assertTrue(percent >= 0 and percent <= 100)
 
+    def test_cpu_topology(self):
+        cpuDir = tempfile.mkdtemp()
+        cpuinfoFile = os.path.join(cpuDir, "cpuinfo")
+        waagent.SetFileContents(cpuinfoFile, ("processor\t: 0\n"
+                                              "vendor_id\t: GenuineIntel\n"
+                                              "model name\t: Intel(R) Xeon(R)\n"
+                                              "cpu MHz\t\t: 2394.454\n"
+                                              "\n"
+                                              "processor\t: 1\n"
+                                              "vendor_id\t: Other\n"))
+        waagent.SetFileContents(os.path.join(cpuDir, "online"), "0-7")
+        #2 sockets, 2 cores per socket, 2 threads per core
+        for cpu in range(0, 8):
+            topology = os.path.join(cpuDir, "cpu{0}".format(cpu), "topology")
+            os.makedirs(topology)
+            waagent.SetFileContents(os.path.join(topology,
+                                                 "physical_package_id"),
+                                    str(cpu / 4))
+            waagent.SetFileContents(os.path.join(topology, "core_id"),
+                                    str(cpu % 4 / 2))
+
+        cpuinfo = aem.CPUInfo.getCPUInfo(cpuDir, cpuinfoFile)
+        self.assertEquals(8, cpuinfo.getNumOfCores())
+        self.assertEquals(2, cpuinfo.getNumOfCoresPerCPU())
+        self.assertEquals(2, cpuinfo.getNumOfThreadsPerCore())
+        self.assertTrue(cpuinfo.isHyperThreadingOn())
+        self.assertEquals("Intel(R) Xeon(R), GenuineIntel",
+                          cpuinfo.getProcessorType())
+        self.assertEquals(2394.454, cpuinfo.getFrequency())
+        self.assertTrue(cpuinfo is aem.CPUInfo.getCPUInfo(cpuDir, cpuinfoFile))
+
+        #cpufreq is preferred
+        os.makedirs(os.path.join(cpuDir, "cpu0", "cpufreq"))
+        waagent.SetFileContents(os.path.join(cpuDir, "cpu0", "cpufreq",
+                                             "scaling_cur_freq"), "2600000")
+        self.assertEquals(2600.0, cpuinfo.getFrequency())
+
+        #Hotplug
+        waagent.SetFileContents(os.path.join(cpuDir, "online"), "0-3")
+        cpuinfo = aem.CPUInfo.getCPUInfo(cpuDir, cpuinfoFile)
+        self.assertEquals(4, cpuinfo.getNumOfCores())
+        self.assertEquals(2, cpuinfo.getNumOfCoresPerCPU())
+
+        #The module level paths are used by default
+        sysDir, infoFile = aem.CPUSysDir, aem.CPUInfoFile
+        aem.CPUSysDir, aem.CPUInfoFile = cpuDir, cpuinfoFile
+        try:
+            self.assertTrue(cpuinfo is aem.CPUInfo.getCPUInfo())
+        finally:
+            aem.CPUSysDir, aem.CPUInfoFile = sysDir, infoFile
+        shutil.rmtree(cpuDir)
+
     def test_meminfo(self):
         meminfo = aem.MemoryInfo()
         self.assertNotEquals(None, meminfo.getMemSize())
@@ -188,6 +243,87 @@ class TestAEM(unittest.TestCase):
         self.assertNotEquals(None, netinfo.getNetworkWriteBytes())
         self.assertNotEquals(None, netinfo.getNetworkPacketRetransmitted())
 
+    def test_network_sampler(self):
+        testSnapshotFile = "/tmp/NetworkSnapshot"
+        if os.path.isfile(testSnapshotFile):
+            os.remove(testSnapshotFile)
+        class Stat(object):
+            def __init__(self, recv, sent):
+                self.bytes_recv = recv
+                self.bytes_sent = sent
+
+        #No baseline on first sample
+        sampler = aem.NetworkSampler({"eth0" : Stat(1000, 2000)},
+                                     snapshotFile = testSnapshotFile)
+        self.assertEquals({}, sampler.getRates())
+        self.assertTrue(os.path.isfile(testSnapshotFile))
+
+        sampler = aem.NetworkSampler({"eth0" : Stat(7000, 5000),
+                                      "eth1" : Stat(10, 10)},
+                                     snapshotFile = testSnapshotFile)
+        sampler.timestamp = sampler.loadSnapshot()[0] + 60
+        rates = sampler.getRates()
+        self.assertAlmostEqual(100, rates["eth0"][0])
+        self.assertAlmostEqual(50, rates["eth0"][1])
+        self.assertFalse("eth1" in rates)
+
+    def test_parse_proc_net_stat(self):
+        content = ("Ip: Forwarding DefaultTTL\n"
+                   "Ip: 2 64\n"
+                   "Tcp: RtoAlgorithm RtoMin MaxConn CurrEstab RetransSegs\n"
+                   "Tcp: 1 200 -1 2 42\n"
+                   "Udp: InDatagrams NoPorts\n"
+                   "Udp: 24 0\n")
+        stats = aem.parseProcNetStat(content)
+        self.assertEquals(42, stats["Tcp"]["RetransSegs"])
+        self.assertEquals(-1, stats["Tcp"]["MaxConn"])
+        self.assertEquals(24, stats["Udp"]["InDatagrams"])
+        self.assertEquals(64, stats["Ip"]["DefaultTTL"])
+
+        netinfo = aem.NetworkInfo()
+        netinfo.protocolStats = stats
+        self.assertEquals(42, netinfo.getNetworkPacketRetransmitted())
+        self.assertEquals(None, netinfo.getProtocolStat("TcpExt", "TCPTimeouts"))
+
+    def test_disk_sampler(self):
+        testDir = tempfile.mkdtemp()
+        statsFile = os.path.join(testDir, "diskstats")
+        snapshotFile = os.path.join(testDir, "DiskSnapshot")
+        line = "   8      32 {0} {1} 0 {2} {3} {4} 0 {5} {6} 0 0 {7} 0 0 0 0\n"
+        waagent.SetFileContents(statsFile,
+                                line.format("sdc", 0, 0, 0, 0, 0, 0, 0) +
+                                line.format("sdc1", 0, 0, 0, 0, 0, 0, 0))
+        stats = aem.parseDiskStats(waagent.GetFileContents(statsFile),
+                                   ["sdc"])
+        self.assertEquals(["sdc"], stats.keys())
+        self.assertEquals(11, len(stats["sdc"]))
+
+        sampler = aem.DiskSampler(["sdc"], snapshotFile, statsFile)
+        self.assertEquals({}, sampler.getRates())
+
+        #600 reads and 1200 writes of 4KB each in 60s
+        waagent.SetFileContents(statsFile,
+                                line.format("sdc", 600, 4800, 1200,
+                                            1200, 9600, 6000, 120000))
+        timestamp, snapshot = aem.loadCounterSnapshot(snapshotFile)
+        aem.saveCounterSnapshot(snapshotFile, timestamp - 60, snapshot)
+        rates = sampler.getRates()["sdc"]
+        self.assertAlmostEquals(10, rates["readIops"], 1)
+        self.assertAlmostEquals(20, rates["writeIops"], 1)
+        self.assertAlmostEquals(600 * 4 / 1024.0 / 60,
+                                rates["readThroughput"], 3)
+        self.assertAlmostEquals(4, rates["latency"])
+        self.assertAlmostEquals(2, rates["queueDepth"], 1)
+        shutil.rmtree(testDir)
+
+    def test_counter_delta(self):
+        self.assertEquals(5, aem.counterDelta(10, 15))
+        #32-bit wrap
+        self.assertEquals(20, aem.counterDelta(aem.CounterWrap32 - 10, 10))
+        #Reset
+        self.assertEquals(10, aem.counterDelta(100, 10))
+        self.assertEquals(10, aem.counterDelta(1 << 40, 10))
+
     def test_hwchangeinfo(self):
         netinfo = aem.NetworkInfo()
         testHwInfoFile = "/tmp/HwInfo"
@@ -299,11 +435,102 @@ class TestAEM(unittest.TestCase):
         self.assertNotEquals(None, stat.getWriteOpServerLatency())
         self.assertNotEquals(None, stat.getWriteOpThroughput())
 
+    def test_storage_aggregation(self):
+        metrics = mock_getStorageMetrics()
+        self.assertEquals("read", aem.getOperationType("user;GetBlob"))
+        self.assertEquals("write", aem.getOperationType("user;PutPage"))
+        self.assertEquals(None, aem.getOperationType("user;All"))
+        self.assertEquals(None, aem.getOperationType("system;GetBlob"))
+
+        stat = aem.AzureStorageStat(metrics)
+        writes = filter(lambda m : m.RowKey in ["user;ClearPage",
+                                                "user;PutBlob",
+                                                "user;PutPage"], metrics)
+        self.assertEquals(sum(map(lambda m : m.TotalRequests, writes)),
+                          stat.getWriteOps())
+        self.assertEquals(sum(map(lambda m : m.TotalIngress + m.TotalEgress,
+                                  writes)),
+                          stat.getWriteBytes())
+        self.assertEquals(["ClearPage", "GetBlob", "PutBlob", "PutPage"],
+                          stat.getOperations())
+        getBlob = next(m for m in metrics if m.RowKey == "user;GetBlob")
+        self.assertEquals(getBlob.TotalRequests, stat.getReadOps())
+        self.assertEquals(getBlob.TotalRequests,
+                          stat.getOpStat("GetBlob")["ops"])
+        self.assertAlmostEquals(getBlob.AverageE2ELatency,
+                                stat.getOpStat("GetBlob")["e2eLatency"])
+
+        stat = aem.AzureStorageStat(None)
+        self.assertEquals(None, stat.getReadOps())
+        self.assertEquals([], stat.getOperations())
+
+    def test_run_queries(self):
+        slowCalls = []
+        def slow():
+            slowCalls.append(1)
+            time.sleep(5)
+            return "slow"
+        def fail():
+            raise Exception("fail")
+        queries = [("slow", slow), ("fail", fail)]
+        queries.extend([(i, lambda i=i: i) for i in range(0, 10)])
+        results = aem.runQueries(queries, maxWorkers = 2, timeout = 0.5)
+        self.assertEquals(12, len(results))
+        for i in range(0, 10):
+            self.assertEquals((i, None), results[i])
+        self.assertEquals(None, results["slow"][0])
+        self.assertEquals(aem.QueryTimeoutError, type(results["slow"][1]))
+        self.assertEquals(None, results["fail"][0])
+        self.assertNotEquals(None, results["fail"][1])
+        self.assertEquals({}, aem.runQueries([]))
+
+        #Only the first query of a repeated key is run
+        results = aem.runQueries([("a", lambda : 1), ("a", lambda : 2)],
+                                 maxWorkers = 2, timeout = 0.5)
+        self.assertEquals({"a" : (1, None)}, results)
+
+        #The abandoned query is still running, don't start another one
+        results = aem.runQueries([("slow", slow), ("fast", lambda : 1)],
+                                 maxWorkers = 2, timeout = 0.5)
+        self.assertEquals(aem.QueryTimeoutError, type(results["slow"][1]))
+        self.assertEquals((1, None), results["fast"])
+        self.assertEquals(1, len(slowCalls))
+
     def test_disk_info(self):
         config = self.test_config()
         mapping = aem.DiskInfo(config).getDiskMapping()
         self.assertNotEquals(None, mapping)
 
+    def test_disk_topology(self):
+        sysBlockDir = aem.SysBlockDir
+        aem.SysBlockDir = tempfile.mkdtemp()
+        try:
+            for dev, addr in [("sda", "0:0:0:0"), ("sdb", "1:0:1:0"),
+                              ("sdc", "5:0:0:0"), ("sdaa", "5:0:0:24")]:
+                os.makedirs(os.path.join(aem.SysBlockDir, dev,
+                                         "device/scsi_disk", addr))
+            topology = aem.DiskTopology.getDiskTopology()
+            self.assertEquals("sda", topology.getOSDisk())
+            self.assertEquals(["sdaa", "sdc"], topology.getDataDisks())
+            self.assertEquals("sdaa", topology.getDevByLun(24))
+            self.assertEquals(0, topology.getLun("sdc"))
+            self.assertTrue(topology is aem.DiskTopology.getDiskTopology())
+
+            aem.SysBlockDir = tempfile.mkdtemp()
+            for dev, model in [("nvme0n1", "MSFT NVMe Accelerator v1.0"),
+                               ("nvme0n3", "MSFT NVMe Accelerator v1.0"),
+                               ("nvme1n1", "Microsoft NVMe Direct Disk")]:
+                os.makedirs(os.path.join(aem.SysBlockDir, dev, "device"))
+                waagent.SetFileContents(os.path.join(aem.SysBlockDir, dev,
+                                                     "device/model"), model)
+            topology = aem.DiskTopology.getDiskTopology()
+            self.assertEquals("nvme0n1", topology.getOSDisk())
+            self.assertEquals(["nvme0n3"], topology.getDataDisks())
+            self.assertEquals("nvme0n3", topology.getDevByLun(1))
+        finally:
+            aem.SysBlockDir = sysBlockDir
+            aem.DiskTopology.cached = None
+
     def test_get_storage_key_range(self):
         startKey, endKey = aem.getStorageTableKeyRange()
         self.assertNotEquals(None, startKey)
@@ -358,12 +585,109 @@ class TestAEM(unittest.TestCase):
             content = F.read()
             self.assertEquals(str(counters[0]), content)
 
-        testEventFile = "/dev/console"
+        self.assertFalse(os.path.isfile(testEventFile + ".tmp"))
+
+        #Unchanged counters are served from the cache
+        counters.append(aem.PerfCounter(counterType = 1,
+                                        category = "test",
+                                        name = "int",
+                                        value = 1))
+        writer.write(counters, eventFile = testEventFile)
+        self.assertEquals(2, len(writer.cache))
+        counters[1].value = 1.0
+        content = writer.serialize(counters)
+        self.assertEquals("".join(map(lambda c : str(c), counters)), content)
+        self.assertTrue("int;;0;1.0;" in content)
+
+        testEventFile = "/nonexistent/Event"
         print("==============================")
         print("The warning below is expected.")
         self.assertRaises(IOError, writer.write, counters, 2, testEventFile)
         print("==============================")
 
+    def test_scheduler(self):
+        clock = [1000.0]
+        sleeps = []
+        def sleep(secs):
+            sleeps.append(secs)
+            clock[0] += secs
+        scheduler = aem.CollectionScheduler(interval = 60,
+                                            clock = lambda : clock[0],
+                                            sleep = sleep)
+        #First run starts immediately
+        scheduler.wait()
+        self.assertEquals([], sleeps)
+
+        #Collection took 10s
+        clock[0] += 10
+        scheduler.wait()
+        self.assertEquals([50], sleeps)
+
+        #Collection overran by 2 intervals, run now and realign
+        clock[0] += 150
+        scheduler.wait()
+        self.assertEquals([50], sleeps)
+        self.assertEquals(1240, scheduler.nextRun)
+
+    def test_table_service_cache(self):
+        service = aem.getTableService("asdf", "qwer", ".table.core.windows.net")
+        self.assertTrue(service is aem.getTableService("asdf", "qwer",
+                                            ".table.core.windows.net"))
+        self.assertFalse(service is aem.getTableService("asdf", "zxcv",
+                                            ".table.core.windows.net"))
+
+    def test_collection_timings(self):
+        timings = aem.CollectionTimings()
+        startTime = time.time()
+        counters = [aem.PerfCounter(counterType = 1,
+                                    category = "test",
+                                    name = "test",
+                                    instance = str(i),
+                                    value = i) for i in range(0, 3)]
+        counters[0].createTime = startTime + 1
+        counters[1].createTime = startTime + 1.5
+        counters[2].createTime = startTime + 3.5
+        timings.addDataSource("TestDataSource", startTime, counters)
+        timings.finish()
+        self.assertEquals(1, timings.counters["test/test/0"])
+        self.assertEquals(0.5, timings.counters["test/test/1"])
+        self.assertEquals(2, timings.counters["test/test/2"])
+        self.assertTrue("TestDataSource" in timings.dataSources)
+
+        testTimingsFile = "/tmp/Timings"
+        timings.write(testTimingsFile)
+        with open(testTimingsFile) as F:
+            content = json.loads(F.read())
+        self.assertEquals(3, len(content["counters"]))
+        self.assertNotEquals(None, content["cycle"])
+
+    def test_collection_timings_phases(self):
+        timings = aem.CollectionTimings()
+        startTime = time.time()
+        counters = [aem.PerfCounter(counterType = 1,
+                                    category = "test",
+                                    name = "test",
+                                    instance = str(i),
+                                    value = i) for i in range(0, 2)]
+        counters[0].createTime = startTime + 3
+        counters[1].createTime = startTime + 4
+        #Shared setup before the first counter, and one phase that straddles
+        #the creation of the first counter
+        phases = [("Setup", startTime, startTime + 2.5),
+                  ("Shared", startTime + 2.75, startTime + 3.5)]
+        timings.addDataSource("TestDataSource", startTime, counters, phases)
+        self.assertEquals(2.5, timings.phases["TestDataSource/Setup"])
+        self.assertEquals(0.75, timings.phases["TestDataSource/Shared"])
+        self.assertEquals(0.25, timings.counters["test/test/0"])
+        self.assertEquals(0.5, timings.counters["test/test/1"])
+
+    def test_time_phase(self):
+        phases = []
+        self.assertEquals(3, aem.timePhase(phases, "Add", lambda a, b: a + b,
+                                           1, 2))
+        self.assertEquals("Add", phases[0][0])
+        self.assertTrue(phases[0][1] <= phases[0][2])
+
     def test_easyHash(self):
         hashVal = aem.easyHash('a')
         self.assertEquals(97, hashVal)
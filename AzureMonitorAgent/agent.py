@@ -26,7 +26,6 @@ import pwd
 import glob
 import grp
 import re
-import filecmp
 import stat
 import traceback
 import time
@@ -37,18 +36,21 @@ import base64
 import inspect
 import shutil
 import hashlib
-import fileinput
-import contextlib
+import ctypes
+import ctypes.util
+import select
+import struct
 import ama_tst.modules.install.supported_distros as supported_distros
 from collections import OrderedDict
 from hashlib import sha256
 from shutil import copyfile, rmtree, copytree, copy2
 
-from threading import Thread
+from threading import Thread, Lock
 import telegraf_utils.telegraf_config_handler as telhandler
 import metrics_ext_utils.metrics_constants as metrics_constants
 import metrics_ext_utils.metrics_ext_handler as me_handler
 import metrics_ext_utils.metrics_common_utils as metrics_utils
+import metrics_ext_utils.imds_client as imds_client
 
 try:
     import urllib.request as urllib # Python 3+
@@ -133,10 +135,65 @@ AMAAstTransformConfigMarkerPath = '/etc/opt/microsoft/azuremonitoragent/config-c
 AMAExtensionLogRotateFilePath = '/etc/logrotate.d/azuremonitoragentextension'
 WAGuestAgentLogRotateFilePath = '/etc/logrotate.d/waagent-extn.logrotate'
 AmaUninstallContextFile = '/var/opt/microsoft/uninstall-context'
+# Package file list recorded at install time and journal of an uninstall cleanup that is in progress
+PackageFilesManifestPath = '/var/opt/microsoft/azuremonitoragent-files.manifest.json'
+PackageCleanupJournalPath = '/var/opt/microsoft/azuremonitoragent-cleanup.journal.json'
+MaxCleanupWorkers = 4
 AmaDataPath = '/var/opt/microsoft/azuremonitoragent/'
+ConfigWatcherPidFile = 'amaconfigwatcher.pid'
+# Watcher processes of versions that ran one process per config, stopped on upgrade
+LegacyWatcherProcesses = [('amametrics.pid', '-metrics'),
+                          ('amasyslogconfig.pid', '-syslogconfig'),
+                          ('amatransformconfig.pid', '-transformconfig')]
+# Health checks and MSI token refresh run at this interval; config changes are handled as they happen
+ConfigWatcherPeriodicSeconds = 30
+# Interval to poll config files at when inotify is not available
+ConfigWatcherPollSeconds = 1
+# Time given to a config writer to finish before a notified file is read
+ConfigWatcherSettleSeconds = 0.2
+# Restarts of telegraf and ME back off exponentially, up to a budget of restarts per window
+ProcessRestartBackoffSeconds = 5
+ProcessRestartMaxBackoffSeconds = 300
+ProcessRestartBudget = 10
+ProcessRestartBudgetWindowSeconds = 3600
+SupervisorMetricsPath = os.path.join(AmaDataPath, 'supervisor-metrics.json')
+# Per-phase durations of each handler operation, one JSON record per line, rotated to TimingsFilePath.1. A record is
+# appended after each top-level phase and at exit, the last record of an operation and start supersedes earlier ones.
+# Kept in the agent data directory, so a complete uninstall removes it.
+TimingsFilePath = os.path.join(AmaDataPath, 'handler-timings.json')
+TimingsFileMaxBytes = 1024 * 1024
+TimingsSummaryPhases = 5
+ConfigWatcherTimingsSeconds = 3600
 SupportedArch = set(['x86_64', 'aarch64'])
+BinaryManifestPath = '/opt/microsoft/azuremonitoragent/binaries.manifest.json'
+BinaryMode = stat.S_IXGRP | stat.S_IRGRP | stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR | stat.S_IXOTH | stat.S_IROTH
+MaxBinaryStagingWorkers = 4
 MDSDFluentPort = 0
 MDSDSyslogPort = 0
+# Port settings substituted into the fluent-bit, rsyslog and syslog-ng configs
+ConfigFileMode = stat.S_IRGRP | stat.S_IRUSR | stat.S_IWUSR | stat.S_IROTH
+FluentPortPattern = re.compile(r'^.*Port.*\n?', re.M)
+RsyslogPortPattern = re.compile(re.escape('Port="28330"'))
+SyslogNgPortPattern = re.compile(re.escape('port(28330)'))
+# SELinux config and policy stores, including the pre-2.7 policy store location used on RHEL 7
+SELinuxPolicyStorePaths = ['/etc/selinux/config', '/etc/selinux/*/policy', '/etc/selinux/*/modules/active',
+                           '/var/lib/selinux/*', '/var/lib/selinux/*/active']
+SELinuxPolicyCache = None
+# Package databases whose modification invalidates the cached package inventory
+PackageDatabasePaths = {'dpkg' : ['/var/lib/dpkg/status'],
+                        'rpm' : ['/var/lib/rpm/rpmdb.sqlite', '/var/lib/rpm/Packages', '/var/lib/rpm/Packages.db',
+                                 '/usr/lib/sysimage/rpm/rpmdb.sqlite', '/usr/lib/sysimage/rpm/Packages',
+                                 '/usr/lib/sysimage/rpm/Packages.db']}
+# Each line is '<state>\t<name>\t<package id as printed by dpkg-query/rpm -q>'
+PackageInventoryCommands = {'dpkg' : "dpkg-query -W -f='${db:Status-Abbrev}\t${Package}\t${Package}_${Version}\n' 2>/dev/null",
+                            'rpm' : "rpm -qa --qf 'ii\t%{NAME}\t%{NAME}-%{VERSION}-%{RELEASE}.%{ARCH}\n'"}
+PackageInventoryCache = None
+# Files parsed to detect the distro, and the cache of the detected distro in the extension directory
+DistroDetectionFiles = ['/etc/os-release', '/etc/system-release', '/etc/SuSE-release', '/etc/redhat-release',
+                        '/etc/lsb-release', '/etc/debian_version']
+DistroCacheFile = 'distro.cache.json'
+DistroCache = None
+SupportedDistroIndex = {}
 
 # Error codes
 GenericErrorCode = 1
@@ -155,6 +212,11 @@ HUtilObject = None
 SettingsSequenceNumber = None
 HandlerEnvironment = None
 SettingsDict = None
+SettingsFilePattern = re.compile(r'^([0-9]{1,10})\.settings$')
+# Decrypted protectedSettings are shared between the handler processes in this tmpfs directory
+ProtectedSettingsCacheDir = '/run/azuremonitoragent-extension'
+ProtectedSettingsCacheObject = None
+OperationTimingsObject = None
 
 
 def main():
@@ -179,18 +241,17 @@ def main():
             operation = 'Enable'
         elif re.match('^([-/]*)(update)', option):
             operation = 'Update'
-        elif re.match('^([-/]*)(metrics)', option):
-            operation = 'Metrics'
-        elif re.match('^([-/]*)(syslogconfig)', option):
-            operation = 'Syslogconfig'
-        elif re.match('^([-/]*)(transformconfig)', option):
-            operation = 'Transformconfig'
+        elif re.match('^([-/]*)(configwatcher)', option):
+            operation = 'Configwatcher'
     except Exception as e:
         waagent_log_error(str(e))
 
     if operation is None:
         log_and_exit('Unknown', GenericErrorCode, 'No valid operation provided')
 
+    global OperationTimingsObject
+    OperationTimingsObject = OperationTimings(operation)
+
     # Set up for exit code and any error messages
     exit_code = 0
     message = '{0} succeeded'.format(operation)
@@ -207,8 +268,10 @@ def main():
     # Invoke operation
     try:
         global HUtilObject
-        HUtilObject = parse_context(operation)
-        exit_code, output = operations[operation]()
+        with timing_span('parse context', flush = True):
+            HUtilObject = parse_context(operation)
+        with timing_span(operation, flush = True):
+            exit_code, output = operations[operation]()
 
         # Exit code 1 indicates a general problem that doesn't have a more
         # specific error code; it often indicates a missing dependency
@@ -324,23 +387,317 @@ def check_kill_process(pstring):
         pid = fields[0]
         os.kill(int(pid), signal.SIGKILL)
 
-def compare_and_copy_bin(src, dest):
-    # Check if previous file exist at the location, compare the two binaries,
-    # If the files are not same, remove the older file, and copy the new one
-    # If they are the same, then we ignore it and don't copy
-    if os.path.isfile(src ):
-        if os.path.isfile(dest):
-            if not filecmp.cmp(src, dest):
-                # Removing the file in case it is already being run in a process,
-                # in which case we can get an error "text file busy" while copying
-                os.remove(dest)
-                copyfile(src, dest)
+def get_file_sha256(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def get_file_stat_key(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime, st.st_ino]
+
+class BinaryManifest(object):
+    """
+    Content hashes of the staged binaries and of their sources, each recorded
+    with the size, mtime and inode of the file it was computed from. A file
+    is only read and hashed again when its stat no longer matches.
+    """
+    def __init__(self, path = None):
+        self.path = path if path is not None else BinaryManifestPath
+        self.lock = Lock()
+        self.entries = {}
+        try:
+            with open(self.path, 'r') as f:
+                self.entries = json.load(f)
+        except (IOError, OSError, ValueError):
+            self.entries = {}
+
+    def get_sha256(self, path):
+        stat_key = get_file_stat_key(path)
+        with self.lock:
+            entry = self.entries.get(path)
+        if entry and entry['stat'] == stat_key:
+            return entry['sha256']
+        sha = get_file_sha256(path)
+        self.record(path, sha)
+        return sha
+
+    def record(self, path, sha):
+        with self.lock:
+            self.entries[path] = {'sha256' : sha, 'stat' : get_file_stat_key(path)}
+
+    def save(self):
+        with self.lock:
+            entries = dict((path, entry) for path, entry in self.entries.items() if os.path.exists(path))
+        try:
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(entries, f)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError) as e:
+            hutil_log_info('Failed to save binary manifest {0}: {1}'.format(self.path, e))
+
+def compare_and_copy_bin(src, dest, manifest = None):
+    """
+    Copy src to dest unless dest already has the same content, as recorded in
+    the binary manifest. The copy is written next to dest and renamed over it,
+    so a process running the previous binary keeps it and never sees a
+    partially written file.
+    """
+    if not os.path.isfile(src):
+        return
+    save_manifest = manifest is None
+    if manifest is None:
+        manifest = BinaryManifest()
+
+    src_sha = manifest.get_sha256(src)
+    if not os.path.isfile(dest) or manifest.get_sha256(dest) != src_sha:
+        tmp_dest = dest + '.tmp'
+        copyfile(src, tmp_dest)
+        os.chmod(tmp_dest, BinaryMode)
+        os.rename(tmp_dest, dest)
+        manifest.record(dest, src_sha)
+    else:
+        os.chmod(dest, BinaryMode)
+
+    if save_manifest:
+        manifest.save()
+
+def run_in_parallel(func, items, max_workers = MaxBinaryStagingWorkers):
+    """
+    Call func on each item from at most max_workers threads.
+    Returns the results in the order of items; an exception raised for one
+    item is re-raised once all items were processed.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    errors = []
+    pending = list(range(len(items)))
+    lock = Lock()
 
+    def worker():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                index = pending.pop(0)
+            try:
+                results[index] = func(items[index])
+            except Exception as e:
+                with lock:
+                    errors.append(e)
+
+    threads = [Thread(target = worker) for _ in range(min(max_workers, len(items)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return results
+
+def stage_binaries(binaries):
+    """
+    Copy a list of (src, dest) binaries concurrently, skipping those whose
+    content is already in place, and update the binary manifest
+    """
+    manifest = BinaryManifest()
+    try:
+        with timing_span('stage binaries'):
+            run_in_parallel(lambda binary: compare_and_copy_bin(binary[0], binary[1], manifest), binaries)
+    finally:
+        manifest.save()
+
+def read_elf_dynamic_info(path):
+    """
+    Read the ELF class, machine, DT_NEEDED libraries, DT_RPATH and DT_RUNPATH
+    entries of a binary directly from its program headers and dynamic section.
+    Returns None if the file is not an ELF file.
+    """
+    with open(path, 'rb') as f:
+        ident = f.read(16)
+        if len(ident) < 16 or ident[:4] != b'\x7fELF':
+            return None
+        is_64 = ident[4:5] == b'\x02'
+        endian = '<' if ident[5:6] == b'\x01' else '>'
+        if is_64:
+            header_format = endian + 'HHIQQQIHHHHHH'
+            phdr_format = endian + 'IIQQQQQQ'
+            dyn_format = endian + 'qQ'
         else:
-            # No previous binary exist, simply copy it and make it executable
-            copyfile(src, dest)
-        
-        os.chmod(dest, stat.S_IXGRP | stat.S_IRGRP | stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR | stat.S_IXOTH | stat.S_IROTH)
+            header_format = endian + 'HHIIIIIHHHHHH'
+            phdr_format = endian + 'IIIIIIII'
+            dyn_format = endian + 'iI'
+        header = struct.unpack(header_format, f.read(struct.calcsize(header_format)))
+        machine, phoff, phentsize, phnum = header[1], header[4], header[8], header[9]
+
+        loads = []
+        dynamic = None
+        for i in range(phnum):
+            f.seek(phoff + i * phentsize)
+            phdr = struct.unpack(phdr_format, f.read(struct.calcsize(phdr_format)))
+            if is_64:
+                p_type, p_offset, p_vaddr, p_filesz = phdr[0], phdr[2], phdr[3], phdr[5]
+            else:
+                p_type, p_offset, p_vaddr, p_filesz = phdr[0], phdr[1], phdr[2], phdr[4]
+            if p_type == 1:     # PT_LOAD
+                loads.append((p_vaddr, p_offset, p_filesz))
+            elif p_type == 2:   # PT_DYNAMIC
+                dynamic = (p_offset, p_filesz)
+
+        info = {'is_64' : is_64, 'machine' : machine, 'needed' : [], 'rpath' : [], 'runpath' : []}
+        if dynamic is None:
+            return info
+
+        f.seek(dynamic[0])
+        data = f.read(dynamic[1])
+        entry_size = struct.calcsize(dyn_format)
+        entries = []
+        strtab = None
+        for offset in range(0, len(data) - entry_size + 1, entry_size):
+            tag, value = struct.unpack_from(dyn_format, data, offset)
+            if tag == 0:        # DT_NULL
+                break
+            if tag == 5:        # DT_STRTAB
+                strtab = value
+            entries.append((tag, value))
+
+        strtab_offset = None
+        for vaddr, offset, filesz in loads:
+            if strtab is not None and vaddr <= strtab < vaddr + filesz:
+                strtab_offset = strtab - vaddr + offset
+        if strtab_offset is None:
+            return info
+
+        def read_string(index):
+            f.seek(strtab_offset + index)
+            chunks = []
+            while True:
+                chunk = f.read(256)
+                if not chunk:
+                    break
+                end = chunk.find(b'\0')
+                if end >= 0:
+                    chunks.append(chunk[:end])
+                    break
+                chunks.append(chunk)
+            return b''.join(chunks).decode('utf-8', 'replace')
+
+        for tag, value in entries:
+            if tag == 1:                # DT_NEEDED
+                info['needed'].append(read_string(value))
+            elif tag == 15:             # DT_RPATH
+                info['rpath'].extend(p for p in read_string(value).split(':') if p)
+            elif tag == 29:             # DT_RUNPATH
+                info['runpath'].extend(p for p in read_string(value).split(':') if p)
+        return info
+
+def get_ld_so_cache_dirs(ld_so_cache = '/etc/ld.so.cache'):
+    """
+    Return the directories of the libraries listed in ld.so.cache, which may
+    have been built from other configuration than the current ld.so.conf
+    """
+    dirs = []
+    try:
+        with open(ld_so_cache, 'rb') as f:
+            data = f.read()
+    except IOError:
+        return dirs
+    # The string table of both cache formats holds the absolute library paths
+    for match in re.finditer(br'/[^\x00]*\.so[^\x00/]*(?=\x00)', data):
+        directory = os.path.dirname(match.group(0).decode('utf-8', 'replace'))
+        if directory not in dirs:
+            dirs.append(directory)
+    return dirs
+
+def get_library_search_dirs(ld_so_conf = '/etc/ld.so.conf', ld_so_cache = '/etc/ld.so.cache'):
+    """
+    Return the library directories configured in ld.so.conf (following its
+    include directives) and those of ld.so.cache, followed by the default
+    system library directories
+    """
+    dirs = []
+    conf_files = [ld_so_conf]
+    while conf_files:
+        conf_file = conf_files.pop(0)
+        try:
+            with open(conf_file, 'r') as f:
+                lines = f.readlines()
+        except IOError:
+            continue
+        for line in lines:
+            line = line.split('#', 1)[0].strip()
+            if line.startswith('include'):
+                pattern = line.split(None, 1)[1] if len(line.split(None, 1)) > 1 else ''
+                if pattern and not os.path.isabs(pattern):
+                    pattern = os.path.join(os.path.dirname(conf_file), pattern)
+                conf_files.extend(sorted(glob.glob(pattern)))
+            elif line and line not in dirs:
+                dirs.append(line)
+    for directory in get_ld_so_cache_dirs(ld_so_cache):
+        if directory not in dirs:
+            dirs.append(directory)
+    for directory in ['/lib64', '/usr/lib64', '/lib', '/usr/lib']:
+        if directory not in dirs:
+            dirs.append(directory)
+    return dirs
+
+def find_missing_elf_dependencies(path, origin = None, search_dirs = None):
+    """
+    Return the shared libraries, including indirect dependencies, that path
+    needs and that the dynamic loader would not find, without running ldd.
+    origin is the directory $ORIGIN in the binary's rpath refers to; it
+    defaults to the directory of path. Like the loader, an object without
+    DT_RUNPATH is searched in its own DT_RPATH and then in the DT_RPATH of
+    the objects that loaded it, up to the executable.
+    """
+    if search_dirs is None:
+        search_dirs = get_library_search_dirs()
+    if origin is None:
+        origin = os.path.dirname(os.path.abspath(path))
+
+    root = read_elf_dynamic_info(path)
+    if root is None:
+        return []
+
+    missing = []
+    resolved = set()
+    queue = [(root, origin, [])]
+    while queue:
+        info, info_origin, loader_rpath = queue.pop(0)
+        def expand(paths):
+            return [p.replace('$ORIGIN', info_origin).replace('${ORIGIN}', info_origin) for p in paths]
+        if info['runpath']:
+            # DT_RUNPATH disables DT_RPATH, both the object's own and the inherited one
+            rpath = expand(info['runpath'])
+            dependency_rpath = []
+        else:
+            rpath = expand(info['rpath']) + loader_rpath
+            dependency_rpath = rpath
+        for library in info['needed']:
+            if library in resolved or library in missing:
+                continue
+            found = None
+            for directory in rpath + search_dirs:
+                candidate = os.path.join(directory, library)
+                if not os.path.isfile(candidate):
+                    continue
+                try:
+                    candidate_info = read_elf_dynamic_info(candidate)
+                except (IOError, struct.error):
+                    continue
+                # Skip libraries built for another architecture, e.g. 32-bit ones in /usr/lib
+                if candidate_info and candidate_info['is_64'] == root['is_64'] and candidate_info['machine'] == root['machine']:
+                    found = (candidate_info, os.path.dirname(candidate), dependency_rpath)
+                    break
+            if found is None:
+                missing.append(library)
+            else:
+                resolved.add(library)
+                queue.append(found)
+    return missing
 
 def set_metrics_binaries():
     current_arch = platform.machine()
@@ -358,26 +715,28 @@ def set_metrics_binaries():
 
 def copy_amacoreagent_binaries():
     current_arch = platform.machine()
+    binaries = []
     amacoreagent_bin_local_path = os.getcwd() + "/amaCoreAgentBin/amacoreagent_" + current_arch
     amacoreagent_bin = "/opt/microsoft/azuremonitoragent/bin/amacoreagent"
-    compare_and_copy_bin(amacoreagent_bin_local_path, amacoreagent_bin)
+    binaries.append((amacoreagent_bin_local_path, amacoreagent_bin))
 
     if current_arch == 'x86_64':
         #libgrpc_bin_local_path = os.getcwd() + "/amaCoreAgentBin/libgrpc_csharp_ext.x64.so"
         #libgrpc_bin = "/opt/microsoft/azuremonitoragent/bin/libgrpc_csharp_ext.x64.so"
-        #compare_and_copy_bin(libgrpc_bin_local_path, libgrpc_bin)
+        #binaries.append((libgrpc_bin_local_path, libgrpc_bin))
 
         liblz4x64_bin_local_path = os.getcwd() + "/amaCoreAgentBin/liblz4x64.so"
         liblz4x64_bin = "/opt/microsoft/azuremonitoragent/bin/liblz4x64.so"
-        compare_and_copy_bin(liblz4x64_bin_local_path, liblz4x64_bin)   
+        binaries.append((liblz4x64_bin_local_path, liblz4x64_bin))
     #elif current_arch == 'aarch64':
         #libgrpc_bin_local_path = os.getcwd() + "/amaCoreAgentBin/libgrpc_csharp_ext.arm64.so"
         #libgrpc_bin = "/opt/microsoft/azuremonitoragent/bin/libgrpc_csharp_ext.arm64.so"
-        #compare_and_copy_bin(libgrpc_bin_local_path, libgrpc_bin)
-                  
+        #binaries.append((libgrpc_bin_local_path, libgrpc_bin))
+
     agentlauncher_bin_local_path = os.getcwd() + "/agentLauncherBin/agentlauncher_" + current_arch
     agentlauncher_bin = "/opt/microsoft/azuremonitoragent/bin/agentlauncher"
-    compare_and_copy_bin(agentlauncher_bin_local_path, agentlauncher_bin)
+    binaries.append((agentlauncher_bin_local_path, agentlauncher_bin))
+    stage_binaries(binaries)
 
 def copy_mdsd_fluentbit_binaries():
     current_arch = platform.machine()
@@ -388,50 +747,106 @@ def copy_mdsd_fluentbit_binaries():
     mdsdmgr_bin = "/opt/microsoft/azuremonitoragent/bin/mdsdmgr"
     fluentbit_bin = "/opt/microsoft/azuremonitoragent/bin/fluent-bit"
 
-    # copy the required libs to our test directory first
-    lib_dir = os.path.join(os.getcwd(), "lib")
-    if os.path.exists(lib_dir):
-        rmtree(lib_dir)
+    # The binaries are checked as if they were in place already, so that their
+    # $ORIGIN relative rpath resolves to the shared libs of the installed package
+    search_dirs = get_library_search_dirs()
+    def can_use_shared(path):
+        if not os.path.isfile(path):
+            return False
+        missing = find_missing_elf_dependencies(path, origin=os.path.dirname(mdsd_bin), search_dirs=search_dirs)
+        if not missing:
+            return True
+        # Confirm with ldd before keeping the old binaries, the loader may know paths the parser does not
+        hutil_log_info('{0} may not find the shared libraries {1}, checking with ldd'.format(path, ', '.join(missing)))
+        exit_code, _ = run_command_and_log('ldd ' + path + ' | grep "not found"')
+        if exit_code == 0:
+            hutil_log_info('{0} cannot use the shared libraries'.format(path))
+        return exit_code != 0
 
-    if sys.version_info >= (3, 8):
-        # dirs_exist_ok parameter was added in Python 3.8
-        copytree("/opt/microsoft/azuremonitoragent/lib", lib_dir, dirs_exist_ok=True)
-    else:
-        copytree("/opt/microsoft/azuremonitoragent/lib", lib_dir)
-    
-    canUseSharedmdsd, _ = run_command_and_log('ldd ' + mdsd_bin_local_path + ' | grep "not found"')
-    canUseSharedmdsdmgr, _ = run_command_and_log('ldd ' + mdsdmgr_bin_local_path + ' | grep "not found"')
-    if canUseSharedmdsd != 0 and canUseSharedmdsdmgr != 0:        
-        compare_and_copy_bin(mdsd_bin_local_path, mdsd_bin)
-        compare_and_copy_bin(mdsdmgr_bin_local_path, mdsdmgr_bin)
+    canUseSharedmdsd, canUseSharedmdsdmgr, canUseSharedfluentbit = run_in_parallel(can_use_shared,
+        [mdsd_bin_local_path, mdsdmgr_bin_local_path, fluentbit_bin_local_path])
+
+    binaries = []
+    if canUseSharedmdsd and canUseSharedmdsdmgr:
+        binaries.append((mdsd_bin_local_path, mdsd_bin))
+        binaries.append((mdsdmgr_bin_local_path, mdsdmgr_bin))
+
+    if canUseSharedfluentbit:
+        binaries.append((fluentbit_bin_local_path, fluentbit_bin))
+    stage_binaries(binaries)
+
+def get_package_database_key():
+    """
+    Return the stat of the package database files of the current package
+    manager. Installing or removing a package rewrites the database, so a
+    change of this key invalidates the cached package inventory.
+    """
+    key = []
+    for path in PackageDatabasePaths.get(PackageManager, []):
+        try:
+            key.append((path, get_file_stat_key(path)))
+        except OSError:
+            pass
+    return (PackageManager, tuple(key))
+
+def parse_package_inventory(output):
+    """
+    Parse the output of a PackageInventoryCommands query into a dictionary of
+    package name -> list of installed package ids.
+    dpkg packages that are only known to the database but not installed are skipped.
+    """
+    packages = {}
+    for line in output.splitlines():
+        fields = line.split('\t')
+        if len(fields) != 3 or len(fields[0]) < 2 or fields[0][1] == 'n':
+            continue
+        packages.setdefault(fields[1], []).append(fields[2])
+    return packages
+
+def get_package_inventory():
+    """
+    Return the installed packages, querying the package manager for all of
+    them at once only when the package database changed since the last query
+    """
+    global PackageInventoryCache
 
-    canUseSharedfluentbit, _ = run_command_and_log('ldd ' + fluentbit_bin_local_path + ' | grep "not found"')
-    if canUseSharedfluentbit != 0:
-        compare_and_copy_bin(fluentbit_bin_local_path, fluentbit_bin)
+    if PackageManager not in PackageInventoryCommands:
+        return None
+    key = get_package_database_key()
+    if PackageInventoryCache is None or PackageInventoryCache['key'] != key:
+        exit_code, output = run_command_and_log(PackageInventoryCommands[PackageManager], check_error=False, log_output=False)
+        if exit_code != 0 or not output:
+            hutil_log_error("Could not query installed packages, exit code {0}".format(exit_code))
+            return None
+        PackageInventoryCache = {'key' : key, 'packages' : parse_package_inventory(output)}
+    return PackageInventoryCache['packages']
 
-    rmtree(os.getcwd() + "/lib")    
+def is_package_installed(name):
+    packages = get_package_inventory()
+    return packages is not None and name in packages
 
 def get_installed_package_version():
     """
     Returns if Azure Monitor Agent is installed and a list of installed version of the Azure Monitor Agent package.
     Returns: (is_installed, version_list)
     """
-    if PackageManager == "dpkg":
-        # In the case of dpkg, we specify only Package and Version as architecture is written as amd64/arm64 instead of x86_64/aarch64.
-        cmd = "dpkg-query -W -f='${Package}_${Version}\n' 'azuremonitoragent*' 2>/dev/null"
-    elif PackageManager == "rpm":
-        cmd = "rpm -q azuremonitoragent"
-    else:
+    if PackageManager != "dpkg" and PackageManager != "rpm":
         hutil_log_error("Could not determine package manager.")
         return False, []
 
-    exit_code, output = run_command_and_log(cmd, check_error=False)
-
-    if exit_code != 0 or not output:
-        hutil_log_info("Azure Monitor Agent package not found after running {0}.".format(cmd))
+    packages = get_package_inventory()
+    version_list = []
+    if packages is not None:
+        # In the case of dpkg, the ids are Package_Version as architecture is written as amd64/arm64 instead of x86_64/aarch64.
+        # dpkg also reports packages matching 'azuremonitoragent*', like the previous dpkg-query did.
+        for name in sorted(packages):
+            if name == 'azuremonitoragent' or (PackageManager == "dpkg" and name.startswith('azuremonitoragent')):
+                version_list.extend(packages[name])
+
+    if not version_list:
+        hutil_log_info("Azure Monitor Agent package not found in the {0} package database.".format(PackageManager))
         return False, []
 
-    version_list = output.strip().split('\n')
     return True, version_list
 
 def get_current_bundle_file():
@@ -456,8 +871,7 @@ def install():
 
     # Check if Debian 12 and 13 VMs have rsyslog package (required for AMA 1.31+)
     if (vm_dist.startswith('debian')) and ((vm_ver.startswith('12') or vm_ver.startswith('13')) or int(vm_ver.split('.')[0]) >= 12):
-        check_rsyslog, _ = run_command_and_log("dpkg -s rsyslog")
-        if check_rsyslog != 0:
+        if not is_package_installed('rsyslog'):
             hutil_log_info("'rsyslog' package missing from Debian {0} machine, installing to allow AMA to run.".format(vm_ver))
             rsyslog_exit_code, rsyslog_output = run_command_and_log("DEBIAN_FRONTEND=noninteractive apt-get update && \
                                                                     DEBIAN_FRONTEND=noninteractive apt-get install -y rsyslog")
@@ -466,8 +880,7 @@ def install():
     
     # Check if Amazon 2023 VMs have rsyslog package (required for AMA 1.31+)
     if (vm_dist.startswith('amzn')) and vm_ver.startswith('2023'):
-        check_rsyslog, _ = run_command_and_log("dnf list installed | grep rsyslog.x86_64")
-        if check_rsyslog != 0:
+        if not is_package_installed('rsyslog'):
             hutil_log_info("'rsyslog' package missing from Amazon Linux 2023 machine, installing to allow AMA to run.")
             rsyslog_exit_code, rsyslog_output = run_command_and_log("dnf install -y rsyslog")
             if rsyslog_exit_code != 0:
@@ -475,8 +888,7 @@ def install():
     
     # Check if Azure Linux 4+ VMs have rsyslog package (Azure Linux 4 ships journald-only, no rsyslog by default)
     if (vm_dist.startswith('azurelinux')) and int(vm_ver.split('.')[0]) >= 4:
-        check_rsyslog, _ = run_command_and_log("rpm -q rsyslog")
-        if check_rsyslog != 0:
+        if not is_package_installed('rsyslog'):
             hutil_log_info("'rsyslog' package missing from Azure Linux {0} machine, installing to allow AMA to run.".format(vm_ver))
             rsyslog_exit_code, rsyslog_output = run_command_and_log("dnf install -y rsyslog")
             if rsyslog_exit_code != 0:
@@ -484,8 +896,7 @@ def install():
     
     # Check if SLES 16+ VMs have 'which' package (changed from Requires to Recommends in spec, may not be installed)
     if (vm_dist.startswith('suse') or vm_dist.startswith('sles')) and int(vm_ver.split('.')[0]) >= 16:
-        check_which, _ = run_command_and_log("rpm -q which")
-        if check_which != 0:
+        if not is_package_installed('which'):
             hutil_log_info("'which' package missing from SLES {0} machine, creating 'which' alias using 'command -v'.".format(vm_ver))
             try:
                 # Note: command -v also reports shell built-ins (e.g. echo, cd) unlike which,
@@ -567,6 +978,9 @@ def install():
         if exit_code != 0:
             return exit_code, output
 
+    # Record the installed files, so that uninstall does not depend on the package database
+    record_package_files()
+
     # Copy the AMACoreAgent and agentlauncher binaries
     copy_amacoreagent_binaries()
 
@@ -618,6 +1032,11 @@ def uninstall():
     exit_if_vm_not_supported('Uninstall')
     find_package_manager("Uninstall")
 
+    # Finish the file cleanup of an uninstall that was interrupted, e.g. by the waagent timeout
+    resume_package_files_cleanup()
+
+    clear_protected_settings_cache()
+
     # Before we uninstall, we need to ensure AMA is installed to begin with
     is_installed, installed_versions = get_installed_package_version()
     if not is_installed:
@@ -777,16 +1196,10 @@ def force_uninstall_azure_monitor_agent():
         hutil_log_info("Azure Monitor Agent has been uninstalled.")
         return 0, "Azure Monitor Agent has been uninstalled."
       
-def _get_package_files_for_cleanup():
+def _query_package_files():
     """
-    Get the list of files and directories installed by the provided
-    azuremonitoragent spec that should be removed during uninstall.
-    This must be called BEFORE the package is uninstalled to ensure the package
-    manager still has the file list available.
-    
-    Returns:
-        tuple: (files_list, directories_to_add) where files_list contains package files
-               and directories_to_add contains directories that need explicit cleanup
+    Query the package manager for the azuremonitor files and directories
+    installed by the azuremonitoragent package.
     """
     try:
         # Get list of files installed by the package
@@ -800,7 +1213,7 @@ def _get_package_files_for_cleanup():
             hutil_log_info("Unknown package manager, cannot list package files")
             return []
 
-        exit_code, output = run_command_and_log(cmd, check_error=False)
+        exit_code, output = run_command_and_log(cmd, check_error=False, log_output=False)
         
         if exit_code != 0 or not output:
             hutil_log_info("Could not get package file list for cleanup")
@@ -826,6 +1239,164 @@ def _get_package_files_for_cleanup():
         hutil_log_error("Error gathering package files for cleanup: {0}\n Is Azure Monitor Agent Installed?".format(ex))
         return []
 
+def _write_json_file(path, data):
+    state_dir = os.path.dirname(path)
+    if not os.path.exists(state_dir):
+        os.makedirs(state_dir)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.rename(tmp_path, path)
+
+def _read_json_file(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+def record_package_files():
+    """
+    Record the files installed by the azuremonitoragent package in the
+    package files manifest used by uninstall
+    """
+    package_files = _query_package_files()
+    if not package_files:
+        return
+    try:
+        _write_json_file(PackageFilesManifestPath, {'files' : package_files})
+        hutil_log_info("Recorded {0} package files in {1}".format(len(package_files), PackageFilesManifestPath))
+    except Exception as ex:
+        hutil_log_error("Failed to record package files in {0}: {1}".format(PackageFilesManifestPath, ex))
+
+def _get_package_files_for_cleanup():
+    """
+    Get the list of files and directories installed by the provided
+    azuremonitoragent spec that should be removed during uninstall.
+    The list recorded at install time is used if present, otherwise the
+    package manager is queried. This must be called BEFORE the package is
+    uninstalled to ensure the package manager still has the file list available.
+    
+    Returns:
+        list: azuremonitor paths installed by the package
+    """
+    manifest = _read_json_file(PackageFilesManifestPath)
+    if isinstance(manifest, dict) and manifest.get('files'):
+        hutil_log_info("Using package file list recorded in {0}".format(PackageFilesManifestPath))
+        return manifest['files']
+    return _query_package_files()
+
+def _collapse_cleanup_paths(paths):
+    """
+    Return the paths to remove without those inside another path to remove,
+    as removing the enclosing directory tree removes them as well
+    """
+    paths = set(p.rstrip('/') or '/' for p in paths)
+    collapsed = []
+    for path in sorted(paths):
+        parent = os.path.dirname(path)
+        while parent not in paths and parent != os.path.dirname(parent):
+            parent = os.path.dirname(parent)
+        if parent not in paths or parent == path:
+            collapsed.append(path)
+    return collapsed
+
+def _remove_path_tree(path):
+    """
+    Remove a file or a directory tree bottom-up, without following symlinks.
+    Returns (items removed, bytes freed); failures are logged and skipped.
+    """
+    removed = freed = 0
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return removed, freed
+
+    if not stat.S_ISDIR(st.st_mode):
+        entries = [(path, st)]
+    else:
+        entries = []
+        for root, dirs, files in os.walk(path, topdown=False):
+            for name in files + dirs:
+                entry_path = os.path.join(root, name)
+                try:
+                    entries.append((entry_path, os.lstat(entry_path)))
+                except OSError:
+                    pass
+        entries.append((path, st))
+
+    for entry_path, entry_st in entries:
+        try:
+            if stat.S_ISDIR(entry_st.st_mode):
+                os.rmdir(entry_path)
+            else:
+                os.remove(entry_path)
+                if stat.S_ISREG(entry_st.st_mode):
+                    freed += entry_st.st_size
+            removed += 1
+        except OSError as ex:
+            hutil_log_info("Failed to remove {0}: {1}".format(entry_path, ex))
+    return removed, freed
+
+def _remove_cleanup_paths(cleanup_paths):
+    """
+    Remove the given files and directory trees, recording them in the cleanup
+    journal first so that an interrupted cleanup is finished by the next uninstall.
+    The entries of the directories are removed from up to MaxCleanupWorkers
+    threads, so that one large log or spool directory does not serialize the cleanup.
+    """
+    start_time = time.time()
+    cleanup_paths = _collapse_cleanup_paths(cleanup_paths)
+    try:
+        _write_json_file(PackageCleanupJournalPath, {'paths' : cleanup_paths})
+    except Exception as ex:
+        hutil_log_info("Failed to write cleanup journal {0}: {1}".format(PackageCleanupJournalPath, ex))
+
+    hutil_log_info("Removing {0} azuremonitor paths".format(len(cleanup_paths)))
+
+    work_items = []
+    directories = []
+    for path in cleanup_paths:
+        if os.path.isdir(path) and not os.path.islink(path):
+            try:
+                work_items.extend(os.path.join(path, name) for name in os.listdir(path))
+                directories.append(path)
+                continue
+            except OSError as ex:
+                hutil_log_info("Failed to list {0}: {1}".format(path, ex))
+        work_items.append(path)
+
+    results = run_in_parallel(_remove_path_tree, work_items, MaxCleanupWorkers)
+    items_removed = sum(removed for removed, _ in results)
+    bytes_freed = sum(freed for _, freed in results)
+
+    for path in directories:
+        removed, freed = _remove_path_tree(path)
+        items_removed += removed
+        bytes_freed += freed
+        if not os.path.exists(path):
+            hutil_log_info("Removed directory: {0}".format(path))
+
+    try:
+        os.remove(PackageCleanupJournalPath)
+    except OSError:
+        pass
+
+    hutil_log_info("Removed {0} items total, freed {1} bytes in {2:.2f} seconds".format(items_removed, bytes_freed, time.time() - start_time))
+    return items_removed, bytes_freed
+
+def resume_package_files_cleanup():
+    """
+    Finish removing the paths of an uninstall cleanup that was interrupted
+    """
+    journal = _read_json_file(PackageCleanupJournalPath)
+    if isinstance(journal, dict) and journal.get('paths'):
+        hutil_log_info("Resuming interrupted cleanup of {0} azuremonitor paths".format(len(journal['paths'])))
+        try:
+            _remove_cleanup_paths(journal['paths'])
+        except Exception as ex:
+            hutil_log_error("Error while resuming cleanup: {0}".format(ex))
+
 def _remove_package_files_from_list(package_files):
     """
     Remove all files and directories from the provided list that were installed 
@@ -842,7 +1413,7 @@ def _remove_package_files_from_list(package_files):
             return
             
         # Build consolidated list of paths to clean up
-        cleanup_paths = set(package_files) if package_files else set()
+        cleanup_paths = set(package_files)
         
         # Add directories that need explicit cleanup since on rpm systems 
         # the initial list for this path does not remove the directories and files
@@ -856,26 +1427,11 @@ def _remove_package_files_from_list(package_files):
             hutil_log_info("Complete uninstall context - removing everything")
             cleanup_paths.add(AmaDataPath)
 
-        # Sort paths by depth (deepest first) to avoid removing parent before children
-        sorted_paths = sorted(cleanup_paths, key=lambda x: x.count('/'), reverse=True)
-        
-        hutil_log_info("Removing {0} azuremonitor paths".format(len(sorted_paths)))
-        
-        items_removed = 0
-        for item_path in sorted_paths:
-            try:
-                if os.path.exists(item_path):
-                    if os.path.isdir(item_path):
-                        rmtree(item_path)
-                        hutil_log_info("Removed directory: {0}".format(item_path))
-                    else:
-                        os.remove(item_path)
-                        hutil_log_info("Removed file: {0}".format(item_path))
-                    items_removed += 1
-            except Exception as ex:
-                hutil_log_info("Failed to remove {0}: {1}".format(item_path, ex))
-        
-        hutil_log_info("Removed {0} items total".format(items_removed))
+        _remove_cleanup_paths(cleanup_paths)
+
+        # The package files are gone, so the install time list is stale
+        if os.path.exists(PackageFilesManifestPath):
+            os.remove(PackageFilesManifestPath)
         
     except Exception as ex:
         hutil_log_error("Error during file removal from list: {0}\n Were these files removed already?".format(ex))
@@ -1006,9 +1562,8 @@ def enable():
         ensure["azuremonitor-agentlauncher"] = True
         ensure["azuremonitor-coreagent"] = True
             
-        # start the metrics, agent transform and syslog watchers only in 3P mode
-        start_metrics_process()
-        start_syslogconfig_process()
+        # start the metrics, agent transform and syslog config watcher only in 3P mode
+        start_config_watcher_process()
     elif ensure.get("azuremonitoragentmgr") or is_gcs_single_tenant:
         # In GCS scenarios, ensure that AMACoreAgent is running
         ensure["azuremonitor-coreagent"] = True
@@ -1048,8 +1603,6 @@ def enable():
             # start/enable ast extension only in 3P mode and non aarch64
             _, ast_output = run_command_and_log(get_service_command("azuremonitor-astextension", *operations))
             output += ast_output # do not block if ast start fails
-            # start transformation config watcher process
-            start_transformconfig_process()
 
     # Service(s) were successfully configured and started; increment sequence number
     HUtilObject.save_seq()
@@ -1186,15 +1739,16 @@ def handle_mcs_config(public_settings, protected_settings, default_configs):
     # fetch proxy settings
     proxy_mode = get_proxy_mode(public_settings)
 
-    if apply_arc_proxy(default_configs):
-        pass  # Arc proxy takes precedence over extension settings
-    elif proxy_mode == "none":
-        default_configs["MDSD_PROXY_MODE"] = "none"
-        unset_proxy()
-    elif proxy_mode == "application":
-        apply_application_proxy(public_settings, protected_settings, default_configs)
-    else:
-        unset_proxy()
+    with timing_span('proxy setup'):
+        if apply_arc_proxy(default_configs):
+            pass  # Arc proxy takes precedence over extension settings
+        elif proxy_mode == "none":
+            default_configs["MDSD_PROXY_MODE"] = "none"
+            unset_proxy()
+        elif proxy_mode == "application":
+            apply_application_proxy(public_settings, protected_settings, default_configs)
+        else:
+            unset_proxy()
 
     # set arc autonomous endpoints
     az_environment, _ = get_azure_environment_and_region()
@@ -1250,14 +1804,11 @@ def disable():
     Note: disable operation times out from WAAgent at 15 minutes
     """
 
-    #stop the metrics process
+    #stop the metrics services and the config watcher process
     stop_metrics_process()
 
-    #stop syslog config watcher process
-    stop_syslogconfig_process()
-
-    #stop agent transform config watcher process
-    stop_transformconfig_process()
+    # The watcher is stopped, nothing needs the decrypted settings anymore
+    clear_protected_settings_cache()
 
     # stop amacoreagent and agent launcher
     hutil_log_info('Handler initiating Core Agent and agent launcher')
@@ -1671,6 +2222,36 @@ def uninstall_azureotelcollector():
                 hutil_log_error('Error removing azureotelcollector "{0}"'.format(output))
 
 
+def get_watcher_pids(pid_file, option):
+    """
+    Return the pids listed in pid_file that still belong to an agent.py watcher
+    process started with the given command line option
+    """
+    pids = []
+    pids_filepath = os.path.join(os.getcwd(), pid_file)
+    if os.path.exists(pids_filepath):
+        with open(pids_filepath, "r") as f:
+            for pid in f.readlines():
+                # Verify the pid actually belongs to the AMA watcher.
+                cmd_file = os.path.join("/proc", str(pid.strip("\n")), "cmdline")
+                if os.path.exists(cmd_file):
+                    with open(cmd_file, "r") as pidf:
+                        cmdline = pidf.readlines()
+                        if len(cmdline) > 0 and cmdline[0].find("agent.py") >= 0 and cmdline[0].find(option) >= 0:
+                            pids.append(pid)
+    return pids
+
+def kill_watcher_process(pid_file, option):
+    pids_filepath = os.path.join(os.getcwd(), pid_file)
+
+    # kill existing watcher
+    if os.path.exists(pids_filepath):
+        for pid in get_watcher_pids(pid_file, option):
+            kill_cmd = "kill " + pid
+            run_command_and_log(kill_cmd)
+
+        run_command_and_log("rm " + pids_filepath)
+
 def stop_metrics_process():
 
     if telhandler.is_running(is_lad=False):
@@ -1701,505 +2282,847 @@ def stop_metrics_process():
         else:
             hutil_log_error(me_rm_msg)
 
-    pids_filepath = os.path.join(os.getcwd(),'amametrics.pid')
-
-    # kill existing metrics watcher
-    if os.path.exists(pids_filepath):
-        with open(pids_filepath, "r") as f:
-            for pid in f.readlines():
-                # Verify the pid actually belongs to AMA metrics watcher.
-                cmd_file = os.path.join("/proc", str(pid.strip("\n")), "cmdline")
-                if os.path.exists(cmd_file):
-                    with open(cmd_file, "r") as pidf:
-                        cmdline = pidf.readlines()
-                        if len(cmdline) > 0 and cmdline[0].find("agent.py") >= 0 and cmdline[0].find("-metrics") >= 0:
-                            kill_cmd = "kill " + pid
-                            run_command_and_log(kill_cmd)
-
-        run_command_and_log("rm "+pids_filepath)
-
-def stop_syslogconfig_process():
-    
-    pids_filepath = os.path.join(os.getcwd(),'amasyslogconfig.pid')
-
-    # kill existing syslog config watcher
-    if os.path.exists(pids_filepath):
-        with open(pids_filepath, "r") as f:
-            for pid in f.readlines():
-                # Verify the pid actually belongs to AMA syslog watcher.
-                cmd_file = os.path.join("/proc", str(pid.strip("\n")), "cmdline")
-                if os.path.exists(cmd_file):
-                    with open(cmd_file, "r") as pidf:
-                        cmdline = pidf.readlines()
-                        if len(cmdline) > 0 and cmdline[0].find("agent.py") >= 0 and cmdline[0].find("-syslogconfig") >= 0:
-                            kill_cmd = "kill " + pid
-                            run_command_and_log(kill_cmd)
-
-        run_command_and_log("rm "+ pids_filepath)
-
-def is_metrics_process_running():
-    pids_filepath = os.path.join(os.getcwd(),'amametrics.pid')
-    if os.path.exists(pids_filepath):
-        with open(pids_filepath, "r") as f:
-            for pid in f.readlines():
-                # Verify the pid actually belongs to AMA metrics watcher.
-                cmd_file = os.path.join("/proc", str(pid.strip("\n")), "cmdline")
-                if os.path.exists(cmd_file):
-                    with open(cmd_file, "r") as pidf:
-                        cmdline = pidf.readlines()
-                        if len(cmdline) > 0 and cmdline[0].find("agent.py") >= 0 and cmdline[0].find("-metrics") >= 0:
-                            return True
-
-    return False
-
-def is_syslogconfig_process_running():
-    pids_filepath = os.path.join(os.getcwd(),'amasyslogconfig.pid')
-    if os.path.exists(pids_filepath):
-        with open(pids_filepath, "r") as f:
-            for pid in f.readlines():
-                # Verify the pid actually belongs to AMA syslog watcher.
-                cmd_file = os.path.join("/proc", str(pid.strip("\n")), "cmdline")
-                if os.path.exists(cmd_file):
-                    with open(cmd_file, "r") as pidf:
-                        cmdline = pidf.readlines()
-                        if len(cmdline) > 0 and cmdline[0].find("agent.py") >= 0 and cmdline[0].find("-syslogconfig") >= 0:
-                            return True
-
-    return False
+    stop_config_watcher_process()
 
-def is_transformconfig_process_running():
-    pids_filepath = os.path.join(os.getcwd(),'amatransformconfig.pid')
-    if os.path.exists(pids_filepath):
-        with open(pids_filepath, "r") as f:
-            for pid in f.readlines():
-                # Verify the pid actually belongs to AMA transform config watcher.
-                cmd_file = os.path.join("/proc", str(pid.strip("\n")), "cmdline")
-                if os.path.exists(cmd_file):
-                    with open(cmd_file, "r") as pidf:
-                        cmdline = pidf.readlines()
-                        if len(cmdline) > 0 and cmdline[0].find("agent.py") >= 0 and cmdline[0].find("-transformconfig") >= 0:
-                            return True
+def stop_config_watcher_process():
+    """
+    Stop the config watcher, along with any per-config watcher processes left
+    behind by an extension version that ran one process per config
+    """
+    kill_watcher_process(ConfigWatcherPidFile, '-configwatcher')
+    for pid_file, option in LegacyWatcherProcesses:
+        kill_watcher_process(pid_file, option)
 
-    return False
+def is_config_watcher_process_running():
+    return len(get_watcher_pids(ConfigWatcherPidFile, '-configwatcher')) > 0
 
-def start_metrics_process():
+def start_config_watcher_process():
     """
-    Start metrics process that performs periodic monitoring activities
+    Start the config watcher process that manages the lifecycle of telegraf and ME
+    and looks for metrics, syslog and agent transformation config changes
     :return: None
     """
 
-    # if metrics process is already running, it should manage lifecycle of telegraf, ME, 
+    # if the config watcher is already running, it should manage lifecycle of telegraf, ME,
     # process to refresh ME MSI token and look for new config changes if counters change, etc, so this is no-op
-    if not is_metrics_process_running():
+    if not is_config_watcher_process_running():
         stop_metrics_process()
 
-        # Start metrics watcher
+        # Start config watcher
         ama_path = os.path.join(os.getcwd(), 'agent.py')
-        args = [sys.executable, ama_path, '-metrics']
+        args = [sys.executable, ama_path, '-configwatcher']
         log = open(os.path.join(os.getcwd(), 'daemon.log'), 'w')
-        hutil_log_info('start watcher process '+str(args))
+        hutil_log_info('start config watcher process '+str(args))
         subprocess.Popen(args, stdout=log, stderr=log)
 
-def start_syslogconfig_process():
+class ConfigFileWatcher(object):
+    """
+    Watch a set of config files and report the ones whose content changed.
+    Change notifications come from inotify on the parent directories of the
+    files, so that files which are replaced through a rename or created later
+    are picked up as well. When inotify is not available, or a parent directory
+    does not exist yet, the files are polled instead. Either way a file is only
+    read and hashed again when inotify reported it or its mtime or size changed.
+    """
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_IGNORED = 0x00008000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    WatchMask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | \
+                IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+    EventHeaderSize = struct.calcsize('iIII')
+
+    def __init__(self, paths, poll_interval = ConfigWatcherPollSeconds, settle_time = ConfigWatcherSettleSeconds, use_inotify = True):
+        self.paths = list(paths)
+        self.poll_interval = poll_interval
+        self.settle_time = settle_time
+        self.stats = dict((path, None) for path in self.paths)
+        self.digests = dict((path, None) for path in self.paths)
+        self.dirs = {}
+        for path in self.paths:
+            self.dirs.setdefault(os.path.dirname(path), set()).add(os.path.basename(path))
+        self.watches = {}
+        self.notified = set()
+        self.libc = None
+        self.fd = None
+        if use_inotify:
+            self.init_inotify()
+
+    def init_inotify(self):
+        try:
+            self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+            self.fd = fd
+        except (AttributeError, OSError) as e:
+            hutil_log_info('inotify is not available, polling config files instead: {0}'.format(e))
+            self.libc = None
+            self.fd = None
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        self.watches = {}
+
+    def add_watches(self):
+        """
+        Add an inotify watch for each parent directory that is not watched yet
+        Returns True if every directory is watched
+        """
+        if self.fd is None:
+            return False
+        watched = set(self.watches.values())
+        for directory in self.dirs:
+            if directory in watched or not os.path.isdir(directory):
+                continue
+            wd = self.libc.inotify_add_watch(self.fd, directory.encode('utf-8'), self.WatchMask)
+            if wd >= 0:
+                self.watches[wd] = directory
+                # Changes made before the watch existed were not notified
+                self.notified.update(os.path.join(directory, name) for name in self.dirs[directory])
+        return len(self.watches) == len(self.dirs)
+
+    def read_events(self):
+        """
+        Drain pending inotify events and remember which of the watched files they are about
+        """
+        while True:
+            try:
+                buf = os.read(self.fd, 4096)
+            except OSError:
+                return
+            if not buf:
+                return
+            offset = 0
+            while offset + self.EventHeaderSize <= len(buf):
+                wd, mask, _, length = struct.unpack_from('iIII', buf, offset)
+                name = buf[offset + self.EventHeaderSize:offset + self.EventHeaderSize + length]
+                name = name.rstrip(b'\0').decode('utf-8', 'replace')
+                offset += self.EventHeaderSize + length
+                directory = self.watches.get(wd)
+                if directory is None:
+                    continue
+                if mask & self.IN_IGNORED:
+                    # The directory went away; it is watched again once it is recreated
+                    del self.watches[wd]
+                    self.notified.update(os.path.join(directory, f) for f in self.dirs[directory])
+                elif name in self.dirs[directory]:
+                    self.notified.add(os.path.join(directory, name))
+
+    def check(self, paths = None):
+        """
+        Return the subset of paths (all watched paths by default) whose content
+        changed since the last check. A missing file has no content, so creating
+        or deleting a file counts as a change.
+        """
+        if paths is None:
+            paths = self.paths
+        changed = []
+        for path in paths:
+            try:
+                st = os.stat(path)
+                stat_key = (st.st_mtime, st.st_size, st.st_ino)
+            except OSError:
+                stat_key = None
+            if stat_key == self.stats[path] and path not in self.notified:
+                continue
+            self.notified.discard(path)
+            self.stats[path] = stat_key
+            digest = None
+            if stat_key is not None:
+                try:
+                    with open(path, 'rb') as f:
+                        digest = hashlib.sha256(f.read()).hexdigest()
+                except IOError:
+                    pass
+            if digest != self.digests[path]:
+                self.digests[path] = digest
+                changed.append(path)
+        return changed
+
+    def wait(self, timeout, extra_fds = ()):
+        """
+        Block until the content of a watched file changes, one of extra_fds
+        becomes readable or timeout seconds pass, and return the paths that
+        changed (possibly none)
+        """
+        deadline = time.time() + timeout
+        while True:
+            all_watched = self.add_watches()
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return self.check()
+            if not all_watched:
+                remaining = min(remaining, self.poll_interval)
+
+            fds = list(extra_fds)
+            if self.fd is not None:
+                fds.append(self.fd)
+            readable = []
+            if fds:
+                readable, _, _ = select.select(fds, [], [], remaining)
+            else:
+                time.sleep(remaining)
+            if self.fd is not None and self.fd in readable:
+                # Let a writer finish writing or renaming before looking at the file
+                time.sleep(self.settle_time)
+                self.read_events()
+
+            changed = self.check()
+            if changed or set(readable) & set(extra_fds):
+                return changed
+
+def read_config_file(path):
     """
-    Start syslog check process that performs periodic DCR monitoring activities and looks for syslog config changes
-    :return: None
+    Return the content of a config file, or '' if it does not exist
     """
+    if not os.path.isfile(path):
+        return ''
+    with open(path, "r") as f:
+        return f.read()
 
-    # test
-    if not is_syslogconfig_process_running():
-        stop_syslogconfig_process()
-
-        # Start syslog config watcher
-        ama_path = os.path.join(os.getcwd(), 'agent.py')
-        args = [sys.executable, ama_path, '-syslogconfig']
-        log = open(os.path.join(os.getcwd(), 'daemon.log'), 'w')
-        hutil_log_info('start syslog watcher process '+str(args))
-        subprocess.Popen(args, stdout=log, stderr=log)
+def find_process_pid(binary):
+    """
+    Return the pid of a process running binary, or None
+    """
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            exe = os.readlink(os.path.join('/proc', pid, 'exe'))
+        except OSError:
+            continue
+        # A binary replaced while running shows up as "<path> (deleted)"
+        if exe == binary or exe == binary + ' (deleted)':
+            return int(pid)
+    return None
 
-def start_transformconfig_process():
+def write_supervisor_metrics(metrics):
     """
-    Start agent transform check process that performs periodic DCR monitoring activities and looks for agent transformation config changes
-    :return: None
+    Write the restart metrics of the supervised processes as JSON
     """
+    try:
+        tmp_path = SupervisorMetricsPath + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(metrics, f, sort_keys=True)
+        os.rename(tmp_path, SupervisorMetricsPath)
+    except (IOError, OSError) as e:
+        hutil_log_info('Failed to write {0}: {1}'.format(SupervisorMetricsPath, e))
+
+class ProcessSupervisor(object):
+    """
+    Keep a service running, restarting it with exponential backoff and within
+    a budget of restarts per window. The process is tracked through a pidfd
+    when the platform supports it, so that its exit wakes up the watcher right
+    away; otherwise is_running is polled. Restart counts and the time it took
+    to recover are exposed through get_metrics.
+    """
+    def __init__(self, name, binary, is_running, restart, hutil_error, hutil_log,
+                 backoff = ProcessRestartBackoffSeconds, max_backoff = ProcessRestartMaxBackoffSeconds,
+                 budget = ProcessRestartBudget, budget_window = ProcessRestartBudgetWindowSeconds,
+                 clock = time.time):
+        self.name = name
+        self.binary = binary
+        self.is_running = is_running
+        self.restart = restart
+        self.hutil_error = hutil_error
+        self.hutil_log = hutil_log
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.budget = budget
+        self.budget_window = budget_window
+        self.clock = clock
+        self.pidfd = None
+        self.down_since = None
+        self.next_restart = 0
+        self.failures = 0
+        self.restart_times = []
+        self.restarts = 0
+        self.recoveries = 0
+        self.last_time_to_recover = None
+        self.budget_exhausted = False
+
+    def attach(self):
+        """
+        Open a pidfd for the running process, if the platform supports it
+        """
+        self.detach()
+        if not hasattr(os, 'pidfd_open'):
+            return
+        pid = find_process_pid(self.binary)
+        if pid is None:
+            return
+        try:
+            self.pidfd = os.pidfd_open(pid)
+        except OSError:
+            self.pidfd = None
+
+    def detach(self):
+        if self.pidfd is not None:
+            os.close(self.pidfd)
+            self.pidfd = None
+
+    def fileno(self):
+        return self.pidfd
+
+    def is_alive(self):
+        if self.pidfd is not None:
+            readable, _, _ = select.select([self.pidfd], [], [], 0)
+            if not readable:
+                return True
+            # The process exited
+            self.detach()
+        return self.is_running()
+
+    def get_next_wakeup(self):
+        """
+        Return when the next restart attempt is due, or None if the process is up
+        """
+        if self.down_since is None or self.budget_exhausted:
+            return None
+        return self.next_restart
+
+    def check(self):
+        now = self.clock()
+        if self.is_alive():
+            if self.down_since is not None:
+                self.last_time_to_recover = now - self.down_since
+                self.recoveries += 1
+                self.hutil_log('{0} recovered after {1:.1f} seconds'.format(self.name, self.last_time_to_recover))
+                self.down_since = None
+                self.failures = 0
+            if self.pidfd is None:
+                self.attach()
+            return
 
-    # test
-    if not is_transformconfig_process_running():
-        stop_transformconfig_process()
+        if self.down_since is None:
+            self.down_since = now
+            self.next_restart = now
+        if now < self.next_restart:
+            return
 
-        # Start agent transform config watcher
-        ama_path = os.path.join(os.getcwd(), 'agent.py')
-        args = [sys.executable, ama_path, '-transformconfig']
-        log = open(os.path.join(os.getcwd(), 'daemon.log'), 'w')
-        hutil_log_info('start agent transform config watcher process '+str(args))
-        subprocess.Popen(args, stdout=log, stderr=log)
+        self.restart_times = [t for t in self.restart_times if now - t < self.budget_window]
+        if len(self.restart_times) >= self.budget:
+            if not self.budget_exhausted:
+                self.hutil_error("{0} binary process is not running. Failed to restart after {1} retries within {2} seconds. "
+                                 "Retrying after {3} seconds".format(self.name, self.budget, self.budget_window,
+                                                                     int(self.restart_times[0] + self.budget_window - now)))
+            self.budget_exhausted = True
+            self.next_restart = self.restart_times[0] + self.budget_window
+            return
+        self.budget_exhausted = False
+
+        self.failures += 1
+        self.restarts += 1
+        self.restart_times.append(now)
+        self.next_restart = now + min(self.max_backoff, self.backoff * 2 ** (self.failures - 1))
+        self.hutil_log("{0} binary process is not running. Restarting {0} now. Retry count - {1}".format(self.name, self.failures))
+        self.restart()
+        self.attach()
+
+    def get_metrics(self):
+        return {
+            'restarts' : self.restarts,
+            'recoveries' : self.recoveries,
+            'consecutiveFailures' : self.failures,
+            'lastTimeToRecoverSeconds' : self.last_time_to_recover,
+            'downSinceEpoch' : self.down_since,
+            'budgetExhausted' : self.budget_exhausted,
+        }
 
-def stop_transformconfig_process():
+class MetricsConfigHandler(object):
+    """
+    Set up telegraf and ME when the metric counters or fluent configuration
+    change, and keep them running and the ME MSI token fresh
+    """
+    def __init__(self, hutil_error, hutil_log):
+        self.hutil_error = hutil_error
+        self.hutil_log = hutil_log
+        self.paths = [MdsdCounterJsonPath, FluentCfgPath, AMAFluentPortFilePath]
+        self.watcher = None
+        self.counters = None
+        self.enabled_me_CMv2_mode = False
+
+        # Retrieve managed identity info that may be needed for token retrieval
+        self.identifier_name, self.identifier_value, error_msg = get_managed_identity()
+        if error_msg:
+            hutil_error('Failed to determine managed identity settings; MSI token retreival will rely on default identity, if any. {0}.'.format(error_msg))
+        if self.identifier_name and self.identifier_value:
+            self.managed_identity_str = "uai#{0}#{1}".format(self.identifier_name, self.identifier_value)
+        else:
+            self.managed_identity_str = "sai"
+        self.token_manager = me_handler.get_msi_token_manager(self.identifier_name, self.identifier_value, is_lad=False,
+                                                             log_info=hutil_log, log_error=hutil_error)
+
+        self.supervisors = [
+            ProcessSupervisor("Telegraf", metrics_constants.ama_telegraf_bin,
+                              lambda: telhandler.is_running(is_lad=False), self.restart_telegraf,
+                              hutil_error, hutil_log),
+            ProcessSupervisor("MetricsExtension", metrics_constants.ama_metrics_extension_bin,
+                              lambda: me_handler.is_running(is_lad=False), self.restart_metrics_extension,
+                              hutil_error, hutil_log),
+        ]
+        self.supervisor_metrics = None
+
+    def run(self, changed, periodic):
+        try:
+            if periodic:
+                self.ensure_services()
 
-    pids_filepath = os.path.join(os.getcwd(),'amatransformconfig.pid')
+            if FluentCfgPath in changed or AMAFluentPortFilePath in changed:
+                self.update_fluent_config(FluentCfgPath in changed)
 
-    # kill existing agent transform config watcher
-    if os.path.exists(pids_filepath):
-        with open(pids_filepath, "r") as f:
-            for pid in f.readlines():
-                # Verify the pid actually belongs to AMA tranform config watcher.
-                cmd_file = os.path.join("/proc", str(pid.strip("\n")), "cmdline")
-                if os.path.exists(cmd_file):
-                    with open(cmd_file, "r") as pidf:
-                        cmdline = pidf.readlines()
-                        if len(cmdline) > 0 and cmdline[0].find("agent.py") >= 0 and cmdline[0].find("-transformconfig") >= 0:
-                            kill_cmd = "kill " + pid
-                            run_command_and_log(kill_cmd)
+            if MdsdCounterJsonPath in changed:
+                data = read_config_file(MdsdCounterJsonPath)
+                if (data != ''):
+                    self.counters = json.loads(data)
+                    if len(self.counters) != 0:
+                        self.configure_metrics(data)
 
-        run_command_and_log("rm "+ pids_filepath)
+            if periodic and self.counters is not None:
+                if len(self.counters) == 0:
+                    self.remove_metrics_services()
+                else:
+                    self.refresh_msi_token()
 
-def metrics_watcher(hutil_error, hutil_log):
-    """
-    Watcher thread to monitor metric configuration changes and to take action on them
-    """
-    global MDSDFluentPort
-    # Check every 30 seconds
-    sleepTime =  30
+        except IOError as e:
+            self.hutil_error('I/O error in setting up or monitoring metrics. Exception={0}'.format(e))
 
-    # Retrieve managed identity info that may be needed for token retrieval
-    identifier_name, identifier_value, error_msg = get_managed_identity()
-    if error_msg:
-        hutil_error('Failed to determine managed identity settings; MSI token retreival will rely on default identity, if any. {0}.'.format(error_msg))
-    if identifier_name and identifier_value:
-        managed_identity_str = "uai#{0}#{1}".format(identifier_name, identifier_value)
-    else:
-        managed_identity_str = "sai"
+        except Exception as e:
+            self.hutil_error('Error in setting up or monitoring metrics. Exception={0}'.format(e))
 
-    # Sleep before starting the monitoring
-    time.sleep(sleepTime)
-    last_crc = None
-    last_crc_fluent = None
-    me_msi_token_expiry_epoch = None
-    enabled_me_CMv2_mode = False
-    log_messages = ""
+    def ensure_services(self):
+        if not azureotelcollector_is_active():
+            install_azureotelcollector()
 
-    while True:
-        try:
-            if not azureotelcollector_is_active():
-                install_azureotelcollector()
+        if not me_handler.is_running(is_lad=False):
+            me_service_template_path = os.getcwd() + "/services/metrics-extension.service"
+            log_messages = ""
 
-            if not me_handler.is_running(is_lad=False):
-                me_service_template_path = os.getcwd() + "/services/metrics-extension.service"
+            try:
+                if is_feature_enabled("enableAzureOTelCollector"):
+                    if os.path.exists(me_service_template_path):
+                        os.remove(me_service_template_path)
+                    copyfile(os.getcwd() + "/services/metrics-extension-cmv2.service", me_service_template_path)
+                    me_handler.setup_me(
+                        is_lad=False,
+                        managed_identity=self.managed_identity_str,
+                        HUtilObj=HUtilObject,
+                        is_local_control_channel=False)
+                    self.enabled_me_CMv2_mode, log_messages = me_handler.start_metrics_cmv2()
+                elif is_feature_enabled("enableCMV2"):
+                    if os.path.exists(me_service_template_path):
+                        os.remove(me_service_template_path)
+                    copyfile(os.getcwd() + "/services/metrics-extension-otlp.service", me_service_template_path)
+                    me_handler.setup_me(
+                        is_lad=False,
+                        managed_identity=self.managed_identity_str,
+                        HUtilObj=HUtilObject,
+                        is_local_control_channel=False)
+                    self.enabled_me_CMv2_mode, log_messages = me_handler.start_metrics_cmv2()
+            except Exception as e:
+                hutil_log_error("Error in setting up metrics-extension.service in CMv2 mode. Exception={0}".format(e))
 
-                try:
-                    if is_feature_enabled("enableAzureOTelCollector"):
-                        if os.path.exists(me_service_template_path):
-                            os.remove(me_service_template_path)
-                        copyfile(os.getcwd() + "/services/metrics-extension-cmv2.service", me_service_template_path)
-                        me_handler.setup_me(
-                            is_lad=False,
-                            managed_identity=managed_identity_str,
-                            HUtilObj=HUtilObject,
-                            is_local_control_channel=False)
-                        enabled_me_CMv2_mode, log_messages = me_handler.start_metrics_cmv2()
-                    elif is_feature_enabled("enableCMV2"):
-                        if os.path.exists(me_service_template_path):
-                            os.remove(me_service_template_path)
-                        copyfile(os.getcwd() + "/services/metrics-extension-otlp.service", me_service_template_path)
-                        me_handler.setup_me(
-                            is_lad=False,
-                            managed_identity=managed_identity_str,
-                            HUtilObj=HUtilObject,
-                            is_local_control_channel=False)
-                        enabled_me_CMv2_mode, log_messages = me_handler.start_metrics_cmv2()
-                except Exception as e:
-                    hutil_log_error("Error in setting up metrics-extension.service in CMv2 mode. Exception={0}".format(e))
-
-                if enabled_me_CMv2_mode:
-                    hutil_log_info("Successfully started metrics-extension.")
-                elif log_messages:
-                    hutil_log_error(log_messages)
-
-            # update fluent config for fluent port if needed
-            fluent_port = ''
-            if os.path.isfile(AMAFluentPortFilePath):
-                f = open(AMAFluentPortFilePath, "r")
-                fluent_port = validate_port_number(f.read(), "fluent")
-                f.close()
-            
-            if fluent_port != '' and os.path.isfile(FluentCfgPath) and fluent_port != MDSDFluentPort:
-                portSetting = "    Port                       "  + fluent_port + "\n"
-                defaultPortSetting = 'Port'
-                portUpdated = True                
-                with open(FluentCfgPath, 'r') as f:                    
-                    for line in f:                        
-                        found = re.search(r'^\s{0,}Port\s{1,}' + fluent_port + '$', line)
-                        if found:
-                            portUpdated = False
-
-                if portUpdated == True:
-                    with contextlib.closing(fileinput.FileInput(FluentCfgPath, inplace=True, backup='.bak')) as file:
-                        for line in file:
-                            if defaultPortSetting in line:
-                                print(portSetting, end='')
-                            else:
-                                print(line, end='')
-                    os.chmod(FluentCfgPath, stat.S_IRGRP | stat.S_IRUSR | stat.S_IWUSR | stat.S_IROTH)
-                    MDSDFluentPort = fluent_port
-
-                    # add SELinux rules if needed
-                    if os.path.exists('/etc/selinux/config') and fluent_port != '':
-                        sedisabled, _ = run_command_and_log('getenforce | grep -i "Disabled"',log_cmd=False, log_output=False)
-                        if sedisabled != 0:                        
-                            check_semanage, _ = run_command_and_log("which semanage",log_cmd=False, log_output=False)
-                            if check_semanage == 0:
-                                fluentPortEnabled, _ = run_command_and_log('grep -Rnw /var/lib/selinux -e ' + fluent_port,log_cmd=False, log_output=False)
-                                if fluentPortEnabled != 0:                    
-                                    # also check SELinux config paths for Oracle/RH
-                                    fluentPortEnabled, _ = run_command_and_log('grep -Rnw /etc/selinux -e ' + fluent_port,log_cmd=False, log_output=False)
-                                    if fluentPortEnabled != 0:                    
-                                        # allow the fluent port in SELinux
-                                        run_command_and_log('semanage port -a -t http_port_t -p tcp ' + fluent_port,log_cmd=False, log_output=False)
-
-            if os.path.isfile(FluentCfgPath):
-                f = open(FluentCfgPath, "r")
-                data = f.read()
+            if self.enabled_me_CMv2_mode:
+                hutil_log_info("Successfully started metrics-extension.")
+            elif log_messages:
+                hutil_log_error(log_messages)
 
-                if (data != ''):
-                    crc_fluent = hashlib.sha256(data.encode('utf-8')).hexdigest()
+    def update_fluent_config(self, fluent_cfg_changed):
+        """
+        Update fluent config for fluent port if needed, and restart the agent
+        launcher when the fluent config changed
+        """
+        global MDSDFluentPort
+
+        fluent_port = ''
+        if os.path.isfile(AMAFluentPortFilePath):
+            f = open(AMAFluentPortFilePath, "r")
+            fluent_port = validate_port_number(f.read(), "fluent")
+            f.close()
+
+        if fluent_port != '' and os.path.isfile(FluentCfgPath):
+            content = read_config_file(FluentCfgPath)
+            portUpdated = re.search(r'^\s*Port\s+' + re.escape(fluent_port) + '$', content, re.M) is None
+
+            if portUpdated == True and write_config_if_changed(FluentCfgPath, render_config(content, FluentPortPattern,
+                    "    Port                       " + fluent_port + "\n")):
+                MDSDFluentPort = fluent_port
+
+                # Pick up our own rewrite here so the launcher is restarted only once
+                if self.watcher is not None:
+                    fluent_cfg_changed = bool(self.watcher.check([FluentCfgPath])) or fluent_cfg_changed
+
+                # allow the fluent port in SELinux if needed
+                allow_selinux_port(fluent_port, 'http_port_t')
+
+        if fluent_cfg_changed and read_config_file(FluentCfgPath) != '':
+            restart_launcher()
+
+    def configure_metrics(self, data):
+        self.hutil_log("Start processing metric configuration")
+        self.hutil_log(data)
+
+        telegraf_config, telegraf_namespaces, telegraf_action = telhandler.apply_config(
+            self.counters,
+            "unix:///run/azuremetricsext/mdm_influxdb.socket",
+            "unix:///run/azuremonitoragent/default_influx.socket",
+            is_lad=False,
+            consolidate=is_feature_enabled('consolidateTelegrafInputs'))
+
+        # Only the changed telegraf configs were written; restart telegraf only if a reload cannot pick them up
+        if telegraf_action == telhandler.TelegrafConfigReload:
+            reload_telegraf_res, log_messages = telhandler.reload_telegraf(is_lad=False)
+            if reload_telegraf_res:
+                self.hutil_log("Successfully reloaded metrics-sourcer configuration.")
+            else:
+                self.hutil_log("{0} Restarting metrics-sourcer.".format(log_messages))
+                telegraf_action = telhandler.TelegrafConfigRestart
+        elif telegraf_action == telhandler.TelegrafConfigUnchanged and not telhandler.is_running(is_lad=False):
+            telegraf_action = telhandler.TelegrafConfigRestart
+
+        if telegraf_action == telhandler.TelegrafConfigRestart:
+            start_telegraf_res, log_messages = telhandler.start_telegraf(is_lad=False)
+            if start_telegraf_res:
+                self.hutil_log("Successfully started metrics-sourcer.")
+            else:
+                self.hutil_error(log_messages)
 
-                    if (crc_fluent != last_crc_fluent):                        
-                        restart_launcher()
-                        last_crc_fluent = crc_fluent
-           
-            if os.path.isfile(MdsdCounterJsonPath):
-                f = open(MdsdCounterJsonPath, "r")
-                data = f.read()
+        if not self.enabled_me_CMv2_mode:
+            me_service_template_path = os.getcwd() + "/services/metrics-extension.service"
+            if os.path.exists(me_service_template_path):
+                os.remove(me_service_template_path)
 
-                if (data != ''):
-                    json_data = json.loads(data)
-
-                    if len(json_data) == 0:
-                        last_crc = hashlib.sha256(data.encode('utf-8')).hexdigest()
-                        if telhandler.is_running(is_lad=False):
-                            # Stop the telegraf and ME services
-                            tel_out, tel_msg = telhandler.stop_telegraf_service(is_lad=False)
-                            if tel_out:
-                                hutil_log(tel_msg)
-                            else:
-                                hutil_error(tel_msg)
-
-                            # Delete the telegraf and ME services
-                            tel_rm_out, tel_rm_msg = telhandler.remove_telegraf_service(is_lad=False)
-                            if tel_rm_out:
-                                hutil_log(tel_rm_msg)
-                            else:
-                                hutil_error(tel_rm_msg)
-
-                        if not enabled_me_CMv2_mode and me_handler.is_running(is_lad=False):
-                            me_out, me_msg = me_handler.stop_metrics_service(is_lad=False)
-                            if me_out:
-                                hutil_log(me_msg)
-                            else:
-                                hutil_error(me_msg)
-
-                            me_rm_out, me_rm_msg = me_handler.remove_metrics_service(is_lad=False)
-                            if me_rm_out:
-                                hutil_log(me_rm_msg)
-                            else:
-                                hutil_error(me_rm_msg)
+            copyfile(os.getcwd() + "/services/metrics-extension-cmv1.service", me_service_template_path)
+            me_handler.setup_me(is_lad=False, managed_identity=self.managed_identity_str, HUtilObj=HUtilObject)
+            # setup_me recreated the ME config directory, write the token file again before ME starts
+            self.refresh_msi_token()
 
-                    else:
-                        crc = hashlib.sha256(data.encode('utf-8')).hexdigest()
-
-                        if(crc != last_crc):
-                            # Resetting the me_msi_token_expiry_epoch variable if we set up ME again.
-                            me_msi_token_expiry_epoch = None
-                            hutil_log("Start processing metric configuration")
-                            hutil_log(data)
-
-                            telegraf_config, telegraf_namespaces = telhandler.handle_config(
-                                json_data,
-                                "unix:///run/azuremetricsext/mdm_influxdb.socket",
-                                "unix:///run/azuremonitoragent/default_influx.socket",
-                                is_lad=False)
-
-                            start_telegraf_res, log_messages = telhandler.start_telegraf(is_lad=False)
-                            if start_telegraf_res:
-                                hutil_log("Successfully started metrics-sourcer.")
-                            else:
-                                hutil_error(log_messages)
-
-                            if not enabled_me_CMv2_mode:
-                                me_service_template_path = os.getcwd() + "/services/metrics-extension.service"
-                                if os.path.exists(me_service_template_path):
-                                    os.remove(me_service_template_path)
-
-                                copyfile(os.getcwd() + "/services/metrics-extension-cmv1.service", me_service_template_path)
-                                me_handler.setup_me(is_lad=False, managed_identity=managed_identity_str, HUtilObj=HUtilObject)
-
-                                start_metrics_out, log_messages = me_handler.start_metrics(is_lad=False, managed_identity=managed_identity_str)
-                                if start_metrics_out:
-                                    hutil_log("Successfully started metrics-extension.")
-                                else:
-                                    hutil_error(log_messages)
-
-                            last_crc = crc
-
-                        generate_token = False
-                        me_token_path = os.path.join(os.getcwd(), "/config/metrics_configs/AuthToken-MSI.json")
-
-                        if me_msi_token_expiry_epoch is None or me_msi_token_expiry_epoch == "":
-                            if os.path.isfile(me_token_path):
-                                with open(me_token_path, "r") as f:
-                                    authtoken_content = f.read()
-                                    if authtoken_content and "expires_on" in authtoken_content:
-                                        me_msi_token_expiry_epoch = authtoken_content["expires_on"]
-                                    else:
-                                        generate_token = True
-                            else:
-                                generate_token = True
-
-                        if me_msi_token_expiry_epoch:
-                            currentTime = datetime.datetime.now()
-                            token_expiry_time = datetime.datetime.fromtimestamp(int(me_msi_token_expiry_epoch))
-                            if token_expiry_time - currentTime < datetime.timedelta(minutes=30):
-                                # The MSI Token will expire within 30 minutes. We need to refresh the token
-                                generate_token = True
-
-                        if generate_token:
-                            generate_token = False
-                            msi_token_generated, me_msi_token_expiry_epoch, log_messages = me_handler.generate_MSI_token(identifier_name, identifier_value, is_lad=False)
-                            if msi_token_generated:
-                                hutil_log("Successfully refreshed metrics-extension MSI Auth token.")
-                            else:
-                                hutil_error(log_messages)
-
-                        telegraf_restart_retries = 0
-                        me_restart_retries = 0
-                        max_restart_retries = 10
-
-                        # Check if telegraf is running, if not, then restart
-                        if not telhandler.is_running(is_lad=False):
-                            if telegraf_restart_retries < max_restart_retries:
-                                telegraf_restart_retries += 1
-                                hutil_log("Telegraf binary process is not running. Restarting telegraf now. Retry count - {0}".format(telegraf_restart_retries))
-                                tel_out, tel_msg = telhandler.stop_telegraf_service(is_lad=False)
-                                if tel_out:
-                                    hutil_log(tel_msg)
-                                else:
-                                    hutil_error(tel_msg)
-                                start_telegraf_res, log_messages = telhandler.start_telegraf(is_lad=False)
-                                if start_telegraf_res:
-                                    hutil_log("Successfully started metrics-sourcer.")
-                                else:
-                                    hutil_error(log_messages)
-                            else:
-                                hutil_error("Telegraf binary process is not running. Failed to restart after {0} retries. Please check telegraf.log".format(max_restart_retries))
-                        else:
-                            telegraf_restart_retries = 0
-
-                        # Check if ME is running, if not, then restart
-                        if not me_handler.is_running(is_lad=False):
-                            if me_restart_retries < max_restart_retries:
-                                me_restart_retries += 1
-                                hutil_log("MetricsExtension binary process is not running. Restarting MetricsExtension now. Retry count - {0}".format(me_restart_retries))
-                                me_out, me_msg = me_handler.stop_metrics_service(is_lad=False)
-                                if me_out:
-                                    hutil_log(me_msg)
-                                else:
-                                    hutil_error(me_msg)
-                                start_metrics_out, log_messages = me_handler.start_metrics(is_lad=False, managed_identity=managed_identity_str)
-
-                                if start_metrics_out:
-                                    hutil_log("Successfully started metrics-extension.")
-                                else:
-                                    hutil_error(log_messages)
-                            else:
-                                hutil_error("MetricsExtension binary process is not running. Failed to restart after {0} retries. Please check /var/log/syslog for ME logs".format(max_restart_retries))
-                        else:
-                            me_restart_retries = 0
+            start_metrics_out, log_messages = me_handler.start_metrics(is_lad=False, managed_identity=self.managed_identity_str)
+            if start_metrics_out:
+                self.hutil_log("Successfully started metrics-extension.")
+            else:
+                self.hutil_error(log_messages)
+
+    def remove_metrics_services(self):
+        hutil_log = self.hutil_log
+        hutil_error = self.hutil_error
+        self.token_manager.stop()
+        if telhandler.is_running(is_lad=False):
+            # Stop the telegraf and ME services
+            tel_out, tel_msg = telhandler.stop_telegraf_service(is_lad=False)
+            if tel_out:
+                hutil_log(tel_msg)
+            else:
+                hutil_error(tel_msg)
 
-        except IOError as e:
-            hutil_error('I/O error in setting up or monitoring metrics. Exception={0}'.format(e))
+            # Delete the telegraf and ME services
+            tel_rm_out, tel_rm_msg = telhandler.remove_telegraf_service(is_lad=False)
+            if tel_rm_out:
+                hutil_log(tel_rm_msg)
+            else:
+                hutil_error(tel_rm_msg)
 
-        except Exception as e:
-            hutil_error('Error in setting up or monitoring metrics. Exception={0}'.format(e))
+        if not self.enabled_me_CMv2_mode and me_handler.is_running(is_lad=False):
+            me_out, me_msg = me_handler.stop_metrics_service(is_lad=False)
+            if me_out:
+                hutil_log(me_msg)
+            else:
+                hutil_error(me_msg)
+
+            me_rm_out, me_rm_msg = me_handler.remove_metrics_service(is_lad=False)
+            if me_rm_out:
+                hutil_log(me_rm_msg)
+            else:
+                hutil_error(me_rm_msg)
+
+    def refresh_msi_token(self):
+        """
+        Make sure ME has a valid MSI token and keep it refreshed in the background. Refresh failures are logged by
+        the token manager.
+        """
+        self.token_manager.ensure_token()
+        self.token_manager.start()
 
-        finally:
-            time.sleep(sleepTime)
+    def restart_telegraf(self):
+        tel_out, tel_msg = telhandler.stop_telegraf_service(is_lad=False)
+        if tel_out:
+            self.hutil_log(tel_msg)
+        else:
+            self.hutil_error(tel_msg)
+        start_telegraf_res, log_messages = telhandler.start_telegraf(is_lad=False)
+        if start_telegraf_res:
+            self.hutil_log("Successfully started metrics-sourcer.")
+        else:
+            self.hutil_error(log_messages)
+
+    def restart_metrics_extension(self):
+        me_out, me_msg = me_handler.stop_metrics_service(is_lad=False)
+        if me_out:
+            self.hutil_log(me_msg)
+        else:
+            self.hutil_error(me_msg)
+        start_metrics_out, log_messages = me_handler.start_metrics(is_lad=False, managed_identity=self.managed_identity_str)
+        if start_metrics_out:
+            self.hutil_log("Successfully started metrics-extension.")
+        else:
+            self.hutil_error(log_messages)
+
+    def supervise(self):
+        """
+        Restart telegraf and ME if they are not running while metric counters are configured
+        """
+        if not self.counters:
+            for supervisor in self.supervisors:
+                supervisor.detach()
+            return
+        try:
+            for supervisor in self.supervisors:
+                supervisor.check()
+            metrics = dict((supervisor.name, supervisor.get_metrics()) for supervisor in self.supervisors)
+            metrics['MsiToken'] = self.token_manager.get_metrics()
+            if metrics != self.supervisor_metrics:
+                self.supervisor_metrics = metrics
+                write_supervisor_metrics(metrics)
+        except Exception as e:
+            self.hutil_error('Error in monitoring metrics. Exception={0}'.format(e))
 
-def syslogconfig_watcher(hutil_error, hutil_log):
+class SyslogConfigHandler(object):
     """
-    Watcher thread to monitor syslog configuration changes and to take action on them
+    Place or remove the local syslog configs when the syslog marker or port
+    change. This also runs periodically so that removed configs are restored.
     """
-    syslog_enabled  = False
-    # Check for config changes every 30 seconds
-    sleepTime =  30
+    def __init__(self, hutil_error, hutil_log):
+        self.hutil_error = hutil_error
+        self.hutil_log = hutil_log
+        self.paths = [AMASyslogConfigMarkerPath, AMASyslogPortFilePath]
+        self.GcsEnabled, self.McsEnabled = get_control_plane_mode()
 
-    # Sleep before starting the monitoring
-    time.sleep(sleepTime)
+    def run(self, changed, periodic):
+        if not periodic and not set(changed) & set(self.paths):
+            return
 
-    GcsEnabled, McsEnabled = get_control_plane_mode()
-        
-    while True:
-        try:       
+        syslog_enabled = False
+        try:
             if os.path.isfile(AMASyslogConfigMarkerPath):
-                f = open(AMASyslogConfigMarkerPath, "r")
-                data = f.read()
-
+                data = read_config_file(AMASyslogConfigMarkerPath)
                 if (data != ''):
                     if "true" in data:
                         syslog_enabled = True
-                f.close()
-            elif GcsEnabled:
+            elif self.GcsEnabled:
                 # 1P Syslog is always enabled as each tenant could be having different mdsd.xml configuration
                 syslog_enabled = True
 
             if syslog_enabled:
                 # place syslog local configs
-                syslog_enabled  = False
-                generate_localsyslog_configs(uses_gcs=GcsEnabled, uses_mcs=McsEnabled)
+                generate_localsyslog_configs(uses_gcs=self.GcsEnabled, uses_mcs=self.McsEnabled)
             else:
                 # remove syslog local configs
                 remove_localsyslog_configs()
 
         except IOError as e:
-            hutil_error('I/O error in setting up syslog config watcher. Exception={0}'.format(e))
+            self.hutil_error('I/O error in setting up syslog config watcher. Exception={0}'.format(e))
 
         except Exception as e:
-            hutil_error('Error in setting up syslog config watcher. Exception={0}'.format(e))
+            self.hutil_error('Error in setting up syslog config watcher. Exception={0}'.format(e))
+
+class TransformConfigHandler(object):
+    """
+    Restart the AST extension when the agent transformation config changes
+    """
+    def __init__(self, hutil_error, hutil_log):
+        self.hutil_error = hutil_error
+        self.hutil_log = hutil_log
+        self.paths = [AMAAstTransformConfigMarkerPath]
+
+    def run(self, changed, periodic):
+        if AMAAstTransformConfigMarkerPath not in changed:
+            return
 
-        finally:
-            time.sleep(sleepTime)
+        try:
+            if read_config_file(AMAAstTransformConfigMarkerPath) != '':
+                restart_astextension()
+
+        except IOError as e:
+            self.hutil_error('I/O error in setting up agent transform config watcher. Exception={0}'.format(e))
 
-def transformconfig_watcher(hutil_error, hutil_log):
+        except Exception as e:
+            self.hutil_error('Error in setting up agent transform config watcher. Exception={0}'.format(e))
+
+def config_watcher(hutil_error, hutil_log):
     """
-    Watcher thread to monitor agent transformation configuration changes and to take action on them
+    Watcher thread to monitor metrics, syslog and agent transformation
+    configuration changes and to take action on them. Handlers run as soon as
+    a file they watch changes, and every ConfigWatcherPeriodicSeconds for the
+    periodic health checks. Supervised processes are checked as soon as they
+    exit and whenever their restart backoff expires.
     """
-    # Check for config changes every 30 seconds
-    sleepTime =  30
+    handlers = [MetricsConfigHandler(hutil_error, hutil_log),
+                SyslogConfigHandler(hutil_error, hutil_log)]
+    # The agent transformation config is only used by the AST extension, which does not run on aarch64
+    if platform.machine() != 'aarch64':
+        handlers.append(TransformConfigHandler(hutil_error, hutil_log))
+
+    paths = []
+    for handler in handlers:
+        paths.extend(p for p in handler.paths if p not in paths)
+    watcher = ConfigFileWatcher(paths)
+    for handler in handlers:
+        handler.watcher = watcher
 
     # Sleep before starting the monitoring
-    time.sleep(sleepTime)
-    last_crc = None
+    time.sleep(ConfigWatcherPeriodicSeconds)
+    next_periodic = 0
+    global OperationTimingsObject
+    OperationTimingsObject = OperationTimings('Configwatcher')
 
     while True:
         try:
-            if os.path.isfile(AMAAstTransformConfigMarkerPath):
-                f = open(AMAAstTransformConfigMarkerPath, "r")
-                data = f.read()
-                if (data != ''):
-                    crc = hashlib.sha256(data.encode('utf-8')).hexdigest()
+            if time.time() - OperationTimingsObject.start_time >= ConfigWatcherTimingsSeconds:
+                OperationTimingsObject.save()
+                OperationTimingsObject = OperationTimings('Configwatcher')
+
+            supervisors = [s for handler in handlers for s in getattr(handler, 'supervisors', [])]
+            wakeup = min([next_periodic] + [s.get_next_wakeup() for s in supervisors if s.get_next_wakeup() is not None])
+            pidfds = [s.fileno() for s in supervisors if s.fileno() is not None]
+            changed = watcher.wait(max(0, wakeup - time.time()), pidfds)
+            periodic = time.time() >= next_periodic
+            if periodic:
+                next_periodic = time.time() + ConfigWatcherPeriodicSeconds
+            for handler in handlers:
+                with timing_span(type(handler).__name__):
+                    handler.run(changed, periodic)
+                if hasattr(handler, 'supervise'):
+                    with timing_span(type(handler).__name__ + ' supervise'):
+                        handler.supervise()
 
-                    if (crc != last_crc):
-                        restart_astextension()
-                        last_crc = crc
-                f.close()
+        except Exception as e:
+            hutil_error('Error in config watcher. Exception={0}'.format(e))
+            time.sleep(ConfigWatcherPollSeconds)
 
-        except IOError as e:
-            hutil_error('I/O error in setting up agent transform config watcher. Exception={0}'.format(e))
+def get_selinux_policy_key():
+    """
+    Return the modification times of the SELinux config and policy stores.
+    semanage rewrites the policy store whenever a port label is added or
+    removed, so a change of this key invalidates the cached policy.
+    """
+    key = []
+    for pattern in SELinuxPolicyStorePaths:
+        for path in sorted(glob.glob(pattern)):
+            try:
+                key.append((path, os.stat(path).st_mtime))
+            except OSError:
+                pass
+    return tuple(key)
+
+def get_selinux_policy():
+    """
+    Return the cached SELinux policy state, re-reading the enforcement state
+    and semanage availability when the policy store changed
+    """
+    global SELinuxPolicyCache
+
+    key = get_selinux_policy_key()
+    if SELinuxPolicyCache is None or SELinuxPolicyCache['key'] != key:
+        enabled = False
+        semanage_available = False
+        if os.path.exists('/etc/selinux/config'):
+            sedisabled, _ = run_command_and_log('getenforce | grep -i "Disabled"',log_cmd=False, log_output=False)
+            enabled = sedisabled != 0
+            if enabled:
+                check_semanage, _ = run_command_and_log("which semanage",log_cmd=False, log_output=False)
+                semanage_available = check_semanage == 0
+        SELinuxPolicyCache = {'key' : key, 'enabled' : enabled,
+                              'semanage' : semanage_available, 'ports' : None}
+    return SELinuxPolicyCache
+
+def is_selinux_enabled():
+    return get_selinux_policy()['enabled']
+
+def parse_semanage_ports(output):
+    """
+    Parse the output of 'semanage port -l' into a dictionary of
+    (protocol, port) -> set of SELinux port types.
+    Only ports that are labelled individually are included; port ranges
+    (e.g. unreserved_port_t 1024-32767) do not count as a label for a port.
+    """
+    ports = {}
+    for line in output.splitlines():
+        fields = line.split(None, 2)
+        if len(fields) < 3 or not fields[0].endswith('_t'):
+            continue
+        port_type, protocol, port_list = fields
+        for port in port_list.split(','):
+            port = port.strip()
+            if port.isdigit():
+                ports.setdefault((protocol, port), set()).add(port_type)
+    return ports
 
-        except Exception as e:
-            hutil_error('Error in setting up agent transform config watcher. Exception={0}'.format(e))
+def get_selinux_port_types(port, protocol = 'tcp'):
+    """
+    Return the SELinux port types the port is labelled with, from a single
+    'semanage port -l' snapshot cached until the policy store changes
+    """
+    policy = get_selinux_policy()
+    if policy['ports'] is None:
+        exit_code, output = run_command_and_log('semanage port -l', log_cmd=False, log_output=False)
+        policy['ports'] = parse_semanage_ports(output) if exit_code == 0 else {}
+    return policy['ports'].get((protocol, str(port)), set())
+
+def allow_selinux_port(port, port_type):
+    """
+    Label the tcp port with port_type in SELinux, unless SELinux is disabled,
+    semanage is not available or the port is already labelled
+    """
+    global SELinuxPolicyCache
+
+    policy = get_selinux_policy()
+    if not policy['enabled'] or not policy['semanage'] or port == '':
+        return
+    if not get_selinux_port_types(port):
+        run_command_and_log('semanage port -a -t ' + port_type + ' -p tcp ' + port,log_cmd=False, log_output=False)
+        SELinuxPolicyCache = None
+
+def render_config(content, pattern, replacement):
+    """
+    Render a config in memory, replacing every match of a precompiled pattern
+    with replacement taken literally
+    """
+    return pattern.sub(lambda match: replacement, content)
 
-        finally:
-            time.sleep(sleepTime)
+def render_config_template(template_path, pattern, replacement):
+    with open(template_path, 'r') as f:
+        return render_config(f.read(), pattern, replacement)
+
+def write_config_if_changed(path, content, mode = ConfigFileMode):
+    """
+    Atomically replace the config file at path with content, unless it already
+    has exactly this content.
+    Returns True if the file was written, i.e. the daemon reading it needs a restart.
+    """
+    data = content.encode('utf-8')
+    try:
+        with open(path, 'rb') as f:
+            if f.read() == data:
+                return False
+    except IOError:
+        pass
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.chmod(tmp_path, mode)
+    os.rename(tmp_path, path)
+    return True
 
 def generate_localsyslog_configs(uses_gcs = False, uses_mcs = False):
     """
@@ -2232,23 +3155,12 @@ def generate_localsyslog_configs(uses_gcs = False, uses_mcs = False):
     # always use syslog tcp port, unless 
     # - the distro is Red Hat based and doesn't have semanage
     #   these distros seem to have SELinux on by default and we shouldn't be installing semanage ourselves
-    if not os.path.exists('/etc/selinux/config'):
+    if not is_selinux_enabled():
+        useSyslogTcp = True
+    else:
+        # allow the syslog port in SELinux if needed
+        allow_selinux_port(syslog_port, 'syslogd_port_t')
         useSyslogTcp = True
-    else:        
-        sedisabled, _ = run_command_and_log('getenforce | grep -i "Disabled"',log_cmd=False, log_output=False)
-        if sedisabled == 0:
-            useSyslogTcp = True
-        else:            
-            check_semanage, _ = run_command_and_log("which semanage",log_cmd=False, log_output=False)
-            if check_semanage == 0 and syslog_port != '':
-                syslogPortEnabled, _ = run_command_and_log('grep -Rnw /var/lib/selinux -e ' + syslog_port,log_cmd=False, log_output=False)
-                if syslogPortEnabled != 0:                    
-                    # also check SELinux config paths for Oracle/RH
-                    syslogPortEnabled, _ = run_command_and_log('grep -Rnw /etc/selinux -e ' + syslog_port,log_cmd=False, log_output=False)
-                    if syslogPortEnabled != 0:                    
-                        # allow the syslog port in SELinux
-                        run_command_and_log('semanage port -a -t syslogd_port_t -p tcp ' + syslog_port,log_cmd=False, log_output=False)
-                useSyslogTcp = True   
 
     if syslog_port != '':
         MDSDSyslogPort = syslog_port
@@ -2266,25 +3178,12 @@ def generate_localsyslog_configs(uses_gcs = False, uses_mcs = False):
                     os.remove("/etc/rsyslog.d/05-azuremonitoragent-loadomuxsock.conf")
                 if os.path.exists('/etc/rsyslog.d/10-azuremonitoragent.conf'):
                     os.remove("/etc/rsyslog.d/10-azuremonitoragent.conf")
-                copyfile("/etc/opt/microsoft/azuremonitoragent/syslog/rsyslogconf/10-azuremonitoragent-omfwd.conf","/etc/rsyslog.d/10-azuremonitoragent-omfwd.conf")
-                os.chmod('/etc/rsyslog.d/10-azuremonitoragent-omfwd.conf', stat.S_IRGRP | stat.S_IRUSR | stat.S_IWUSR | stat.S_IROTH)
-                restartRequired = True                
-            
-            portSetting = 'Port="' + syslog_port + '"'
-            defaultPortSetting = 'Port="28330"'
-            portUpdated = False
-            with open('/etc/rsyslog.d/10-azuremonitoragent-omfwd.conf') as f:
-                if portSetting not in f.read():
-                    portUpdated = True
-
-            if portUpdated == True:
-                copyfile("/etc/opt/microsoft/azuremonitoragent/syslog/rsyslogconf/10-azuremonitoragent-omfwd.conf","/etc/rsyslog.d/10-azuremonitoragent-omfwd.conf")
-                with contextlib.closing(fileinput.FileInput('/etc/rsyslog.d/10-azuremonitoragent-omfwd.conf', inplace=True, backup='.bak')) as file:
-                    for line in file:
-                        print(line.replace(defaultPortSetting, portSetting), end='')
-                os.chmod('/etc/rsyslog.d/10-azuremonitoragent-omfwd.conf', stat.S_IRGRP | stat.S_IRUSR | stat.S_IWUSR | stat.S_IROTH)
+
+            omfwd_config = render_config_template("/etc/opt/microsoft/azuremonitoragent/syslog/rsyslogconf/10-azuremonitoragent-omfwd.conf",
+                                                  RsyslogPortPattern, 'Port="' + syslog_port + '"')
+            if write_config_if_changed('/etc/rsyslog.d/10-azuremonitoragent-omfwd.conf', omfwd_config):
                 restartRequired = True
-            
+
             if restartRequired == True:
                 run_command_and_log(get_service_command("rsyslog", "restart"))
                 hutil_log_info("Installed local syslog configuration files and restarted syslog")
@@ -2297,25 +3196,12 @@ def generate_localsyslog_configs(uses_gcs = False, uses_mcs = False):
                 syslog_ng_confpath = os.path.join('/etc/syslog-ng/', 'conf.d')
                 if not os.path.exists(syslog_ng_confpath):
                     os.makedirs(syslog_ng_confpath)
-                copyfile("/etc/opt/microsoft/azuremonitoragent/syslog/syslog-ngconf/azuremonitoragent-tcp.conf","/etc/syslog-ng/conf.d/azuremonitoragent-tcp.conf")
-                os.chmod('/etc/syslog-ng/conf.d/azuremonitoragent-tcp.conf', stat.S_IRGRP | stat.S_IRUSR | stat.S_IWUSR | stat.S_IROTH)
-                restartRequired = True
 
-            portSetting = "port(" + syslog_port + ")"
-            defaultPortSetting = "port(28330)"
-            portUpdated = False
-            with open('/etc/syslog-ng/conf.d/azuremonitoragent-tcp.conf') as f:
-                if portSetting not in f.read():
-                    portUpdated = True
-
-            if portUpdated == True:
-                copyfile("/etc/opt/microsoft/azuremonitoragent/syslog/syslog-ngconf/azuremonitoragent-tcp.conf","/etc/syslog-ng/conf.d/azuremonitoragent-tcp.conf")
-                with contextlib.closing(fileinput.FileInput('/etc/syslog-ng/conf.d/azuremonitoragent-tcp.conf', inplace=True, backup='.bak')) as file:
-                    for line in file:
-                        print(line.replace(defaultPortSetting, portSetting), end='')
-                os.chmod('/etc/syslog-ng/conf.d/azuremonitoragent-tcp.conf', stat.S_IRGRP | stat.S_IRUSR | stat.S_IWUSR | stat.S_IROTH)
+            tcp_config = render_config_template("/etc/opt/microsoft/azuremonitoragent/syslog/syslog-ngconf/azuremonitoragent-tcp.conf",
+                                                SyslogNgPortPattern, "port(" + syslog_port + ")")
+            if write_config_if_changed('/etc/syslog-ng/conf.d/azuremonitoragent-tcp.conf', tcp_config):
                 restartRequired = True
-            
+
             if restartRequired == True:
                 run_command_and_log(get_service_command("syslog-ng", "restart"))
                 hutil_log_info("Installed local syslog configuration files and restarted syslog")    
@@ -2366,46 +3252,17 @@ def remove_localsyslog_configs():
         run_command_and_log(get_service_command("syslog-ng", "restart"))
         hutil_log_info("Removed local syslog configuration files if found and restarted syslog")
 
-def metrics():
-    """
-    Take care of setting up telegraf and ME for metrics if configuration is present
-    """
-    pids_filepath = os.path.join(os.getcwd(), 'amametrics.pid')
-    py_pid = os.getpid()
-    with open(pids_filepath, 'w') as f:
-        f.write(str(py_pid) + '\n')
-
-    watcher_thread = Thread(target = metrics_watcher, args = [hutil_log_error, hutil_log_info])
-    watcher_thread.start()
-    watcher_thread.join()
-
-    return 0, ""
-
-def syslogconfig():
+def configwatcher():
     """
-    Take care of setting up syslog configuration change watcher
+    Take care of setting up telegraf and ME for metrics if configuration is present,
+    and of watching for metrics, syslog and agent transformation config changes
     """
-    pids_filepath = os.path.join(os.getcwd(), 'amasyslogconfig.pid')
+    pids_filepath = os.path.join(os.getcwd(), ConfigWatcherPidFile)
     py_pid = os.getpid()
     with open(pids_filepath, 'w') as f:
         f.write(str(py_pid) + '\n')
 
-    watcher_thread = Thread(target = syslogconfig_watcher, args = [hutil_log_error, hutil_log_info])
-    watcher_thread.start()
-    watcher_thread.join()
-
-    return 0, ""
-
-def transformconfig():
-    """
-    Take care of setting up agent transformation configuration change watcher
-    """
-    pids_filepath = os.path.join(os.getcwd(), 'amatransformconfig.pid')
-    py_pid = os.getpid()
-    with open(pids_filepath, 'w') as f:
-        f.write(str(py_pid) + '\n')
-
-    watcher_thread = Thread(target = transformconfig_watcher, args = [hutil_log_error, hutil_log_info])
+    watcher_thread = Thread(target = config_watcher, args = [hutil_log_error, hutil_log_info])
     watcher_thread.start()
     watcher_thread.join()
 
@@ -2417,9 +3274,7 @@ operations = {'Disable' : disable,
               'Install' : install,
               'Enable' : enable,
               'Update' : update,
-              'Metrics' : metrics,
-              'Syslogconfig' : syslogconfig,
-              'Transformconfig' : transformconfig
+              'Configwatcher' : configwatcher
 }
 
 
@@ -2434,7 +3289,8 @@ def parse_context(operation):
         try:
 
             logFileName = 'extension.log'
-            hutil = HUtil.HandlerUtility(waagent.Log, waagent.Error, logFileName=logFileName)
+            hutil = HUtil.HandlerUtility(waagent.Log, waagent.Error, logFileName=logFileName,
+                                         protected_settings_cache=get_protected_settings_cache())
             hutil.do_parse_context(operation)
 
             # As per VM extension team, we have to manage rotation for our extension.log
@@ -2507,7 +3363,55 @@ def find_package_manager(operation):
         log_and_exit(operation, UnsupportedOperatingSystem, "The OS has neither rpm nor dpkg" )
 
 
+def get_distro_detection_key():
+    """
+    Return the stat of the distribution files find_vm_distro parses.
+    An OS upgrade rewrites them, so a change of this key invalidates the cached distro.
+    """
+    key = []
+    for path in DistroDetectionFiles:
+        try:
+            key.append(get_file_stat_key(path))
+        except OSError:
+            key.append(None)
+    return key
+
 def find_vm_distro(operation):
+    """
+    Returns the Linux Distribution and version this VM is running on.
+    The result of detect_vm_distro is cached in memory and in the extension
+    directory, so that each handler invocation parses the distribution files
+    only when they changed.
+    """
+    global DistroCache
+
+    key = get_distro_detection_key()
+    if DistroCache is not None and DistroCache['key'] == key:
+        return DistroCache['dist'], DistroCache['ver']
+
+    cache_path = os.path.join(os.getcwd(), DistroCacheFile)
+    try:
+        with open(cache_path, 'r') as f:
+            cache = json.load(f)
+        if cache['key'] == key:
+            DistroCache = cache
+            return cache['dist'], cache['ver']
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        pass
+
+    vm_dist, vm_ver = detect_vm_distro(operation)
+    # Round trip through json so that the in-memory key compares equal to a freshly computed one
+    DistroCache = json.loads(json.dumps({'key' : key, 'dist' : vm_dist, 'ver' : vm_ver}))
+    try:
+        tmp_path = cache_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(DistroCache, f)
+        os.rename(tmp_path, cache_path)
+    except (IOError, OSError) as ex:
+        hutil_log_info("Could not cache the detected distro in {0}: {1}".format(cache_path, ex))
+    return vm_dist, vm_ver
+
+def detect_vm_distro(operation):
     """
     Finds the Linux Distribution this VM is running on by directly parsing
     distribution-specific files for reliable detection.
@@ -2693,6 +3597,44 @@ def find_vm_distro(operation):
     
     return vm_dist.lower(), vm_ver.lower()
 
+def get_supported_distro_index(arch):
+    """
+    Return the supported_distros matrix of the given architecture as a
+    dictionary of distribution -> set of supported version tuples, e.g.
+    {'ubuntu' : set([(18, 4), ...]), ...}, built once per architecture
+    """
+    if arch not in SupportedDistroIndex:
+        if arch == 'aarch64':
+            supported_dists = supported_distros.supported_dists_aarch64
+        else:
+            supported_dists = supported_distros.supported_dists_x86_64
+        SupportedDistroIndex[arch] = dict((dist, set(tuple(int(num) for num in ver.split('.')) for ver in vers))
+                                          for dist, vers in supported_dists.items())
+    return SupportedDistroIndex[arch]
+
+def is_distro_supported(vm_dist, vm_ver, arch):
+    """
+    Check vm_dist and vm_ver against the supported distros matrix.
+    A supported distribution matches the beginning of vm_dist, and vm_ver
+    must be at least as precise (at least as many digits) as a supported
+    version and match all of its digits.
+    """
+    index = get_supported_distro_index(arch)
+    vm_ver_nums = []
+    for num in vm_ver.split('.'):
+        try:
+            vm_ver_nums.append(int(num))
+        except ValueError:
+            break
+    for length in range(1, len(vm_dist) + 1):
+        supported_vers = index.get(vm_dist[:length])
+        if supported_vers is None:
+            continue
+        for ver_length in range(1, len(vm_ver_nums) + 1):
+            if tuple(vm_ver_nums[:ver_length]) in supported_vers:
+                return True
+    return False
+
 def is_vm_supported_for_extension(operation):
     """
     Checks if the VM this extension is running on is supported by AzureMonitorAgent
@@ -2703,43 +3645,8 @@ def is_vm_supported_for_extension(operation):
     this VM extension. All other distros will get error code 51
     """
 
-    if platform.machine() == 'aarch64':
-        supported_dists = supported_distros.supported_dists_aarch64
-    else:
-        supported_dists = supported_distros.supported_dists_x86_64
-
-    vm_supported = False
     vm_dist, vm_ver = find_vm_distro(operation)
-    # Find this VM distribution in the supported list
-    for supported_dist in list(supported_dists.keys()):
-        if not vm_dist.startswith(supported_dist):
-            continue
-
-        # Check if this VM distribution version is supported
-        vm_ver_split = vm_ver.split('.')
-        for supported_ver in supported_dists[supported_dist]:
-            supported_ver_split = supported_ver.split('.')
-
-            # If vm_ver is at least as precise (at least as many digits) as
-            # supported_ver and matches all the supported_ver digits, then
-            # this VM is guaranteed to be supported
-            vm_ver_match = True
-            for idx, supported_ver_num in enumerate(supported_ver_split):
-                try:
-                    supported_ver_num = int(supported_ver_num)
-                    vm_ver_num = int(vm_ver_split[idx])
-                except IndexError:
-                    vm_ver_match = False
-                    break
-                if vm_ver_num != supported_ver_num:
-                    vm_ver_match = False
-                    break
-            if vm_ver_match:
-                vm_supported = True
-                break
-
-        if vm_supported:
-            break
+    vm_supported = is_distro_supported(vm_dist, vm_ver, platform.machine())
 
     return vm_supported, vm_dist, vm_ver
 
@@ -2764,7 +3671,8 @@ def is_feature_enabled(feature):
         'useDynamicSSL'             : ['all'],
         'enableCMV2'                : ['all'],
         'enableAzureOTelCollector'  : ['all'],
-        'enableCurlUpload'          : ['eastus2euap', 'centraluseuap']
+        'enableCurlUpload'          : ['eastus2euap', 'centraluseuap'],
+        'consolidateTelegrafInputs' : ['eastus2euap', 'centraluseuap']
     }
     
     featurePreviewFlagPath = PreviewFeaturesDirectory + feature
@@ -2821,84 +3729,155 @@ def copy_astextension_binaries():
         if f != 'AstExtension' and f != 'appsettings.json':
             os.remove(os.path.join(astextension_bin, f))
 
-    for f in os.listdir(astextension_bin_local_path):
-        compare_and_copy_bin(astextension_bin_local_path + f, astextension_bin + f)
+    stage_binaries([(astextension_bin_local_path + f, astextension_bin + f) for f in os.listdir(astextension_bin_local_path)])
 
 
-def is_arc_installed():
+def get_azure_environment_and_region():
     """
-    Check if this is an Arc machine
+    Retreive the Azure environment and region from Azure or Arc IMDS, through the instance document cache shared
+    with the metrics setup
     """
-    # Using systemctl to check this since Arc only supports VMs that have systemd
-    check_arc = os.system('systemctl status himdsd 1>/dev/null 2>&1')
-    return check_arc == 0
-
+    environment = region = None
 
-def get_arc_endpoint():
-    """
-    Find the endpoint for Arc IMDS
-    """
-    endpoint_filepath = '/lib/systemd/system.conf.d/azcmagent.conf'
-    endpoint = ''
     try:
-        with open(endpoint_filepath, 'r') as f:
-            data = f.read()
-        endpoint = data.split("\"IMDS_ENDPOINT=")[1].split("\"\n")[0]
-    except:
-        hutil_log_error('Unable to load Arc IMDS endpoint from {0}'.format(endpoint_filepath))
-    return endpoint
+        # A single attempt, callers like is_feature_enabled fall back to defaults when IMDS is not reachable
+        response = imds_client.get_imds_instance(False, HUtilObject, max_attempts=1)
 
+        if ('azEnvironment' in response['compute']):
+            environment = response['compute']['azEnvironment'].lower()
+        if ('location' in response['compute']):
+            region = response['compute']['location'].lower()
+    except Exception as e:
+        hutil_log_error('Unexpected error from Metadata service: {0}'.format(e))
 
-def get_imds_endpoint():
-    """
-    Find the appropriate endpoint (Azure or Arc) for IMDS
-    """
-    azure_imds_endpoint = 'http://169.254.169.254/metadata/instance?api-version=2018-10-01'
-    if (is_arc_installed()):
-        hutil_log_info('Arc is installed, loading Arc-specific IMDS endpoint')
-        imds_endpoint = get_arc_endpoint()
-        if imds_endpoint:
-            imds_endpoint += '/metadata/instance?api-version=2019-08-15'
-        else:
-            # Fall back to the traditional IMDS endpoint; the cloud domain and VM
-            # resource id detection logic are resilient to failed queries to IMDS
-            imds_endpoint = azure_imds_endpoint
-            hutil_log_info('Falling back to default Azure IMDS endpoint')
-    else:
-        imds_endpoint = azure_imds_endpoint
+    hutil_log_info('Detected environment: {0}, region: {1}'.format(environment, region))
 
-    hutil_log_info('Using IMDS endpoint "{0}"'.format(imds_endpoint))
-    return imds_endpoint
+    return environment, region
 
 
-def get_azure_environment_and_region():
-    """
-    Retreive the Azure environment and region from Azure or Arc IMDS
-    """
-    imds_endpoint = get_imds_endpoint()
-    req = urllib.Request(imds_endpoint)
-    req.add_header('Metadata', 'True')
+class OperationTimings(object):
+    """
+    Durations of the phases of one handler operation, such as commands, binary
+    staging or proxy setup. Phases are aggregated by name into a count and a
+    total duration, so they can be recorded from any thread. The phase named
+    after the operation itself spans most of the others.
+    """
+    def __init__(self, operation, clock = time.time):
+        self.operation = operation
+        self.clock = clock
+        self.start_time = clock()
+        self.phases = OrderedDict()
+        self.lock = Lock()
+        # Whether the record changed since it was last saved, an operation is saved at least once
+        self.dirty = True
+
+    def record(self, phase, seconds):
+        with self.lock:
+            count, total = self.phases.get(phase, (0, 0.0))
+            self.phases[phase] = (count + 1, total + seconds)
+            self.dirty = True
+
+    def span(self, phase, flush = False):
+        return TimingSpan(self, phase, flush)
+
+    def get_record(self):
+        with self.lock:
+            phases = dict((phase, {'count' : count, 'seconds' : round(total, 3)})
+                          for phase, (count, total) in self.phases.items())
+        return {'operation' : self.operation,
+                'start' : datetime.datetime.utcfromtimestamp(self.start_time).strftime('%Y-%m-%dT%H:%M:%SZ'),
+                'seconds' : round(self.clock() - self.start_time, 3),
+                'phases' : phases}
+
+    def get_summary(self, max_phases = TimingsSummaryPhases):
+        """
+        Return the total duration and the slowest phases as one line for the status message
+        """
+        record = self.get_record()
+        phases = [phase for phase in record['phases'].items() if phase[0] != self.operation]
+        slowest = sorted(phases, key = lambda phase: -phase[1]['seconds'])[:max_phases]
+        return 'Timings: {0:.1f}s total; {1}'.format(record['seconds'], ', '.join(
+            '{0} {1:.1f}s ({2}x)'.format(phase, data['seconds'], data['count']) for phase, data in slowest))
 
-    environment = region = None
+    def save(self, path = None):
+        """
+        Append the timings record to the timings file, rotating it once it exceeds TimingsFileMaxBytes
+        """
+        path = path if path is not None else TimingsFilePath
+        with self.lock:
+            self.dirty = False
+        # Before the package is installed or after a complete uninstall, don't recreate the data directory
+        if not os.path.isdir(os.path.dirname(path)):
+            return
+        try:
+            if os.path.exists(path) and os.path.getsize(path) > TimingsFileMaxBytes:
+                os.rename(path, path + '.1')
+            with open(path, 'a') as f:
+                f.write(json.dumps(self.get_record(), sort_keys=True) + '\n')
+        except (IOError, OSError) as e:
+            hutil_log_info('Failed to write {0}: {1}'.format(path, e))
+
+    def flush(self, path = None):
+        """
+        Save the timings record if phases were recorded since the last save, so the phases that finished are kept
+        even if the handler is killed before it exits
+        """
+        with self.lock:
+            dirty = self.dirty
+        if dirty:
+            self.save(path)
+
+class TimingSpan(object):
+    """
+    Context manager recording the duration of a phase, and with flush, saving the timings once it finishes; does
+    nothing without timings
+    """
+    def __init__(self, timings, phase, flush = False):
+        self.timings = timings
+        self.phase = phase
+        self.flush = flush
+        self.start_time = None
+
+    def __enter__(self):
+        if self.timings is not None:
+            self.start_time = self.timings.clock()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self.timings is not None:
+            self.timings.record(self.phase, self.timings.clock() - self.start_time)
+            if self.flush:
+                self.timings.flush()
+        return False
 
-    try:
-        response = json.loads(urllib.urlopen(req).read().decode('utf-8', 'ignore'))
-
-        if ('compute' in response):
-            if ('azEnvironment' in response['compute']):
-                environment = response['compute']['azEnvironment'].lower()
-            if ('location' in response['compute']):
-                region = response['compute']['location'].lower()
-    except urlerror.HTTPError as e:
-        hutil_log_error('Request to Metadata service URL failed with an HTTPError: {0}'.format(e))
-        hutil_log_error('Response from Metadata service: {0}'.format(e.read()))
-    except Exception as e:
-        hutil_log_error('Unexpected error from Metadata service: {0}'.format(e))
+def timing_span(phase, flush = False):
+    """
+    Time a phase of the current operation, saving the timings once it finishes with flush
+    """
+    return TimingSpan(OperationTimingsObject, phase, flush)
 
-    hutil_log_info('Detected environment: {0}, region: {1}'.format(environment, region))
+def get_command_phase(cmd):
+    """
+    Name the timing phase of a command after its executable, leaving out
+    arguments and environment assignments, which might contain PII
+    """
+    for token in cmd.split():
+        if '=' not in token:
+            return 'command ' + os.path.basename(token)
+    return 'command'
 
-    return environment, region
+def finish_operation_timings():
+    """
+    Save the timings of the current operation and return their summary
+    """
+    global OperationTimingsObject
 
+    if OperationTimingsObject is None:
+        return ''
+    timings = OperationTimingsObject
+    OperationTimingsObject = None
+    timings.flush()
+    return timings.get_summary()
 
 def run_command_and_log(cmd, check_error = True, log_cmd = True, log_output = True):
     """
@@ -2907,7 +3886,8 @@ def run_command_and_log(cmd, check_error = True, log_cmd = True, log_output = Tr
     The output should not contain any PII, but the command might. In this case,
     log_cmd should be set to False.
     """
-    exit_code, output = run_get_output(cmd, check_error, log_cmd)
+    with timing_span(get_command_phase(cmd)):
+        exit_code, output = run_get_output(cmd, check_error, log_cmd)
     if log_cmd:
         hutil_log_info('Output of command "{0}": \n{1}'.format(cmd.rstrip(), output))
     elif log_output:
@@ -2946,18 +3926,19 @@ def run_command_with_retries_output(cmd, retries, retry_check, final_check = Non
     run_cmd = cmd
     run_verbosely = False
 
-    while try_count <= retries:
-        if run_verbosely:
-            run_cmd = cmd + ' -v'
-        exit_code, output = run_command_and_log(run_cmd, check_error, log_cmd)
-        should_retry, retry_message, run_verbosely = retry_check(exit_code,
-                                                                 output)
-        if not should_retry:
-            break
-        try_count += 1
-        hutil_log_info(retry_message)
-        time.sleep(sleep_time)
-        sleep_time *= sleep_increase_factor
+    with timing_span(get_command_phase(cmd) + ' with retries'):
+        while try_count <= retries:
+            if run_verbosely:
+                run_cmd = cmd + ' -v'
+            exit_code, output = run_command_and_log(run_cmd, check_error, log_cmd)
+            should_retry, retry_message, run_verbosely = retry_check(exit_code,
+                                                                     output)
+            if not should_retry:
+                break
+            try_count += 1
+            hutil_log_info(retry_message)
+            time.sleep(sleep_time)
+            sleep_time *= sleep_increase_factor
 
     if final_check is not None:
         exit_code = final_check(exit_code, output)
@@ -3007,6 +3988,175 @@ def final_check_if_dpkg_or_rpm_locked(exit_code, output):
         exit_code = DPKGOrRPMLockedErrorCode
     return exit_code
 
+def is_tmpfs(path):
+    """
+    Check if path is on a tmpfs or ramfs mount, i.e. never written to disk
+    """
+    path = os.path.realpath(path)
+    fs_type = None
+    mount_point = ''
+    try:
+        with open('/proc/mounts', 'r') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount = fields[1]
+                if (path == mount or path.startswith(mount.rstrip('/') + '/')) and len(mount) >= len(mount_point):
+                    mount_point = mount
+                    fs_type = fields[2]
+    except IOError:
+        return False
+    return fs_type in ('tmpfs', 'ramfs')
+
+class ProtectedSettingsCache(object):
+    """
+    Decrypted protectedSettings keyed by sequence number, certificate
+    thumbprint and a hash of the encrypted settings, so that openssl is forked
+    once per settings change rather than once per handler or watcher process.
+    Entries are shared between processes through a root-only directory when
+    it is on tmpfs, and kept in memory only otherwise. Only the latest entry
+    is kept, and disable and uninstall clear the cache.
+    """
+    def __init__(self, cache_dir = None, create = True):
+        self.cache_dir = cache_dir if cache_dir is not None else ProtectedSettingsCacheDir
+        self.entries = {}
+        self.shared = self.init_cache_dir() if create else False
+
+    def init_cache_dir(self):
+        parent = os.path.dirname(self.cache_dir.rstrip('/'))
+        if os.getuid() != 0 or not os.path.isdir(parent) or not is_tmpfs(parent):
+            return False
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.mkdir(self.cache_dir, 0o700)
+            st = os.lstat(self.cache_dir)
+            if not stat.S_ISDIR(st.st_mode) or st.st_uid != 0:
+                hutil_log_error('Not caching protected settings in {0}: not a directory owned by root'.format(self.cache_dir))
+                return False
+            os.chmod(self.cache_dir, 0o700)
+            return True
+        except OSError as e:
+            hutil_log_info('Not caching protected settings in {0}: {1}'.format(self.cache_dir, e))
+            return False
+
+    def get_key(self, seq_no, thumbprint, settings):
+        key = '{0}:{1}:{2}'.format(seq_no, thumbprint, sha256(settings.encode('utf-8')).hexdigest())
+        return sha256(key.encode('utf-8')).hexdigest()
+
+    def get(self, seq_no, thumbprint, settings):
+        key = self.get_key(seq_no, thumbprint, settings)
+        if key not in self.entries and self.shared:
+            try:
+                with open(os.path.join(self.cache_dir, key), 'rb') as f:
+                    self.entries[key] = f.read().decode('utf-8')
+            except (IOError, OSError):
+                return None
+        return self.entries.get(key)
+
+    def put(self, seq_no, thumbprint, settings, decrypted):
+        if isinstance(decrypted, bytes):
+            decrypted = decrypted.decode('utf-8')
+        key = self.get_key(seq_no, thumbprint, settings)
+        self.entries = {key : decrypted}
+        if not self.shared:
+            return
+        # Do not keep the secrets of previous settings around, even if the new ones cannot be written
+        self.remove_entries(keep = key)
+        try:
+            tmp_path = os.path.join(self.cache_dir, key + '.tmp')
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_NOFOLLOW', 0), 0o600)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(decrypted.encode('utf-8'))
+            os.rename(tmp_path, os.path.join(self.cache_dir, key))
+        except (IOError, OSError) as e:
+            hutil_log_info('Failed to cache protected settings: {0}'.format(e))
+
+    def remove_entries(self, keep = None):
+        try:
+            for name in os.listdir(self.cache_dir):
+                if name != keep:
+                    os.remove(os.path.join(self.cache_dir, name))
+        except (IOError, OSError) as e:
+            hutil_log_error('Failed to remove cached protected settings: {0}'.format(e))
+
+    def clear(self):
+        """
+        Forget the decrypted settings, in memory and in the shared directory
+        """
+        self.entries = {}
+        self.shared = False
+        if os.path.isdir(self.cache_dir) and not os.path.islink(self.cache_dir):
+            self.remove_entries()
+            try:
+                os.rmdir(self.cache_dir)
+            except OSError as e:
+                hutil_log_error('Failed to remove {0}: {1}'.format(self.cache_dir, e))
+
+def get_protected_settings_cache():
+    global ProtectedSettingsCacheObject
+    if ProtectedSettingsCacheObject is None:
+        ProtectedSettingsCacheObject = ProtectedSettingsCache()
+    return ProtectedSettingsCacheObject
+
+def clear_protected_settings_cache():
+    """
+    Remove the decrypted protectedSettings, so they do not outlive the extension on the host
+    """
+    global ProtectedSettingsCacheObject
+    if ProtectedSettingsCacheObject is None:
+        ProtectedSettingsCacheObject = ProtectedSettingsCache(cache_dir = None, create = False)
+    ProtectedSettingsCacheObject.clear()
+
+def decrypt_protected_settings(encoded_settings, settings_thumbprint, seq_no = None):
+    """
+    Decrypt protectedSettings with the certificate of the given thumbprint,
+    unless they were decrypted before for this sequence number.
+    Returns the decrypted settings, or None if they could not be decrypted.
+    """
+    cache = get_protected_settings_cache()
+    protected_settings_str = cache.get(seq_no, settings_thumbprint, encoded_settings)
+    if protected_settings_str:
+        hutil_log_info('Using cached decrypted protectedSettings.')
+        return protected_settings_str
+
+    encoded_cert_path = os.path.join('/var/lib/waagent',
+                                     '{0}.crt'.format(
+                                               settings_thumbprint))
+    encoded_key_path = os.path.join('/var/lib/waagent',
+                                    '{0}.prv'.format(
+                                              settings_thumbprint))
+    decoded_settings = base64.standard_b64decode(encoded_settings)
+
+    # FIPS 140-3: use 'openssl cms' (supports AES256 & DES_EDE3_CBC) with fallback to legacy 'openssl smime'
+    cms_cmd = 'openssl cms -inform DER -decrypt -recip {0} -inkey {1}'.format(encoded_cert_path, encoded_key_path)
+    smime_cmd = 'openssl smime -inform DER -decrypt -recip {0} -inkey {1}'.format(encoded_cert_path, encoded_key_path)
+
+    for decrypt_cmd in [cms_cmd, smime_cmd]:
+        try:
+            # stderr is intentionally captured separately from stdout (and never
+            # logged verbatim) so that non-fatal openssl warnings (e.g. a missing
+            # openssl.cnf) can't get concatenated with the decrypted output, corrupt the
+            # JSON payload, and risk the decrypted secret being echoed in error handling.
+            session = subprocess.Popen([decrypt_cmd], shell=True,
+                                       stdin=subprocess.PIPE,
+                                       stderr=subprocess.PIPE,
+                                       stdout=subprocess.PIPE)
+            output = session.communicate(decoded_settings)
+            # success only if return code is 0 and we have output
+            if session.returncode == 0 and output[0]:
+                if decrypt_cmd == cms_cmd:
+                    hutil_log_info('Decrypted protectedSettings using openssl cms.')
+                else:
+                    hutil_log_info('Decrypted protectedSettings using openssl smime fallback.')
+                cache.put(seq_no, settings_thumbprint, encoded_settings, output[0])
+                return cache.get(seq_no, settings_thumbprint, encoded_settings)
+            else:
+                hutil_log_info('Attempt to decrypt protectedSettings with "{0}" failed (rc={1}).'.format(decrypt_cmd, session.returncode))
+        except OSError:
+            pass
+    return None
+
 def get_settings():
     """
     Retrieve the configuration for this extension operation
@@ -3046,46 +4196,9 @@ def get_settings():
                 and 'protectedSettingsCertThumbprint' in h_settings
                 and h_settings['protectedSettings'] is not None
                 and h_settings['protectedSettingsCertThumbprint'] is not None):
-            encoded_settings = h_settings['protectedSettings']
-            settings_thumbprint = h_settings['protectedSettingsCertThumbprint']
-            encoded_cert_path = os.path.join('/var/lib/waagent',
-                                             '{0}.crt'.format(
-                                                       settings_thumbprint))
-            encoded_key_path = os.path.join('/var/lib/waagent',
-                                            '{0}.prv'.format(
-                                                      settings_thumbprint))
-            decoded_settings = base64.standard_b64decode(encoded_settings)
-
-
-             # FIPS 140-3: use 'openssl cms' (supports AES256 & DES_EDE3_CBC) with fallback to legacy 'openssl smime'
-            cms_cmd = 'openssl cms -inform DER -decrypt -recip {0} -inkey {1}'.format(encoded_cert_path, encoded_key_path)
-            smime_cmd = 'openssl smime -inform DER -decrypt -recip {0} -inkey {1}'.format(encoded_cert_path, encoded_key_path)
-
-            protected_settings_str = None
-            for decrypt_cmd in [cms_cmd, smime_cmd]:
-                try:
-                    # stderr is intentionally captured separately from stdout (and never
-                    # logged verbatim) so that non-fatal openssl warnings (e.g. a missing
-                    # openssl.cnf) can't get concatenated with the decrypted output, corrupt the
-                    # JSON payload, and risk the decrypted secret being echoed in error handling.
-                    session = subprocess.Popen([decrypt_cmd], shell=True,
-                                               stdin=subprocess.PIPE,
-                                               stderr=subprocess.PIPE,
-                                               stdout=subprocess.PIPE)
-                    output = session.communicate(decoded_settings)
-                    # success only if return code is 0 and we have output
-                    if session.returncode == 0 and output[0]:
-                        protected_settings_str = output[0]
-                        if decrypt_cmd == cms_cmd:
-                            hutil_log_info('Decrypted protectedSettings using openssl cms.')
-                        else:
-                            hutil_log_info('Decrypted protectedSettings using openssl smime fallback.')
-                        break
-                    else:
-                        hutil_log_info('Attempt to decrypt protectedSettings with "{0}" failed (rc={1}).'.format(decrypt_cmd, session.returncode))
-                except OSError:
-                    pass
-
+            protected_settings_str = decrypt_protected_settings(h_settings['protectedSettings'],
+                                                                h_settings['protectedSettingsCertThumbprint'],
+                                                                seq_no)
             if protected_settings_str is None:
                 log_and_exit('Enable', GenericErrorCode, 'Failed decrypting protectedSettings')
             protected_settings = ''
@@ -3172,22 +4285,17 @@ def get_latest_seq_no():
             config_dir = os.path.join(os.getcwd(), 'config')
 
         latest_seq_no = -1
-        cur_seq_no = -1
         latest_time = None
         try:
-            for dir_name, sub_dirs, file_names in os.walk(config_dir):
-                for file_name in file_names:
-                    file_basename = os.path.basename(file_name)
-                    match = re.match(r'[0-9]{1,10}\.settings', file_basename)
-                    if match is None:
-                        continue
-                    cur_seq_no = int(file_basename.split('.')[0])
-                    file_path = os.path.join(config_dir, file_name)
-                    cur_time = os.path.getmtime(file_path)
-                    if latest_time is None or cur_time > latest_time:
-                        latest_time = cur_time
-                        latest_seq_no = cur_seq_no
-        except:
+            for file_name in os.listdir(config_dir):
+                match = SettingsFilePattern.match(file_name)
+                if match is None:
+                    continue
+                cur_time = os.path.getmtime(os.path.join(config_dir, file_name))
+                if latest_time is None or cur_time > latest_time:
+                    latest_time = cur_time
+                    latest_seq_no = int(match.group(1))
+        except OSError:
             pass
         if latest_seq_no < 0:
             latest_seq_no = 0
@@ -3299,6 +4407,10 @@ def log_and_exit(operation, exit_code = GenericErrorCode, message = ''):
     """
     Log the exit message and perform the exit
     """
+    timings_summary = finish_operation_timings()
+    if timings_summary:
+        message = '{0}\n{1}'.format(message, timings_summary)
+
     if exit_code == 0:
         waagent_log_info(message)
         hutil_log_info(message)
@@ -5,8 +5,14 @@ Unit tests for AzureMonitorAgent/agent.py - pure logic functions only.
 
 import sys
 import os
+import json
 import re
+import shutil
+import subprocess
+import tempfile
+import time
 import unittest
+from threading import Timer
 from unittest.mock import patch, MagicMock
 
 # Mock Linux-only modules before importing
@@ -31,6 +37,7 @@ for mod_name in (
     'metrics_ext_utils.metrics_constants',
     'metrics_ext_utils.metrics_ext_handler',
     'metrics_ext_utils.metrics_common_utils',
+    'metrics_ext_utils.imds_client',
 ):
     if mod_name in sys.modules:
         continue
@@ -430,5 +437,758 @@ class TestEnableCurlUploadConfig(unittest.TestCase):
         self.assertNotIn("ENABLE_CURL_UPLOAD", configs)
 
 
+class TestConfigFileWatcher(unittest.TestCase):
+    """Tests for ConfigFileWatcher change detection with inotify and with polling."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'metricCounters.json')
+        self.missing = os.path.join(self.tmpdir, 'fluentbit', 'td-agent.conf')
+        self._log = patch('agent.hutil_log_info')
+        self._log.start()
+
+    def tearDown(self):
+        self._log.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, path, content):
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def _check_changes(self, watcher):
+        self._write(self.path, '[]')
+        self.assertEqual(watcher.wait(0), [self.path])
+        self.assertEqual(watcher.wait(0), [])
+
+        # Rewriting the same content is not a change
+        self._write(self.path, '[]')
+        self.assertEqual(watcher.wait(0.5), [])
+
+        self._write(self.path, '[{"counter": 1}]')
+        self.assertEqual(watcher.wait(5), [self.path])
+
+        # A file created in a directory that did not exist yet is picked up
+        os.makedirs(os.path.dirname(self.missing))
+        self._write(self.missing, 'Port 28230')
+        self.assertEqual(watcher.wait(5), [self.missing])
+
+        os.remove(self.path)
+        self.assertEqual(watcher.wait(5), [self.path])
+
+    def test_inotify(self):
+        watcher = agent.ConfigFileWatcher([self.path, self.missing], poll_interval=0.1, settle_time=0)
+        try:
+            self.assertIsNotNone(watcher.fd)
+            self._check_changes(watcher)
+        finally:
+            watcher.close()
+
+    def test_inotify_notifies_without_polling(self):
+        watcher = agent.ConfigFileWatcher([self.path], poll_interval=60, settle_time=0)
+        try:
+            watcher.wait(0)
+            start = time.time()
+            Timer(0.1, self._write, [self.path, 'data']).start()
+            self.assertEqual(watcher.wait(10), [self.path])
+            self.assertLess(time.time() - start, 5)
+        finally:
+            watcher.close()
+
+    def test_polling(self):
+        watcher = agent.ConfigFileWatcher([self.path, self.missing], poll_interval=0.1, use_inotify=False)
+        self.assertIsNone(watcher.fd)
+        self._check_changes(watcher)
+
+    def test_polling_skips_unchanged_stat(self):
+        watcher = agent.ConfigFileWatcher([self.path], use_inotify=False)
+        self._write(self.path, 'data')
+        self.assertEqual(watcher.check(), [self.path])
+        with patch('agent.open', create=True) as mock_open:
+            self.assertEqual(watcher.check(), [])
+            mock_open.assert_not_called()
+
+
+class TestConfigHandlers(unittest.TestCase):
+    """Tests for dispatching config changes to the syslog and transform config handlers."""
+
+    @patch('agent.restart_astextension')
+    @patch('agent.read_config_file', return_value='marker')
+    def test_transform_restarts_on_change_only(self, mock_read, mock_restart):
+        handler = agent.TransformConfigHandler(MagicMock(), MagicMock())
+        handler.run([], True)
+        mock_restart.assert_not_called()
+        handler.run([agent.AMAAstTransformConfigMarkerPath], False)
+        mock_restart.assert_called_once_with()
+
+    @patch('agent.remove_localsyslog_configs')
+    @patch('agent.generate_localsyslog_configs')
+    @patch('agent.get_control_plane_mode', return_value=(False, True))
+    def test_syslog_runs_on_change_or_periodically(self, mock_mode, mock_generate, mock_remove):
+        handler = agent.SyslogConfigHandler(MagicMock(), MagicMock())
+        with patch('os.path.isfile', return_value=True), \
+                patch('agent.read_config_file', return_value='true'):
+            handler.run([agent.MdsdCounterJsonPath], False)
+            mock_generate.assert_not_called()
+            handler.run([agent.AMASyslogConfigMarkerPath], False)
+            mock_generate.assert_called_once_with(uses_gcs=False, uses_mcs=True)
+        with patch('os.path.isfile', return_value=False):
+            handler.run([], True)
+            mock_remove.assert_called_once_with()
+
+
+class TestConfigRendering(unittest.TestCase):
+    """Tests for rendering syslog and fluent-bit configs and writing them only when they change."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'azuremonitoragent-tcp.conf')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_render_syslog_port(self):
+        template = 'action(type="omfwd" Target="127.0.0.1" Port="28330" Protocol="tcp")\n'
+        self.assertEqual(agent.render_config(template, agent.RsyslogPortPattern, 'Port="1234"'),
+                         'action(type="omfwd" Target="127.0.0.1" Port="1234" Protocol="tcp")\n')
+        self.assertEqual(agent.render_config('network("127.0.0.1" port(28330));', agent.SyslogNgPortPattern,
+                                             r'port(1\2)'), r'network("127.0.0.1" port(1\2));')
+
+    def test_render_fluent_port(self):
+        content = '[INPUT]\n    Name forward\n    Port 28230\n    Buffer_Chunk_Size 1m'
+        self.assertEqual(agent.render_config(content, agent.FluentPortPattern, '    Port 1234\n'),
+                         '[INPUT]\n    Name forward\n    Port 1234\n    Buffer_Chunk_Size 1m')
+
+    def test_write_only_when_changed(self):
+        self.assertTrue(agent.write_config_if_changed(self.path, 'port(1234)\n'))
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o644)
+        mtime = os.stat(self.path).st_mtime_ns
+        self.assertFalse(agent.write_config_if_changed(self.path, 'port(1234)\n'))
+        self.assertEqual(os.stat(self.path).st_mtime_ns, mtime)
+        self.assertTrue(agent.write_config_if_changed(self.path, 'port(5678)\n'))
+        with open(self.path) as f:
+            self.assertEqual(f.read(), 'port(5678)\n')
+        self.assertEqual(os.listdir(self.tmpdir), ['azuremonitoragent-tcp.conf'])
+
+
+class TestPackageInventory(unittest.TestCase):
+    """Tests for answering package presence and version checks from one cached package query."""
+
+    DpkgOutput = ('ii \trsyslog\trsyslog_8.2302.0-1\n'
+                  'rc \twhich\twhich_2.21-1\n'
+                  'un \tsyslog-ng\tsyslog-ng_\n'
+                  'ii \tazuremonitoragent\tazuremonitoragent_1.33.1\n')
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.status = os.path.join(self.tmpdir, 'status')
+        with open(self.status, 'w') as f:
+            f.write('Package: rsyslog\n')
+        patcher = patch.multiple(agent, PackageManager='dpkg', PackageInventoryCache=None,
+                                 PackageDatabasePaths={'dpkg' : [self.status]})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_parse_inventory(self):
+        packages = agent.parse_package_inventory(self.DpkgOutput)
+        self.assertEqual(packages, {'rsyslog' : ['rsyslog_8.2302.0-1'], 'which' : ['which_2.21-1'],
+                                    'azuremonitoragent' : ['azuremonitoragent_1.33.1']})
+
+    @patch('agent.run_command_and_log')
+    def test_single_query_until_database_changes(self, mock_run):
+        mock_run.return_value = (0, self.DpkgOutput)
+        self.assertTrue(agent.is_package_installed('rsyslog'))
+        self.assertFalse(agent.is_package_installed('syslog-ng'))
+        self.assertEqual(agent.get_installed_package_version(), (True, ['azuremonitoragent_1.33.1']))
+        self.assertEqual(mock_run.call_count, 1)
+
+        with open(self.status, 'a') as f:
+            f.write('Package: azuremonitoragent\n')
+        mock_run.return_value = (0, 'ii \trsyslog\trsyslog_8.2302.0-1\n')
+        self.assertEqual(agent.get_installed_package_version(), (False, []))
+        self.assertEqual(mock_run.call_count, 2)
+
+    @patch('agent.run_command_and_log', return_value=(1, ''))
+    def test_failed_query_is_not_cached(self, mock_run):
+        self.assertFalse(agent.is_package_installed('rsyslog'))
+        self.assertFalse(agent.is_package_installed('rsyslog'))
+        self.assertEqual(mock_run.call_count, 2)
+
+
+class TestDistroDetection(unittest.TestCase):
+    """Tests for caching the detected distro and looking it up in the supported distros matrix."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.os_release = os.path.join(self.tmpdir, 'os-release')
+        with open(self.os_release, 'w') as f:
+            f.write('ID=ubuntu\nVERSION_ID="22.04"\n')
+        patcher = patch.multiple(agent, DistroCache=None, DistroDetectionFiles=[self.os_release])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    @patch('agent.detect_vm_distro', return_value=('ubuntu', '22.04'))
+    def test_cached_until_distro_files_change(self, mock_detect):
+        self.assertEqual(agent.find_vm_distro('Enable'), ('ubuntu', '22.04'))
+        self.assertEqual(agent.find_vm_distro('Enable'), ('ubuntu', '22.04'))
+        # A new handler invocation reads the cache from the extension directory
+        agent.DistroCache = None
+        self.assertEqual(agent.find_vm_distro('Enable'), ('ubuntu', '22.04'))
+        self.assertEqual(mock_detect.call_count, 1)
+        self.assertTrue(os.path.exists(os.path.join(self.tmpdir, agent.DistroCacheFile)))
+
+        with open(self.os_release, 'w') as f:
+            f.write('ID=ubuntu\nVERSION_ID="24.04"\n')
+        mock_detect.return_value = ('ubuntu', '24.04')
+        self.assertEqual(agent.find_vm_distro('Enable'), ('ubuntu', '24.04'))
+        self.assertEqual(mock_detect.call_count, 2)
+
+    def test_supported_distros(self):
+        self.assertTrue(agent.is_distro_supported('ubuntu', '22.04', 'x86_64'))
+        self.assertFalse(agent.is_distro_supported('ubuntu', '22', 'x86_64'))
+        self.assertFalse(agent.is_distro_supported('ubuntu', '21.04', 'x86_64'))
+        self.assertTrue(agent.is_distro_supported('sles_sap', '15', 'x86_64'))
+        self.assertTrue(agent.is_distro_supported('amzn', '2023', 'x86_64'))
+        self.assertFalse(agent.is_distro_supported('amzn', '2023', 'aarch64'))
+        self.assertTrue(agent.is_distro_supported('redhat', '9', 'aarch64'))
+        self.assertFalse(agent.is_distro_supported('redhat', '7', 'aarch64'))
+        self.assertFalse(agent.is_distro_supported('centos', '7', 'x86_64'))
+        self.assertFalse(agent.is_distro_supported('debian', 'trixie', 'x86_64'))
+
+
+class TestPackageFilesCleanup(unittest.TestCase):
+    """Tests for the manifest driven, resumable removal of package files on uninstall."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.data = os.path.join(self.tmpdir, 'azuremonitoragent')
+        self.outside = os.path.join(self.tmpdir, 'outside')
+        for d in ['log', 'events/a', 'events/b']:
+            os.makedirs(os.path.join(self.data, d))
+            with open(os.path.join(self.data, d, 'file'), 'w') as f:
+                f.write('x' * 10)
+        os.makedirs(self.outside)
+        with open(os.path.join(self.outside, 'keep'), 'w') as f:
+            f.write('keep')
+        os.symlink(self.outside, os.path.join(self.data, 'link'))
+        patcher = patch.multiple(agent, PackageCleanupJournalPath=os.path.join(self.tmpdir, 'journal.json'),
+                                 PackageFilesManifestPath=os.path.join(self.tmpdir, 'manifest.json'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_collapse_nested_paths(self):
+        self.assertEqual(agent._collapse_cleanup_paths(['/opt/ama/bin/x', '/opt/ama/', '/opt/ama-other', '/etc/ama.conf']),
+                         ['/etc/ama.conf', '/opt/ama', '/opt/ama-other'])
+
+    def test_remove_tree_without_following_symlinks(self):
+        removed, freed = agent._remove_cleanup_paths([self.data, os.path.join(self.data, 'log', 'file')])
+        self.assertFalse(os.path.exists(self.data))
+        self.assertTrue(os.path.exists(os.path.join(self.outside, 'keep')))
+        self.assertEqual(freed, 30)
+        # 3 files, 5 directories and the symlink
+        self.assertEqual(removed, 9)
+        self.assertFalse(os.path.exists(agent.PackageCleanupJournalPath))
+
+    def test_files_created_during_cleanup_are_counted(self):
+        run_in_parallel = agent.run_in_parallel
+
+        def run_and_write(func, items, max_workers):
+            results = run_in_parallel(func, items, max_workers)
+            # Written after the directory was listed, removed by the directory pass
+            with open(os.path.join(self.data, 'late'), 'w') as f:
+                f.write('x' * 5)
+            return results
+        with patch('agent.run_in_parallel', side_effect=run_and_write):
+            removed, freed = agent._remove_cleanup_paths([self.data])
+        self.assertFalse(os.path.exists(self.data))
+        self.assertEqual(freed, 35)
+        self.assertEqual(removed, 10)
+
+    def test_resume_interrupted_cleanup(self):
+        agent._write_json_file(agent.PackageCleanupJournalPath, {'paths' : [self.data]})
+        agent.resume_package_files_cleanup()
+        self.assertFalse(os.path.exists(self.data))
+        self.assertFalse(os.path.exists(agent.PackageCleanupJournalPath))
+
+    @patch('agent.run_command_and_log')
+    def test_recorded_files_are_used(self, mock_run):
+        with patch('agent.PackageManager', 'dpkg'):
+            mock_run.return_value = (0, '/etc\n/etc/opt/microsoft/azuremonitoragent\n/lib/systemd/system/azuremonitoragent.service\n')
+            agent.record_package_files()
+            mock_run.return_value = (1, '')
+            self.assertEqual(agent._get_package_files_for_cleanup(),
+                             ['/etc/opt/microsoft/azuremonitoragent', '/lib/systemd/system/azuremonitoragent.service'])
+        self.assertEqual(mock_run.call_count, 1)
+
+
+class TestOperationTimings(unittest.TestCase):
+    """Tests for recording per-phase durations of handler operations."""
+
+    def setUp(self):
+        self.now = 100.0
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'timings.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        agent.OperationTimingsObject = None
+
+    def test_command_phase_hides_arguments(self):
+        self.assertEqual(agent.get_command_phase('DEBIAN_FRONTEND=noninteractive apt-get install -y rsyslog'),
+                         'command apt-get')
+        self.assertEqual(agent.get_command_phase('/usr/bin/rpm -e azuremonitoragent'), 'command rpm')
+
+    @patch('agent.run_get_output')
+    def test_spans_are_aggregated(self, mock_run):
+        agent.OperationTimingsObject = agent.OperationTimings('Install', clock=lambda: self.now)
+
+        def run(cmd, check_error, log_cmd):
+            self.now += 2
+            return 0, ''
+        mock_run.side_effect = run
+        with agent.timing_span('stage binaries'):
+            self.now += 3
+        agent.run_command_and_log('systemctl daemon-reload')
+        agent.run_command_and_log('systemctl restart azuremonitoragent')
+
+        record = agent.OperationTimingsObject.get_record()
+        self.assertEqual(record['seconds'], 7)
+        self.assertEqual(record['phases'], {'stage binaries' : {'count' : 1, 'seconds' : 3},
+                                            'command systemctl' : {'count' : 2, 'seconds' : 4}})
+        self.assertEqual(agent.OperationTimingsObject.get_summary(),
+                         'Timings: 7.0s total; command systemctl 4.0s (2x), stage binaries 3.0s (1x)')
+
+    def test_summary_leaves_out_the_operation_span(self):
+        agent.OperationTimingsObject = agent.OperationTimings('Enable', clock=lambda: self.now)
+        with agent.timing_span('Enable'):
+            with agent.timing_span('proxy setup'):
+                self.now += 2
+            self.now += 1
+        self.assertEqual(agent.OperationTimingsObject.get_summary(), 'Timings: 3.0s total; proxy setup 2.0s (1x)')
+
+    def test_top_level_spans_are_flushed(self):
+        agent.OperationTimingsObject = agent.OperationTimings('Install', clock=lambda: self.now)
+
+        def read_records():
+            with open(self.path) as f:
+                return [json.loads(line) for line in f]
+        with patch('agent.TimingsFilePath', self.path):
+            with agent.timing_span('parse context', flush=True):
+                self.now += 1
+            self.assertEqual(list(read_records()[-1]['phases']), ['parse context'])
+            with agent.timing_span('Install', flush=True):
+                with agent.timing_span('stage binaries'):
+                    self.now += 3
+                self.assertEqual(len(read_records()), 1)
+            self.assertEqual(read_records()[-1]['phases']['Install'], {'count' : 1, 'seconds' : 3})
+            # Nothing new to save at exit
+            self.assertEqual(agent.finish_operation_timings(), 'Timings: 4.0s total; stage binaries 3.0s (1x), parse context 1.0s (1x)')
+            self.assertEqual(len(read_records()), 2)
+
+    def test_operation_without_phases_is_saved(self):
+        agent.OperationTimingsObject = agent.OperationTimings('Disable', clock=lambda: self.now)
+        with patch('agent.TimingsFilePath', self.path):
+            agent.finish_operation_timings()
+        with open(self.path) as f:
+            self.assertEqual(json.loads(f.readline())['operation'], 'Disable')
+
+    def test_save_without_data_directory_is_skipped(self):
+        timings = agent.OperationTimings('Uninstall', clock=lambda: self.now)
+        path = os.path.join(self.tmpdir, 'removed', 'timings.json')
+        timings.save(path)
+        self.assertFalse(os.path.exists(os.path.dirname(path)))
+
+    def test_save_rotates(self):
+        timings = agent.OperationTimings('Enable', clock=lambda: self.now)
+        with patch('agent.TimingsFileMaxBytes', 100):
+            for _ in range(3):
+                timings.save(self.path)
+        self.assertTrue(os.path.exists(self.path + '.1'))
+        with open(self.path) as f:
+            self.assertEqual(json.loads(f.readline())['operation'], 'Enable')
+
+    def test_no_timings_is_a_noop(self):
+        with agent.timing_span('proxy setup'):
+            pass
+        self.assertEqual(agent.finish_operation_timings(), '')
+
+
+class TestSELinuxPolicy(unittest.TestCase):
+    """Tests for the cached SELinux policy and port label lookup."""
+
+    SemanagePorts = (
+        "SELinux Port Type              Proto    Port Number\n"
+        "\n"
+        "http_port_t                    tcp      80, 81, 443, 28230\n"
+        "syslogd_port_t                 udp      514, 6514\n"
+        "syslogd_port_t                 tcp      601, 20514\n"
+        "unreserved_port_t              tcp      61000-65535, 1024-32767\n"
+    )
+
+    def setUp(self):
+        agent.SELinuxPolicyCache = None
+        self.commands = []
+
+        def run_command(cmd, *args, **kwargs):
+            self.commands.append(cmd)
+            if cmd.startswith('getenforce'):
+                return 1, ''
+            if cmd == 'semanage port -l':
+                return 0, self.SemanagePorts
+            return 0, ''
+
+        self._patches = [
+            patch('agent.run_command_and_log', side_effect=run_command),
+            patch('agent.get_selinux_policy_key', side_effect=lambda: (('/var/lib/selinux/targeted', self.mtime),)),
+            patch('os.path.exists', return_value=True),
+        ]
+        self.mtime = 1
+        for p in self._patches:
+            p.start()
+
+    def tearDown(self):
+        for p in self._patches:
+            p.stop()
+        agent.SELinuxPolicyCache = None
+
+    def test_parse_semanage_ports(self):
+        ports = agent.parse_semanage_ports(self.SemanagePorts)
+        self.assertEqual(ports[('tcp', '28230')], set(['http_port_t']))
+        self.assertEqual(ports[('udp', '514')], set(['syslogd_port_t']))
+        self.assertNotIn(('udp', '601'), ports)
+        # Ranges do not label individual ports
+        self.assertNotIn(('tcp', '2000'), ports)
+
+    def test_policy_is_cached_until_store_changes(self):
+        self.assertTrue(agent.is_selinux_enabled())
+        self.assertEqual(agent.get_selinux_port_types('443'), set(['http_port_t']))
+        self.assertEqual(agent.get_selinux_port_types('28330'), set())
+        self.assertTrue(agent.is_selinux_enabled())
+        self.assertEqual(self.commands.count('semanage port -l'), 1)
+        self.assertEqual(len([c for c in self.commands if c.startswith('getenforce')]), 1)
+
+        self.mtime = 2
+        agent.get_selinux_port_types('443')
+        self.assertEqual(self.commands.count('semanage port -l'), 2)
+
+    def test_allow_port_only_labels_unlabelled_ports(self):
+        agent.allow_selinux_port('20514', 'syslogd_port_t')
+        agent.allow_selinux_port('28330', 'syslogd_port_t')
+        labels = [c for c in self.commands if c.startswith('semanage port -a')]
+        self.assertEqual(labels, ['semanage port -a -t syslogd_port_t -p tcp 28330'])
+        # Adding a label invalidates the cached policy
+        self.assertIsNone(agent.SELinuxPolicyCache)
+
+    def test_disabled(self):
+        with patch('agent.run_command_and_log', return_value=(0, 'Disabled')) as mock_run:
+            self.assertFalse(agent.is_selinux_enabled())
+            agent.allow_selinux_port('28330', 'syslogd_port_t')
+            self.assertEqual(mock_run.call_count, 1)
+
+
+class TestBinaryStaging(unittest.TestCase):
+    """Tests for hash-cached, atomic binary staging and ELF dependency checks."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmpdir, 'mdsd_x86_64')
+        self.dest = os.path.join(self.tmpdir, 'mdsd')
+        self.manifest_path = os.path.join(self.tmpdir, 'binaries.manifest.json')
+        with open(self.src, 'wb') as f:
+            f.write(b'binary v1')
+        self._log = patch('agent.hutil_log_info')
+        self._log.start()
+
+    def tearDown(self):
+        self._log.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def _stage(self):
+        manifest = agent.BinaryManifest(self.manifest_path)
+        with patch('agent.copyfile', side_effect=shutil.copyfile) as mock_copy:
+            agent.compare_and_copy_bin(self.src, self.dest, manifest)
+        manifest.save()
+        return mock_copy.call_count
+
+    def test_copies_only_on_hash_mismatch(self):
+        self.assertEqual(self._stage(), 1)
+        self.assertEqual(self._stage(), 0)
+        self.assertFalse(os.path.exists(self.dest + '.tmp'))
+        self.assertTrue(os.stat(self.dest).st_mode & 0o111)
+
+        inode = os.stat(self.dest).st_ino
+        with open(self.src, 'wb') as f:
+            f.write(b'binary v2')
+        self.assertEqual(self._stage(), 1)
+        with open(self.dest, 'rb') as f:
+            self.assertEqual(f.read(), b'binary v2')
+        # The binary is replaced through a rename, not rewritten in place
+        self.assertNotEqual(os.stat(self.dest).st_ino, inode)
+
+    def test_copies_when_destination_changed(self):
+        self._stage()
+        with open(self.dest, 'wb') as f:
+            f.write(b'replaced by a package upgrade')
+        self.assertEqual(self._stage(), 1)
+
+    def test_manifest_skips_hashing_unchanged_files(self):
+        self._stage()
+        manifest = agent.BinaryManifest(self.manifest_path)
+        with patch('agent.get_file_sha256') as mock_sha:
+            manifest.get_sha256(self.src)
+            manifest.get_sha256(self.dest)
+            mock_sha.assert_not_called()
+
+    def test_stage_binaries(self):
+        binaries = []
+        for i in range(6):
+            src = os.path.join(self.tmpdir, 'src{0}'.format(i))
+            with open(src, 'w') as f:
+                f.write(str(i))
+            binaries.append((src, os.path.join(self.tmpdir, 'dest{0}'.format(i))))
+        with patch('agent.BinaryManifestPath', self.manifest_path):
+            agent.stage_binaries(binaries)
+        for i, (_, dest) in enumerate(binaries):
+            with open(dest) as f:
+                self.assertEqual(f.read(), str(i))
+
+    def test_run_in_parallel(self):
+        self.assertEqual(agent.run_in_parallel(lambda x: x * 2, range(10), 3), [x * 2 for x in range(10)])
+        self.assertRaises(ValueError, agent.run_in_parallel, int, ['1', 'x', '3'])
+
+    @unittest.skipUnless(os.path.isfile('/bin/ls'), 'requires an ELF binary')
+    def test_elf_dependencies(self):
+        info = agent.read_elf_dynamic_info('/bin/ls')
+        self.assertIn('libc.so.6', info['needed'])
+        self.assertIsNone(agent.read_elf_dynamic_info(self.src))
+        self.assertEqual(agent.find_missing_elf_dependencies('/bin/ls'), [])
+        self.assertIn('libc.so.6', agent.find_missing_elf_dependencies('/bin/ls', search_dirs=[]))
+
+    def _find_missing_with_fake_libs(self, libs):
+        def read_info(path):
+            info = {'is_64' : True, 'machine' : 62, 'needed' : [], 'rpath' : [], 'runpath' : []}
+            info.update(libs[path])
+            return info
+        with patch('agent.read_elf_dynamic_info', side_effect=read_info), \
+             patch('os.path.isfile', side_effect=lambda path: path in libs):
+            return agent.find_missing_elf_dependencies('/opt/bin/mdsd', search_dirs=['/usr/lib'])
+
+    def test_elf_dependencies_inherit_executable_rpath(self):
+        libs = {
+            '/opt/bin/mdsd' : {'needed' : ['libx.so'], 'rpath' : ['$ORIGIN/../lib']},
+            '/opt/bin/../lib/libx.so' : {'needed' : ['liby.so']},
+            '/opt/bin/../lib/liby.so' : {},
+        }
+        self.assertEqual(self._find_missing_with_fake_libs(libs), [])
+        # DT_RUNPATH disables the inherited DT_RPATH
+        libs['/opt/bin/../lib/libx.so']['runpath'] = ['/nowhere']
+        self.assertEqual(self._find_missing_with_fake_libs(libs), ['liby.so'])
+
+    def test_ld_so_cache_dirs(self):
+        cache_path = os.path.join(self.tmpdir, 'ld.so.cache')
+        with open(cache_path, 'wb') as f:
+            f.write(b'glibc-ld.so.cache1.1\x00\x01libfoo.so.1\x00/opt/foo/lib/libfoo.so.1\x00'
+                    b'libbar.so\x00/usr/lib/bar/libbar.so\x00/opt/foo/lib/libfoo2.so.3\x00')
+        self.assertEqual(agent.get_ld_so_cache_dirs(cache_path), ['/opt/foo/lib', '/usr/lib/bar'])
+        self.assertEqual(agent.get_ld_so_cache_dirs(os.path.join(self.tmpdir, 'missing')), [])
+        self.assertIn('/usr/lib/bar', agent.get_library_search_dirs(os.path.join(self.tmpdir, 'missing'), cache_path))
+
+
+class TestProtectedSettingsCache(unittest.TestCase):
+    """Tests for caching decrypted protected settings per sequence number."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmpdir, 'settings')
+        self._patches = [
+            patch('agent.is_tmpfs', return_value=True),
+            patch('os.getuid', return_value=0),
+            patch('agent.hutil_log_info'),
+            patch('agent.ProtectedSettingsCacheDir', self.cache_dir),
+            patch('agent.ProtectedSettingsCacheObject', None),
+        ]
+        for p in self._patches:
+            p.start()
+
+    def tearDown(self):
+        for p in self._patches:
+            p.stop()
+        shutil.rmtree(self.tmpdir)
+
+    @unittest.skipUnless(hasattr(os, 'geteuid') and os.geteuid() == 0, 'requires root')
+    def test_shared_between_processes(self):
+        cache = agent.ProtectedSettingsCache()
+        self.assertTrue(cache.shared)
+        self.assertIsNone(cache.get(1, 'THUMB', 'MIIB=='))
+        cache.put(1, 'THUMB', 'MIIB==', b'{"secret": 1}')
+
+        other = agent.ProtectedSettingsCache()
+        self.assertEqual(other.get(1, 'THUMB', 'MIIB=='), '{"secret": 1}')
+        self.assertIsNone(other.get(2, 'THUMB', 'MIIB=='))
+        self.assertIsNone(other.get(1, 'OTHER', 'MIIB=='))
+        self.assertIsNone(other.get(1, 'THUMB', 'MIIC=='))
+        self.assertEqual(os.stat(self.cache_dir).st_mode & 0o777, 0o700)
+        for name in os.listdir(self.cache_dir):
+            self.assertEqual(os.stat(os.path.join(self.cache_dir, name)).st_mode & 0o777, 0o600)
+
+        # Only the latest settings are kept
+        other.put(2, 'THUMB', 'MIIB==', '{"secret": 2}')
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+        self.assertIsNone(agent.ProtectedSettingsCache().get(1, 'THUMB', 'MIIB=='))
+
+    def test_memory_only_when_not_on_tmpfs(self):
+        with patch('agent.is_tmpfs', return_value=False):
+            cache = agent.ProtectedSettingsCache()
+        self.assertFalse(cache.shared)
+        cache.put(1, 'THUMB', 'MIIB==', '{}')
+        self.assertEqual(cache.get(1, 'THUMB', 'MIIB=='), '{}')
+        self.assertFalse(os.path.exists(self.cache_dir))
+
+    def _write_entries(self, names):
+        os.mkdir(self.cache_dir, 0o700)
+        for name in names:
+            with open(os.path.join(self.cache_dir, name), 'w') as f:
+                f.write('{"secret": 1}')
+
+    def test_put_drops_previous_entries(self):
+        self._write_entries(['old', 'older'])
+        cache = agent.ProtectedSettingsCache()
+        cache.shared = True
+        cache.put(2, 'THUMB', 'MIIB==', '{"secret": 2}')
+        self.assertEqual(os.listdir(self.cache_dir), [cache.get_key(2, 'THUMB', 'MIIB==')])
+
+    @patch('agent.hutil_log_error')
+    def test_clear_removes_cache_dir(self, mock_error):
+        self._write_entries(['entry'])
+        agent.clear_protected_settings_cache()
+        self.assertFalse(os.path.exists(self.cache_dir))
+        self.assertIsNone(agent.ProtectedSettingsCacheObject.get(1, 'THUMB', 'MIIB=='))
+        mock_error.assert_not_called()
+        # Clearing again, or without a cache directory, is fine
+        agent.clear_protected_settings_cache()
+        mock_error.assert_not_called()
+
+    @patch('subprocess.Popen')
+    def test_decrypt_once_per_sequence_number(self, mock_popen):
+        mock_popen.return_value.communicate.return_value = (b'{"key": "value"}', b'')
+        mock_popen.return_value.returncode = 0
+        for _ in range(3):
+            self.assertEqual(agent.decrypt_protected_settings('MIIB', 'THUMB', 4), '{"key": "value"}')
+        self.assertEqual(mock_popen.call_count, 1)
+        agent.decrypt_protected_settings('MIIB', 'THUMB', 5)
+        self.assertEqual(mock_popen.call_count, 2)
+
+
+class TestGetLatestSeqNo(unittest.TestCase):
+    """Tests for finding the latest settings sequence number."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self._patches = [
+            patch('agent.SettingsSequenceNumber', None),
+            patch('agent.get_handler_env', return_value={'handlerEnvironment': {'configFolder': self.tmpdir}}),
+        ]
+        for p in self._patches:
+            p.start()
+
+    def tearDown(self):
+        for p in self._patches:
+            p.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def test_latest_by_mtime(self):
+        for i, name in enumerate(['1.settings', '12.settings', '3.settings', '20.status', 'HandlerState']):
+            path = os.path.join(self.tmpdir, name)
+            open(path, 'w').close()
+            mtime = 1000 + (100 if name == '3.settings' else i)
+            os.utime(path, (mtime, mtime))
+        self.assertEqual(agent.get_latest_seq_no(), 3)
+
+    def test_no_settings(self):
+        self.assertEqual(agent.get_latest_seq_no(), 0)
+
+
+class TestProcessSupervisor(unittest.TestCase):
+    """Tests for restarting supervised processes with backoff and a restart budget."""
+
+    def setUp(self):
+        self.now = 1000.0
+        self.running = False
+        self.restarts = []
+
+    def _supervisor(self, **kwargs):
+        return agent.ProcessSupervisor('Telegraf', '/nonexistent/telegraf', lambda: self.running,
+                                       lambda: self.restarts.append(self.now), MagicMock(), MagicMock(),
+                                       clock=lambda: self.now, **kwargs)
+
+    def _run(self, supervisor, seconds):
+        for _ in range(int(seconds)):
+            supervisor.check()
+            self.now += 1
+
+    def test_exponential_backoff(self):
+        supervisor = self._supervisor(backoff=5, max_backoff=40, budget=100)
+        self._run(supervisor, 200)
+        intervals = [b - a for a, b in zip(self.restarts, self.restarts[1:])]
+        self.assertEqual(intervals[:5], [5, 10, 20, 40, 40])
+        self.assertEqual(supervisor.get_next_wakeup(), self.restarts[-1] + 40)
+
+    def test_restart_budget(self):
+        supervisor = self._supervisor(backoff=1, max_backoff=1, budget=3, budget_window=100)
+        self._run(supervisor, 50)
+        self.assertEqual(len(self.restarts), 3)
+        self.assertTrue(supervisor.get_metrics()['budgetExhausted'])
+        # Restarts resume once the window has passed
+        self._run(supervisor, 60)
+        self.assertEqual(self.restarts[3], self.restarts[0] + 100)
+
+    def test_recovery_metrics(self):
+        supervisor = self._supervisor(backoff=5)
+        self._run(supervisor, 7)
+        self.running = True
+        self._run(supervisor, 1)
+        metrics = supervisor.get_metrics()
+        self.assertEqual(metrics['restarts'], 2)
+        self.assertEqual(metrics['recoveries'], 1)
+        self.assertEqual(metrics['lastTimeToRecoverSeconds'], 7)
+        self.assertEqual(metrics['consecutiveFailures'], 0)
+        self.assertIsNone(supervisor.get_next_wakeup())
+
+    @unittest.skipUnless(hasattr(os, 'pidfd_open'), 'requires pidfd support')
+    def test_pidfd_wakes_up_watcher(self):
+        sleep_bin = os.path.realpath(shutil.which('sleep'))
+        proc = subprocess.Popen([sleep_bin, '30'])
+        supervisor = agent.ProcessSupervisor('sleep', sleep_bin, lambda: proc.poll() is None,
+                                             MagicMock(), MagicMock(), MagicMock())
+        watcher = agent.ConfigFileWatcher([], use_inotify=False)
+        try:
+            supervisor.check()
+            self.assertIsNotNone(supervisor.fileno())
+            self.assertTrue(supervisor.is_alive())
+            Timer(0.1, proc.kill).start()
+            start = time.time()
+            watcher.wait(10, [supervisor.fileno()])
+            self.assertLess(time.time() - start, 5)
+            proc.wait()
+            self.assertFalse(supervisor.is_alive())
+            self.assertIsNone(supervisor.fileno())
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+            supervisor.detach()
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -28,7 +28,6 @@ import threading
 import time
 import traceback
 import xml.etree.ElementTree as ET
-import json
 
 # Just wanted to be able to run 'python diagnostic.py ...' from a local dev box where there's no waagent.
 # Actually waagent import can succeed even on a Linux machine without waagent installed,
@@ -78,7 +77,6 @@ RunGetOutput = None  # External command executor callable
 hutil = None  # Handler util object
 enable_metrics_ext = False #Flag to enable/disable MetricsExtension
 enable_telegraf = False #Flag to enable/disable Telegraf
-me_msi_token_expiry_epoch = None
 
 
 
@@ -284,7 +282,6 @@ def main(command):
     init_globals()
 
     global g_ext_op_type
-    global me_msi_token_expiry_epoch
 
     g_ext_op_type = get_extension_operation_type(command)
     waagent_ext_event_type = wala_event_type_for_telemetry(g_ext_op_type)
@@ -376,34 +373,7 @@ def main(command):
 
                 if enable_metrics_ext:
                     # Generate/regenerate MSI Token required by ME
-                    generate_token = False
-                    me_token_path = g_ext_dir + "/metrics_configs/AuthToken-MSI.json"
-
-                    if me_msi_token_expiry_epoch is None or me_msi_token_expiry_epoch == "":
-                        if os.path.isfile(me_token_path):
-                            with open(me_token_path, "r") as f:
-                                authtoken_content = f.read()
-                                if authtoken_content and "expires_on" in authtoken_content:
-                                    me_msi_token_expiry_epoch = authtoken_content["expires_on"]
-                                else:
-                                    generate_token = True
-                        else:
-                            generate_token = True
-
-                    if me_msi_token_expiry_epoch:
-                        currentTime = datetime.datetime.now()
-                        token_expiry_time = datetime.datetime.fromtimestamp(me_msi_token_expiry_epoch)
-                        if token_expiry_time - currentTime < datetime.timedelta(minutes=30):
-                            # The MSI Token will expire within 30 minutes. We need to refresh the token
-                            generate_token = True
-
-                    if generate_token:
-                        generate_token = False
-                        msi_token_generated, me_msi_token_expiry_epoch, log_messages = me_handler.generate_MSI_token()
-                        if msi_token_generated:
-                            hutil.log("Successfully refreshed metrics-extension MSI Auth token.")
-                        else:
-                            hutil.error(log_messages)
+                    me_handler.get_msi_token_manager(log_info=hutil.log, log_error=hutil.error).ensure_token()
 
                     start_metrics_out, log_messages = me_handler.start_metrics(is_lad=True)
                     if start_metrics_out:
@@ -634,37 +604,8 @@ def start_mdsd(configurator):
                             hutil.error("MetricsExtension binary process is not running. Failed to restart after {0} retries. Please check /var/log/syslog for ME logs".format(max_restart_retries))
                     else:
                         me_restart_retries = 0
-                    # 6. Regenerate the MSI auth token required for ME if it is nearing expiration
-                    # Generate/regenerate MSI Token required by ME
-                    global me_msi_token_expiry_epoch
-                    generate_token = False
-                    me_token_path = g_ext_dir + "/config/metrics_configs/AuthToken-MSI.json"
-
-                    if me_msi_token_expiry_epoch is None  or me_msi_token_expiry_epoch == "":
-                        if os.path.isfile(me_token_path):
-                            with open(me_token_path, "r") as f:
-                                authtoken_content = json.loads(f.read())
-                                if authtoken_content and "expires_on" in authtoken_content:
-                                    me_msi_token_expiry_epoch = authtoken_content["expires_on"]
-                                else:
-                                    generate_token = True
-                        else:
-                            generate_token = True
-
-                    if me_msi_token_expiry_epoch:
-                        currentTime = datetime.datetime.now()
-                        token_expiry_time = datetime.datetime.fromtimestamp(float(me_msi_token_expiry_epoch))
-                        if token_expiry_time - currentTime < datetime.timedelta(minutes=30):
-                            # The MSI Token will expire within 30 minutes. We need to refresh the token
-                            generate_token = True
-
-                    if generate_token:
-                        generate_token = False
-                        msi_token_generated, me_msi_token_expiry_epoch, log_messages = me_handler.generate_MSI_token()
-                        if msi_token_generated:
-                            hutil.log("Successfully refreshed metrics-extension MSI Auth token.")
-                        else:
-                            hutil.error(log_messages)
+                    # 6. Regenerate the MSI auth token required for ME once half of its lifetime has passed
+                    me_handler.get_msi_token_manager(log_info=hutil.log, log_error=hutil.error).ensure_token()
 
             # Out of the inner while loop: mdsd terminated.
             if mdsd_stdout_stream:
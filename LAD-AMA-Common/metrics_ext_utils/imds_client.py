@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+#
+# Azure Linux extension
+#
+# Copyright (c) Microsoft Corporation
+# All rights reserved.
+# MIT License
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the ""Software""), to deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+# Software.
+# THE SOFTWARE IS PROVIDED *AS IS*, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+# WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# This File contains the IMDS (or Arc HIMDS) client shared by the MetricsExtension and telegraf setup of LAD and AMA.
+# The instance document is cached on disk for a few minutes, so one enable queries IMDS once.
+
+import json
+import os
+import random
+import time
+import metrics_ext_utils.metrics_common_utils as metrics_utils
+
+try:
+    import urllib.request as urllib # Python 3+
+except ImportError:
+    import urllib2 as urllib # Python 2
+
+ImdsInstanceUrl = "http://169.254.169.254/metadata/instance?api-version=2019-03-11"
+ArcImdsInstancePath = "/metadata/instance?api-version=2019-11-01"
+
+# Shared by the LAD and AMA handlers, and cleared on reboot since the VM may have been resized or redeployed
+ImdsCachePath = "/var/run/azure-linux-extensions-imds-instance.json"
+ImdsCacheTtlSeconds = 600
+
+ImdsRequestTimeoutSeconds = 5
+ImdsMaxAttempts = 4
+ImdsBackoffBaseSeconds = 1
+ImdsBackoffMaxSeconds = 8
+
+# (timestamp, instance document) already read by this process, keyed by url
+InstanceCache = {}
+# Instance document url resolved by this process, keyed by is_lad, so the Arc check runs once
+InstanceUrls = {}
+
+
+def log_message(message, HUtilObj=None):
+    if HUtilObj is not None:
+        HUtilObj.log(message)
+    else:
+        print('Info: {0}'.format(message))
+
+
+def get_imds_instance_url(is_lad, refresh=False):
+    """
+    Return the url of the instance document, from Arc HIMDS for AMA on Arc machines and from Azure IMDS otherwise.
+    The url is resolved once per process unless refresh is set.
+    """
+    if not refresh and is_lad in InstanceUrls:
+        return InstanceUrls[is_lad]
+    url = ImdsInstanceUrl
+    if not is_lad and metrics_utils.is_arc_installed():
+        try:
+            url = metrics_utils.get_arc_endpoint() + ArcImdsInstancePath
+        except Exception:
+            # Fall back to Azure IMDS, the callers fail on the missing keys if it is not reachable either
+            pass
+    InstanceUrls[is_lad] = url
+    return url
+
+
+def get_backoff_delay(attempt):
+    """
+    Return the sleep before retry number attempt (0 based): the exponential delay, capped, with half of it jittered
+    so the handlers of many VMs started together do not retry in lockstep
+    """
+    delay = min(ImdsBackoffMaxSeconds, ImdsBackoffBaseSeconds * (2 ** attempt))
+    return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+
+def is_cache_fresh(timestamp, now):
+    return 0 <= now - timestamp < ImdsCacheTtlSeconds
+
+
+def read_instance_cache(url, now):
+    """
+    Return the (timestamp, instance document) cached on disk for url if it is younger than ImdsCacheTtlSeconds,
+    None otherwise
+    """
+    try:
+        with open(ImdsCachePath, "r") as f:
+            cache = json.load(f)
+        if cache["url"] == url and is_cache_fresh(cache["timestamp"], now) and "compute" in cache["data"]:
+            return cache["timestamp"], cache["data"]
+    except Exception:
+        # A missing, unreadable or corrupted cache only costs an IMDS query
+        pass
+    return None
+
+
+def write_instance_cache(url, data, now):
+    """
+    Atomically replace the instance document cached on disk
+    """
+    temp_path = ImdsCachePath + ".tmp." + str(os.getpid())
+    try:
+        with open(temp_path, "w") as f:
+            json.dump({"url": url, "timestamp": now, "data": data}, f)
+        os.chmod(temp_path, 0o600)
+        os.rename(temp_path, ImdsCachePath)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def query_imds_instance(url, HUtilObj=None, max_attempts=None):
+    """
+    Query the instance document, retrying with jittered exponential backoff until it has the compute key
+    """
+    if max_attempts is None:
+        max_attempts = ImdsMaxAttempts
+    for attempt in range(max_attempts):
+        data = None
+        try:
+            req = urllib.Request(url, headers={'Metadata':'true'})
+            res = urllib.urlopen(req, timeout=ImdsRequestTimeoutSeconds)
+            data = json.loads(res.read().decode('utf-8', 'ignore'))
+        except Exception as e:
+            log_message("IMDS query to {0} failed: {1}".format(url, e), HUtilObj)
+
+        if isinstance(data, dict) and "compute" in data:
+            return data
+
+        if attempt + 1 < max_attempts:
+            time.sleep(get_backoff_delay(attempt))
+
+    raise Exception("Unable to find 'compute' key in imds query response. Reached max retry limit of - {0} times.".format(max_attempts))
+
+
+def get_imds_instance(is_lad, HUtilObj=None, refresh=False, max_attempts=None):
+    """
+    Return the IMDS instance document of this VM, from the process or on-disk cache when it is fresh enough
+    :param is_lad: Boolean value for whether the extension is Lad or not (AMA)
+    :param refresh: Skip the caches, including the resolved url, and query IMDS
+    :param max_attempts: Number of queries before giving up, ImdsMaxAttempts by default
+    """
+    url = get_imds_instance_url(is_lad, refresh)
+
+    if not refresh:
+        now = time.time()
+        if url in InstanceCache and is_cache_fresh(InstanceCache[url][0], now):
+            return InstanceCache[url][1]
+        cached = read_instance_cache(url, now)
+        if cached is not None:
+            InstanceCache[url] = cached
+            return cached[1]
+
+    log_message("IMDS url to query: " + url, HUtilObj)
+    data = query_imds_instance(url, HUtilObj, max_attempts)
+    now = time.time()
+    write_instance_cache(url, data, now)
+    InstanceCache[url] = (now, data)
+    return data
@@ -30,6 +30,8 @@ import subprocess
 import time
 import signal
 import metrics_ext_utils.metrics_common_utils as metrics_utils
+import metrics_ext_utils.imds_client as imds_client
+import metrics_ext_utils.msi_token_manager as msi_token_manager
 
 try:
     import urllib.request as urllib # Python 3+
@@ -162,143 +164,116 @@ def remove_metrics_service(is_lad):
 
     return True, "Successfully removed metrics-extensions service and MetricsExtension binary."
 
-def generate_Arc_MSI_token(resource = "https://ingestion.monitor.azure.com/"):
+def get_me_auth_file_path():
     """
-    This method is used to query the Hyrbid metdadata service of Arc to get the MSI Auth token for the VM and write it to the ME config location
-    This is called from the main extension code after config setup is complete
+    Return the path of the MSI auth token file ME reads
     """
     _, configFolder = get_handler_vars()
-    me_config_dir = configFolder + "/metrics_configs/"
-    me_auth_file_path = me_config_dir + "AuthToken-MSI.json"
-    expiry_epoch_time = ""
-    log_messages = ""
-    retries = 1
-    max_retries = 3
-    sleep_time = 5
+    return configFolder + "/metrics_configs/AuthToken-MSI.json"
 
-    if not os.path.exists(me_config_dir):
-        log_messages += "Metrics extension config directory - {0} does not exist. Failed to generate MSI auth token fo ME.\n".format(me_config_dir)
-        return False, expiry_epoch_time, log_messages
-    try:
-        data = None
-        while retries <= max_retries:
-            arc_endpoint = metrics_utils.get_arc_endpoint()
-            try:
-                msiauthurl = arc_endpoint + "/metadata/identity/oauth2/token?api-version=2019-11-01&resource=" + resource
-                req = urllib.Request(msiauthurl, headers={'Metadata':'true'})
-                res = urllib.urlopen(req)
-            except:
-                # The above request is expected to fail and add a key to the path
-                authkey_dir = "/var/opt/azcmagent/tokens/"
-                if not os.path.exists(authkey_dir):
-                    log_messages += "Unable to find the auth key file at {0} returned from the arc msi auth request.".format(authkey_dir)
-                    return False, expiry_epoch_time, log_messages
-                keys_dir = []
-                for filename in os.listdir(authkey_dir):
-                    keys_dir.append(filename)
 
-                authkey_path = authkey_dir + keys_dir[-1]
-                auth = "basic "
-                with open(authkey_path, "r") as f:
-                    key = f.read()
-                auth += key
-                req = urllib.Request(msiauthurl, headers={'Metadata':'true', 'authorization':auth})
-                res = urllib.urlopen(req)
-                data = json.loads(res.read().decode('utf-8', 'ignore'))
+# Bound on each identity endpoint request, so a hung endpoint cannot hold the token refresh forever
+MsiTokenRequestTimeoutSeconds = 30
 
-            if not data or "access_token" not in data:
-                retries += 1
-            else:
-                break
-
-            log_messages += "Failed to fetch MSI Auth url. Retrying in {2} seconds. Retry Count - {0} out of Mmax Retries - {1}\n".format(retries, max_retries, sleep_time)
-            time.sleep(sleep_time)
-
-
-        if retries > max_retries:
-            log_messages += "Unable to generate a valid MSI auth token at {0}.\n".format(me_auth_file_path)
-            return False, expiry_epoch_time, log_messages
 
-        with open(me_auth_file_path, "w") as f:
-            f.write(json.dumps(data))
+def fetch_Arc_MSI_token(resource = "https://ingestion.monitor.azure.com/"):
+    """
+    Query the Hybrid metadata service of Arc for the MSI auth token of the machine and return the token response
+    """
+    max_retries = 3
+    arc_endpoint = metrics_utils.get_arc_endpoint()
+    msiauthurl = arc_endpoint + "/metadata/identity/oauth2/token?api-version=2019-11-01&resource=" + resource
 
-        if "expires_on" in data:
-            expiry_epoch_time  = data["expires_on"]
-        else:
-            log_messages += "Error parsing the msi token at {0} for the token expiry time. Failed to generate the correct token\n".format(me_auth_file_path)
-            return False, expiry_epoch_time, log_messages
+    for retry in range(max_retries):
+        try:
+            req = urllib.Request(msiauthurl, headers={'Metadata':'true'})
+            res = urllib.urlopen(req, timeout=MsiTokenRequestTimeoutSeconds)
+        except:
+            # The above request is expected to fail and add a key to the path
+            authkey_dir = "/var/opt/azcmagent/tokens/"
+            if not os.path.exists(authkey_dir):
+                raise Exception("Unable to find the auth key file at {0} returned from the arc msi auth request.".format(authkey_dir))
+            keys_dir = []
+            for filename in os.listdir(authkey_dir):
+                keys_dir.append(filename)
+
+            authkey_path = authkey_dir + keys_dir[-1]
+            auth = "basic "
+            with open(authkey_path, "r") as f:
+                key = f.read()
+            auth += key
+            req = urllib.Request(msiauthurl, headers={'Metadata':'true', 'authorization':auth})
+            res = urllib.urlopen(req, timeout=MsiTokenRequestTimeoutSeconds)
+            data = json.loads(res.read().decode('utf-8', 'ignore'))
+            if data and "access_token" in data:
+                return data
 
-    except Exception as e:
-        log_messages += "Failed to get msi auth token. Please check if VM's system assigned Identity is enabled Failed with error {0}\n".format(e)
-        return False, expiry_epoch_time, log_messages
+        if retry + 1 < max_retries:
+            time.sleep(imds_client.get_backoff_delay(retry))
 
-    return True, expiry_epoch_time, log_messages
+    raise Exception("Unable to fetch a valid MSI auth token after {0} retries.".format(max_retries))
 
 
-def generate_MSI_token(identifier_name = '', identifier_value = '', is_lad = True):
+def fetch_MSI_token(identifier_name = '', identifier_value = ''):
     """
-    This method is used to query the metdadata service to get the MSI Auth token for the VM and write it to the ME config location
-    This is called from the main extension code after config setup is complete
+    Query the metadata service for the MSI auth token of the VM and return the token response
     """
+    max_retries = 3
+    msiauthurl = "http://169.254.169.254/metadata/identity/oauth2/token?api-version=2018-02-01&resource=https://ingestion.monitor.azure.com/"
+    if identifier_name and identifier_value:
+        msiauthurl += '&{0}={1}'.format(identifier_name, identifier_value)
 
-    if metrics_utils.is_arc_installed():
-        _, _, _, az_environment, _ = get_imds_values(is_lad)
-        if az_environment.lower() == ArcACloudName:
-            return generate_Arc_MSI_token("https://monitoring.azs")
-        return generate_Arc_MSI_token()
-    else:
-        _, configFolder = get_handler_vars()
-        me_config_dir = configFolder + "/metrics_configs/"
-        me_auth_file_path = me_config_dir + "AuthToken-MSI.json"
-        expiry_epoch_time = ""
-        log_messages = ""
-        retries = 1
-        max_retries = 3
-        sleep_time = 5
-
-        if not os.path.exists(me_config_dir):
-            log_messages += "Metrics extension config directory - {0} does not exist. Failed to generate MSI auth token for ME.\n".format(me_config_dir)
-            return False, expiry_epoch_time, log_messages
+    for retry in range(max_retries):
         try:
-            data = None
-            while retries <= max_retries:
-                msiauthurl = "http://169.254.169.254/metadata/identity/oauth2/token?api-version=2018-02-01&resource=https://ingestion.monitor.azure.com/"
-
-                if identifier_name and identifier_value:
-                    msiauthurl += '&{0}={1}'.format(identifier_name, identifier_value)
+            req = urllib.Request(msiauthurl, headers={'Metadata':'true', 'Content-Type':'application/json'})
+            res = urllib.urlopen(req, timeout=MsiTokenRequestTimeoutSeconds)
+            data = json.loads(res.read().decode('utf-8', 'ignore'))
+        except Exception as e:
+            raise Exception("Please check if the VM's system assigned identity is enabled or the user assigned identity "
+                            "passed in the extension settings exists and is assigned to this VM. Failed with error {0}".format(e))
+        if data and "access_token" in data:
+            return data
 
-                req = urllib.Request(msiauthurl, headers={'Metadata':'true', 'Content-Type':'application/json'})
-                res = urllib.urlopen(req)
-                data = json.loads(res.read().decode('utf-8', 'ignore'))
+        if retry + 1 < max_retries:
+            time.sleep(imds_client.get_backoff_delay(retry))
 
-                if not data or "access_token" not in data:
-                    retries += 1
-                else:
-                    break
+    raise Exception("Unable to fetch a valid MSI auth token after {0} retries.".format(max_retries))
 
-                log_messages += "Failed to fetch MSI Auth url. Retrying in {2} seconds. Retry Count - {0} out of Mmax Retries - {1}\n".format(retries, max_retries, sleep_time)
-                time.sleep(sleep_time)
 
+# MsiTokenManager of this process, keyed by token file path and identity
+MsiTokenManagers = {}
 
-            if retries > max_retries:
-                log_messages += "Unable to generate a valid MSI auth token at {0}.\n".format(me_auth_file_path)
-                return False, expiry_epoch_time, log_messages
+def get_msi_token_manager(identifier_name = '', identifier_value = '', is_lad = True, log_info = None, log_error = None):
+    """
+    Return the token manager of the ME auth token file for the given identity, the same one for every caller in
+    this process so concurrent refreshes share a single fetch
+    """
+    me_auth_file_path = get_me_auth_file_path()
+    key = (me_auth_file_path, identifier_name, identifier_value)
+    if key not in MsiTokenManagers:
+        def fetch():
+            if metrics_utils.is_arc_installed():
+                _, _, _, az_environment, _ = get_imds_values(is_lad)
+                if az_environment.lower() == ArcACloudName:
+                    return fetch_Arc_MSI_token("https://monitoring.azs")
+                return fetch_Arc_MSI_token()
+            return fetch_MSI_token(identifier_name, identifier_value)
 
-            with open(me_auth_file_path, "w") as f:
-                f.write(json.dumps(data))
+        MsiTokenManagers[key] = msi_token_manager.MsiTokenManager(me_auth_file_path, fetch, log_info = log_info, log_error = log_error)
+    return MsiTokenManagers[key]
 
-            if "expires_on" in data:
-                expiry_epoch_time  = data["expires_on"]
-            else:
-                log_messages += "Error parsing the MSI token at {0} for the token expiry time. Failed to generate the correct token\n".format(me_auth_file_path)
-                return False, expiry_epoch_time, log_messages
 
-        except Exception as e:
-            log_messages += "Failed to get MSI auth token. Please check if the VM's system assigned identity is enabled or the user assigned identity "
-            log_messages += "passed in the extension settings exists and is assigned to this VM. Failed with error {0}\n".format(e)
-            return False, expiry_epoch_time, log_messages
+def generate_MSI_token(identifier_name = '', identifier_value = '', is_lad = True):
+    """
+    Make sure the MSI Auth token for the VM at the ME config location is valid, fetching a new one from the metdadata
+    service once half of its lifetime has passed. The file is replaced atomically.
+    This is called from the main extension code after config setup is complete
+    """
+    me_auth_file_path = get_me_auth_file_path()
+    if not os.path.exists(os.path.dirname(me_auth_file_path)):
+        return False, "", "Metrics extension config directory - {0} does not exist. Failed to generate MSI auth token for ME.\n".format(os.path.dirname(me_auth_file_path))
 
-        return True, expiry_epoch_time, log_messages
+    return get_msi_token_manager(identifier_name, identifier_value, is_lad).ensure_token()
 
 def get_ArcA_MSI_token(resource = "https://monitoring.azs"):
     """
@@ -629,47 +604,10 @@ def get_imds_values(is_lad, HUtilObj=None):
     """
     Query imds to get required values for MetricsExtension config for this VM
     """
-    retries = 1
-    max_retries = 3
-    sleep_time = 5
-    imds_url = ""
-    is_arc = False
-
-    if is_lad:
-        imds_url = "http://169.254.169.254/metadata/instance?api-version=2019-03-11"
-    else:
-        if metrics_utils.is_arc_installed():
-            imds_url = metrics_utils.get_arc_endpoint()
-            imds_url += "/metadata/instance?api-version=2019-11-01"
-            is_arc = True
-        else:
-            imds_url = "http://169.254.169.254/metadata/instance?api-version=2019-03-11"
-
-    message = "IMDS url to query: " + imds_url
-    if HUtilObj is not None:
-        HUtilObj.log(message)
-    else:
-        print('Info: {0}'.format(message))
-
-    data = None
-    while retries <= max_retries:
-
-        try:
-            req = urllib.Request(imds_url, headers={'Metadata':'true'})
-            res = urllib.urlopen(req)
-            data = json.loads(res.read().decode('utf-8', 'ignore'))
-        except:
-            pass
-
-        if "compute" not in data:
-            retries += 1
-        else:
-            break
-
-        time.sleep(sleep_time)
-
-    if retries > max_retries:
-        raise Exception("Unable to find 'compute' key in imds query response. Reached max retry limit of - {0} times. Failed to set up ME.".format(max_retries))
+    try:
+        data = imds_client.get_imds_instance(is_lad, HUtilObj)
+    except Exception as e:
+        raise Exception("{0} Failed to set up ME.".format(e))
 
     if "resourceId" not in data["compute"]:
         raise Exception("Unable to find 'resourceId' key in imds query response. Failed to set up ME.")
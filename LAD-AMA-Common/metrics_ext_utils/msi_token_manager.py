@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+#
+# Azure Linux extension
+#
+# Copyright (c) Microsoft Corporation
+# All rights reserved.
+# MIT License
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the ""Software""), to deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+# Software.
+# THE SOFTWARE IS PROVIDED *AS IS*, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+# WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# This File contains the manager of the MSI auth token file MetricsExtension reads, used by LAD and Azure Monitor Extension
+
+import json
+import os
+import threading
+import time
+
+# Refresh once this fraction of the token lifetime has passed
+MsiTokenRefreshFraction = 0.5
+# Tokens closer than this to their expiry are never handed out or left in place
+MsiTokenMinValiditySeconds = 300
+# Refresh margin for tokens without expires_in, which the lifetime cannot be computed for
+MsiTokenDefaultRefreshMarginSeconds = 1800
+# Wait between failed refreshes
+MsiTokenRetrySeconds = 60
+# Wait for the background refresh to finish on stop, a fetch in flight is bounded by its request timeout
+MsiTokenStopTimeoutSeconds = 5
+
+
+def parse_token(data):
+    """
+    Validate the token response of the identity endpoint and return its expires_on and expires_in (None if missing)
+    as integers
+    """
+    if not isinstance(data, dict) or not data.get("access_token"):
+        raise ValueError("The MSI token response has no access_token")
+    try:
+        expires_on = int(float(data["expires_on"]))
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("Error parsing the MSI token response for the token expiry time")
+    try:
+        expires_in = int(float(data["expires_in"]))
+    except (KeyError, TypeError, ValueError):
+        expires_in = None
+    return expires_on, expires_in
+
+
+class MsiTokenManager(object):
+    """
+    Keep the MSI auth token file of MetricsExtension valid. The token is
+    fetched again once refresh_fraction of its lifetime has passed, either by
+    a caller of get_token or by the background thread of start, and the file
+    is replaced atomically so readers never see a half-written or expired
+    token. Concurrent callers share a single fetch. Refresh latency and
+    failures are exposed through get_metrics.
+    """
+    def __init__(self, token_path, fetch, refresh_fraction = MsiTokenRefreshFraction,
+                 min_validity = MsiTokenMinValiditySeconds, retry_interval = MsiTokenRetrySeconds,
+                 log_info = None, log_error = None, clock = time.time):
+        self.token_path = token_path
+        self.fetch = fetch
+        self.refresh_fraction = refresh_fraction
+        self.min_validity = min_validity
+        self.retry_interval = retry_interval
+        self.log_info = log_info
+        self.log_error = log_error
+        self.clock = clock
+        self.condition = threading.Condition()
+        self.fetching = False
+        self.loaded = False
+        self.token = None
+        self.expires_on = None
+        self.refresh_at = None
+        self.next_attempt = 0
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.refreshes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.last_refresh_latency = None
+        self.max_refresh_latency = None
+        self.last_refresh_time = None
+        self.last_error = None
+
+    def get_refresh_at(self, expires_on, expires_in):
+        if expires_in:
+            refresh_at = expires_on - (1 - self.refresh_fraction) * expires_in
+        else:
+            refresh_at = expires_on - MsiTokenDefaultRefreshMarginSeconds
+        return min(refresh_at, expires_on - self.min_validity)
+
+    def set_token(self, data):
+        expires_on, expires_in = parse_token(data)
+        self.token = data
+        self.expires_on = expires_on
+        self.refresh_at = self.get_refresh_at(expires_on, expires_in)
+
+    def load(self):
+        """
+        Pick up the token file left by a previous run, if it is still valid
+        """
+        self.loaded = True
+        try:
+            with open(self.token_path, "r") as f:
+                self.set_token(json.load(f))
+        except Exception:
+            self.token = self.expires_on = self.refresh_at = None
+
+    def persist(self, data):
+        """
+        Replace the token file atomically, keeping the mode and owner of the file it replaces
+        """
+        temp_path = self.token_path + ".tmp"
+        try:
+            with open(temp_path, "w") as f:
+                f.write(json.dumps(data))
+                f.flush()
+                os.fsync(f.fileno())
+            if os.path.exists(self.token_path):
+                st = os.stat(self.token_path)
+                os.chmod(temp_path, st.st_mode & 0o7777)
+                os.chown(temp_path, st.st_uid, st.st_gid)
+            os.rename(temp_path, self.token_path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def is_usable(self, now):
+        return self.token is not None and self.expires_on - now > self.min_validity
+
+    def refresh(self):
+        """
+        Fetch and persist a new token, or wait for the fetch already in progress
+        """
+        with self.condition:
+            if self.fetching:
+                while self.fetching:
+                    self.condition.wait()
+                return
+            self.fetching = True
+
+        start_time = self.clock()
+        error = None
+        try:
+            data = self.fetch()
+            parse_token(data)
+            self.persist(data)
+        except Exception as e:
+            error = "Failed to refresh the MSI auth token: {0}".format(e)
+        latency = self.clock() - start_time
+
+        with self.condition:
+            now = self.clock()
+            if error is None:
+                self.set_token(data)
+                self.refreshes += 1
+                self.consecutive_failures = 0
+                self.last_refresh_time = now
+                self.next_attempt = 0
+            else:
+                self.failures += 1
+                self.consecutive_failures += 1
+                self.last_error = error
+                self.next_attempt = now + self.retry_interval
+            self.last_refresh_latency = latency
+            self.max_refresh_latency = max(latency, self.max_refresh_latency or 0)
+            self.fetching = False
+            self.condition.notify_all()
+
+        if error is None:
+            if self.log_info is not None:
+                self.log_info("Successfully refreshed metrics-extension MSI Auth token in {0:.1f} seconds.".format(latency))
+        elif self.log_error is not None:
+            self.log_error(error)
+
+    def restore(self):
+        """
+        Write the token held in memory back to the token file, for instance after its directory was recreated, or
+        wait for the fetch or restore already in progress
+        """
+        with self.condition:
+            if self.fetching:
+                while self.fetching:
+                    self.condition.wait()
+                return
+            self.fetching = True
+            data = self.token
+
+        error = None
+        try:
+            self.persist(data)
+        except Exception as e:
+            error = "Failed to restore the MSI auth token file: {0}".format(e)
+
+        with self.condition:
+            self.fetching = False
+            self.condition.notify_all()
+
+        if error is None:
+            if self.log_info is not None:
+                self.log_info("Restored the missing metrics-extension MSI Auth token file.")
+        elif self.log_error is not None:
+            self.log_error(error)
+
+    def get_token(self):
+        """
+        Return the current token response, refreshing it first if it is due, and writing it back to the token file
+        if the file went missing. Raise if no usable token can be had.
+        """
+        with self.condition:
+            if not self.loaded:
+                self.load()
+            now = self.clock()
+            due = (not self.is_usable(now) or now >= self.refresh_at) and now >= self.next_attempt
+            missing = not due and self.is_usable(now) and not os.path.exists(self.token_path)
+
+        if due:
+            self.refresh()
+        elif missing:
+            self.restore()
+
+        with self.condition:
+            if self.is_usable(self.clock()):
+                return self.token
+            raise Exception(self.last_error or "No valid MSI auth token")
+
+    def ensure_token(self):
+        """
+        get_token for the extension handlers: return (success, expires_on, log_messages)
+        """
+        try:
+            self.get_token()
+            return True, str(self.expires_on), ""
+        except Exception as e:
+            return False, "", "{0}\n".format(e)
+
+    def get_next_wakeup(self):
+        """
+        Return the seconds until the next refresh or retry is due
+        """
+        with self.condition:
+            if self.token is None:
+                refresh_at = self.next_attempt
+            else:
+                refresh_at = max(self.refresh_at, self.next_attempt)
+            return max(refresh_at - self.clock(), 1)
+
+    def run(self, stop_event):
+        while not stop_event.is_set():
+            try:
+                self.get_token()
+            except Exception:
+                # Already counted and logged by refresh, retried after retry_interval
+                pass
+            stop_event.wait(self.get_next_wakeup())
+
+    def start(self):
+        """
+        Start the background refresh, if it is not running yet
+        """
+        if self.thread is not None and self.thread.is_alive():
+            return
+        # A thread left behind by stop keeps its own, set, event and exits after its fetch
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target = self.run, args = (self.stop_event,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self, timeout = MsiTokenStopTimeoutSeconds):
+        """
+        Stop the background refresh, waiting at most timeout seconds for a fetch in flight
+        """
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+            if self.thread.is_alive() and self.log_error is not None:
+                self.log_error("The MSI auth token refresh did not stop within {0} seconds, leaving it behind.".format(timeout))
+            self.thread = None
+
+    def get_metrics(self):
+        with self.condition:
+            return {
+                'refreshes' : self.refreshes,
+                'failures' : self.failures,
+                'consecutiveFailures' : self.consecutive_failures,
+                'lastRefreshLatencySeconds' : self.last_refresh_latency,
+                'maxRefreshLatencySeconds' : self.max_refresh_latency,
+                'lastRefreshEpoch' : self.last_refresh_time,
+                'expiresOnEpoch' : self.expires_on,
+                'lastError' : self.last_error,
+            }
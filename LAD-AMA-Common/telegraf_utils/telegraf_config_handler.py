@@ -19,6 +19,7 @@
 import sys
 import json
 import os
+import hashlib
 from telegraf_utils.telegraf_name_map import name_map
 import subprocess
 import signal
@@ -26,6 +27,7 @@ from shutil import copyfile, rmtree
 import time
 import metrics_ext_utils.metrics_constants as metrics_constants
 import metrics_ext_utils.metrics_common_utils as metrics_utils
+import metrics_ext_utils.imds_client as imds_client
 
 try:
     # Python 3+
@@ -34,6 +36,14 @@ except ImportError:
     # Python 2
     import urllib2 as urllib
 
+# What the caller of apply_config needs to do for telegraf to pick up the written configs
+TelegrafConfigUnchanged = "none"
+TelegrafConfigReload = "reload"
+TelegrafConfigRestart = "restart"
+
+# Tag that marks the metrics of a consolidated input until they are fanned out to their configuration IDs
+ConsolidationTagKey = "consolidationId"
+
 """
 Sample input data received by this script
 [
@@ -50,7 +60,62 @@ Sample input data received by this script
 ]
 """
 
-def parse_config(data, me_url, mdsd_url, is_lad, az_resource_id, subscription_id, resource_group, region, virtual_machine_name):
+class TomlBuilder(object):
+    """
+    Collects the lines of a telegraf TOML config and joins them once in build()
+    """
+    def __init__(self):
+        self.parts = []
+
+    def line(self, text="", indent=0):
+        self.parts.append(" " * indent + text + "\n")
+
+    def table(self, name, indent=0):
+        self.line("[[" + name + "]]", indent)
+
+    def key(self, name, value, indent=2):
+        self.line(name + " = " + value, indent)
+
+    def build(self):
+        return "".join(self.parts)
+
+
+def toml_string(value):
+    return "\"" + value + "\""
+
+
+def toml_array(values):
+    return "[" + ", ".join(toml_string(value) for value in values) + "]"
+
+
+def get_consolidation_router(consolidation_id, config_ids):
+    """
+    Render the starlark processor that copies every metric of a consolidated input once per configuration ID,
+    replacing the consolidation tag with the configurationId tag
+    :param consolidation_id: Value of the ConsolidationTagKey tag set on the consolidated input
+    :param config_ids: Configuration IDs the metrics are fanned out to
+    """
+    router = TomlBuilder()
+    router.line()
+    router.table("processors.starlark")
+    router.key("source", "'''")
+    router.line("def apply(metric):")
+    router.line("metrics = []", 4)
+    router.line("for configuration_id in " + json.dumps(config_ids) + ":", 4)
+    router.line("copy = deepcopy(metric)", 8)
+    router.line("copy.tags.pop(" + toml_string(ConsolidationTagKey) + ")", 8)
+    router.line("copy.tags[\"configurationId\"] = configuration_id", 8)
+    router.line("metrics.append(copy)", 8)
+    router.line("return metrics", 4)
+    router.line("'''", 2)
+    router.line()
+    router.line("[processors.starlark.tagpass]", 2)
+    router.key(ConsolidationTagKey, toml_array([consolidation_id]), 4)
+    router.line()
+    return router.build()
+
+
+def parse_config(data, me_url, mdsd_url, is_lad, az_resource_id, subscription_id, resource_group, region, virtual_machine_name, consolidate=False):
     """
     Main parser method to convert Metrics config from extension configuration to telegraf configuration
     :param data: Parsed Metrics Configuration from which telegraf config is created
@@ -62,9 +127,10 @@ def parse_config(data, me_url, mdsd_url, is_lad, az_resource_id, subscription_id
     :param resource_group: Azure Resource Group value for the VM
     :param region: Azure Region value for the VM
     :param virtual_machine_name: Azure Virtual Machine Name value (Only in the case for VMSS) for the VM
+    :param consolidate: Collect a plugin referenced by several configuration IDs with a single input and fan its
+                        metrics out to the configuration IDs, instead of one input per configuration ID
     """
-    storage_namepass_list = []    
-    storage_namepass_str = ""
+    storage_namepass_list = []
 
     vmi_rate_counters_list = ["LogicalDisk\\BytesPerSecond", "LogicalDisk\\ReadBytesPerSecond", "LogicalDisk\\ReadsPerSecond",  "LogicalDisk\\WriteBytesPerSecond", "LogicalDisk\\WritesPerSecond", "LogicalDisk\\TransfersPerSecond", "Network\\ReadBytesPerSecond", "Network\\WriteBytesPerSecond"]
 
@@ -80,6 +146,7 @@ def parse_config(data, me_url, mdsd_url, is_lad, az_resource_id, subscription_id
 
     telegraf_json = {}
     counterConfigIdMap = {}
+    counterConfigIdSets = {}
 
     for item in data:
         sink = item["sink"]
@@ -99,13 +166,16 @@ def parse_config(data, me_url, mdsd_url, is_lad, az_resource_id, subscription_id
                 
             if counter not in counterConfigIdMap:
                 counterConfigIdMap[counter] = []
+                counterConfigIdSets[counter] = set()
 
             configIds = counterConfigIdMap[counter]
+            configIdSet = counterConfigIdSets[counter]
 
             configurationIds = item["configurationId"]
 
             for configId in configurationIds:
-                if configId not in configIds:
+                if configId not in configIdSet:
+                    configIdSet.add(configId)
                     configIds.append(configId)
             
             omiclass = ""
@@ -161,218 +231,225 @@ def parse_config(data, me_url, mdsd_url, is_lad, az_resource_id, subscription_id
         raise Exception("Unable to parse telegraf config into intermediate dictionary.")
 
     excess_diskio_plugin_list_lad = ["total_transfers_filesystem", "read_bytes_filesystem", "total_bytes_filesystem", "write_bytes_filesystem", "reads_filesystem", "writes_filesystem"]
-    excess_diskio_field_drop_list_str = ""
+    excess_diskio_field_drop_list = []
+    storage_namepass_set = set()
 
+    def add_storage_namepass(measurement):
+        storage_namepass_set.add(measurement)
+        storage_namepass_list.append(measurement)
 
     int_file = {"filename":"intermediate.json", "data": json.dumps(telegraf_json)}
     output = []
     output.append(int_file)
 
-    for omiclass in telegraf_json:        
+    for omiclass in telegraf_json:
         for plugin in telegraf_json[omiclass]:
+            plugin_fields = telegraf_json[omiclass][plugin]
+
             # Collect all unique configurationIds from all fields in this plugin
             all_config_ids = []
-            for field in telegraf_json[omiclass][plugin]:
-                configIds = counterConfigIdMap[telegraf_json[omiclass][plugin][field]["displayName"]]
-                for configId in configIds:
-                    if configId not in all_config_ids:
+            all_config_id_set = set()
+            for field in plugin_fields:
+                for configId in counterConfigIdMap[plugin_fields[field]["displayName"]]:
+                    if configId not in all_config_id_set:
+                        all_config_id_set.add(configId)
                         all_config_ids.append(configId)
 
+            is_vmi = plugin.endswith("_vmi")
+            is_vmi_rate_counter = False
+            for field in plugin_fields:
+                if plugin_fields[field]["displayName"] in vmi_rate_counters_list:
+                    is_vmi_rate_counter = True
+                    break
+
+            # If it's a lad config then add the namepass fields for sending totals to storage
+            # always skip lad plugin names as they should be dropped from ME
+            lad_plugin_name = plugin + "_total"
+            ama_plugin_name = plugin + "_mdsd_la_perf"
             for configId in all_config_ids:
-                config_file = {"filename" : omiclass+"-"+plugin+"-"+configId+".conf"}
-                input_str = ""
-                ama_rename_str = ""
-                metricsext_rename_str = ""
-                lad_specific_rename_str = ""
-                rate_specific_aggregator_str = ""
-                aggregator_str = ""
-                
-                # Arbitrary max value for finding min
-                min_interval = "999999999s"
-                is_vmi = plugin.endswith("_vmi")
-                is_vmi_rate_counter = False
-                for field in telegraf_json[omiclass][plugin]:
-                    if not is_vmi_rate_counter:
-                        is_vmi_rate_counter = telegraf_json[omiclass][plugin][field]["displayName"] in vmi_rate_counters_list
-                
-                # if is_vmi_rate_counter:
-                #     min_interval = "1s"
-                    
-                if is_vmi or is_vmi_rate_counter:
-                    splitResult = plugin.split('_')
-                    telegraf_plugin = splitResult[0]
-                    input_str += "[[inputs." + telegraf_plugin + "]]\n"
-                    # plugin = plugin[:-4]
-                else:
-                    input_str += "[[inputs." + plugin + "]]\n"
-                # input_str += " "*2 + "name_override = \"" + omiclass + "\"\n"
-
-                # If it's a lad config then add the namepass fields for sending totals to storage
-                # always skip lad plugin names as they should be dropped from ME
-                lad_plugin_name = plugin + "_total"
-                if lad_plugin_name not in storage_namepass_list:
-                        storage_namepass_list.append(lad_plugin_name)
-                        
-                if is_lad:                
-                    lad_specific_rename_str += "\n[[processors.rename]]\n"
-                    lad_specific_rename_str += " "*2 + "namepass = [\"" + lad_plugin_name + "\"]\n"                
-                elif is_vmi  or is_vmi_rate_counter:                
-                    if plugin not in storage_namepass_list:
-                        storage_namepass_list.append(plugin + "_mdsd")
-                else:
-                    ama_plugin_name = plugin + "_mdsd_la_perf"
-                    ama_rename_str += "\n[[processors.rename]]\n"
-                    ama_rename_str += " "*2 + "namepass = [\"" + ama_plugin_name + "\"]\n"
-                    if ama_plugin_name not in storage_namepass_list:
-                        storage_namepass_list.append(ama_plugin_name)
+                if lad_plugin_name not in storage_namepass_set:
+                    add_storage_namepass(lad_plugin_name)
+                if is_lad:
+                    pass
+                elif is_vmi or is_vmi_rate_counter:
+                    if plugin not in storage_namepass_set:
+                        add_storage_namepass(plugin + "_mdsd")
+                elif ama_plugin_name not in storage_namepass_set:
+                    add_storage_namepass(ama_plugin_name)
+
+            namespace = MetricsExtensionNamepsace
+            if is_vmi or is_vmi_rate_counter:
+                namespace = "insights.virtualmachine"
+
+            if is_vmi_rate_counter:
+                # Adding "_rated" as a substring for vmi rate metrics to avoid renaming collisions
+                plugin_name = plugin + "_rated"
+            else:
+                plugin_name = plugin
+
+            # Arbitrary max value for finding min
+            min_interval = "999999999s"
+            fields = []
+            ops_fields = []
+            non_ops_fields = []
+            ops = []
+            ama_rename = TomlBuilder()
+            metricsext_rename = TomlBuilder()
+            lad_specific_rename = TomlBuilder()
+
+            metricsext_rename.line()
+            metricsext_rename.table("processors.rename")
+            metricsext_rename.key("namepass", toml_array([plugin_name]))
+            metricsext_rename.line()
+            metricsext_rename.table("processors.rename.replace", 2)
+            metricsext_rename.key("measurement", toml_string(plugin_name), 4)
+            metricsext_rename.key("dest", toml_string(namespace), 4)
 
-                namespace = MetricsExtensionNamepsace
+            if is_lad:
+                lad_specific_rename.line()
+                lad_specific_rename.table("processors.rename")
+                lad_specific_rename.key("namepass", toml_array([lad_plugin_name]))
+            elif not is_vmi and not is_vmi_rate_counter:
+                ama_rename.line()
+                ama_rename.table("processors.rename")
+                ama_rename.key("namepass", toml_array([ama_plugin_name]))
+
+            for field in plugin_fields:
+                field_config = plugin_fields[field]
+                fields.append(field)
                 if is_vmi or is_vmi_rate_counter:
-                    namespace = "insights.virtualmachine"
-
-                if is_vmi_rate_counter:
-                    # Adding "_rated" as a substring for vmi rate metrics to avoid renaming collisions
-                    plugin_name = plugin + "_rated"
+                    if "MB" in field:
+                        fields.append(field.replace('MB','Bytes'))
+
+                #Use the shortest interval time for the whole plugin
+                new_interval = field_config["interval"]
+                if int(new_interval[:-1]) < int(min_interval[:-1]):
+                    min_interval = new_interval
+
+                #compute values for aggregator options
+                aggregated_name = field_config["ladtablekey"] if is_lad else field_config["displayName"]
+                if "op" in field_config:
+                    if field_config["op"] == "rate":
+                        ops = ["rate", "rate_min", "rate_max", "rate_count", "rate_sum", "rate_mean"]
+                    ops_fields.append(aggregated_name)
                 else:
-                    plugin_name = plugin
-
-                metricsext_rename_str += "\n[[processors.rename]]\n"
-                metricsext_rename_str += " "*2 + "namepass = [\"" + plugin_name + "\"]\n"
-                metricsext_rename_str += "\n" + " "*2 + "[[processors.rename.replace]]\n"
-                metricsext_rename_str += " "*4 + "measurement = \"" + plugin_name + "\"\n"
-                metricsext_rename_str += " "*4 + "dest = \"" + namespace + "\"\n"
-
-                fields = ""
-                ops_fields = ""
-                non_ops_fields = ""
-                non_rate_aggregate = False
-                ops = ""
-                rate_aggregate = False
-                for field in telegraf_json[omiclass][plugin]:
-                    fields += "\"" + field + "\", "
-                    if is_vmi or is_vmi_rate_counter :
-                        if "MB" in field:
-                            fields += "\"" + field.replace('MB','Bytes') + "\", "
-
-                    #Use the shortest interval time for the whole plugin
-                    new_interval = telegraf_json[omiclass][plugin][field]["interval"]
-                    if int(new_interval[:-1]) < int(min_interval[:-1]):
-                        min_interval = new_interval
-
-                    #compute values for aggregator options
-                    if "op" in telegraf_json[omiclass][plugin][field]:
-                        if telegraf_json[omiclass][plugin][field]["op"] == "rate":
-                            rate_aggregate = True
-                            ops = "\"rate\", \"rate_min\", \"rate_max\", \"rate_count\", \"rate_sum\", \"rate_mean\""
-                        if is_lad:
-                            ops_fields += "\"" +  telegraf_json[omiclass][plugin][field]["ladtablekey"] + "\", "
-                        else:
-                            ops_fields += "\"" +  telegraf_json[omiclass][plugin][field]["displayName"] + "\", "
-                    else:
-                        non_rate_aggregate = True
-                        if is_lad:
-                            non_ops_fields += "\"" +  telegraf_json[omiclass][plugin][field]["ladtablekey"] + "\", "
-                        else:
-                            non_ops_fields += "\"" +  telegraf_json[omiclass][plugin][field]["displayName"] + "\", "
-
-                    #Add respective rename processor plugin based on the displayname
-                    if is_lad:
-                        lad_specific_rename_str += "\n" + " "*2 + "[[processors.rename.replace]]\n"
-                        lad_specific_rename_str += " "*4 + "field = \"" + field + "\"\n"
-                        lad_specific_rename_str += " "*4 + "dest = \"" + telegraf_json[omiclass][plugin][field]["ladtablekey"] + "\"\n"
-                    elif not is_vmi and not is_vmi_rate_counter:
-                        # no rename of fields as they are set in telegraf directly                
-                        ama_rename_str += "\n" + " "*2 + "[[processors.rename.replace]]\n"
-                        ama_rename_str += " "*4 + "field = \"" + field + "\"\n"
-                        ama_rename_str += " "*4 + "dest = \"" + telegraf_json[omiclass][plugin][field]["displayName"] + "\"\n"
-
-                    # Avoid adding the rename logic for the redundant *_filesystem fields for diskio which were added specifically for OMI parity in LAD
-                    # Had to re-use these six fields to avoid renaming issues since both Filesystem and Disk in OMI-LAD use them
-                    # AMA only uses them once so only need this for LAD
-                    if is_lad:
-                        if field in excess_diskio_plugin_list_lad:
-                            excess_diskio_field_drop_list_str += "\"" + field + "\", "
-                        else:
-                            metricsext_rename_str += "\n" + " "*2 + "[[processors.rename.replace]]\n"
-                            metricsext_rename_str += " "*4 + "field = \"" + field + "\"\n"
-                            metricsext_rename_str += " "*4 + "dest = \"" + plugin + "/" + field + "\"\n"
-                    elif not is_vmi and not is_vmi_rate_counter:
-                        # no rename of fields as they are set in telegraf directly                
-                        metricsext_rename_str += "\n" + " "*2 + "[[processors.rename.replace]]\n"
-                        metricsext_rename_str += " "*4 + "field = \"" + field + "\"\n"
-                        metricsext_rename_str += " "*4 + "dest = \"" + plugin + "/" + field + "\"\n"
-
-                #Add respective operations for aggregators
-                # if is_lad:
-                if not is_vmi and not is_vmi_rate_counter:
-                    suffix = ""
-                    if is_lad:
-                        suffix = "_total\"]\n"
-                    else:
-                        suffix = "_mdsd_la_perf\"]\n"
-                        
-                    if rate_aggregate:
-                        aggregator_str += "[[aggregators.basicstats]]\n"
-                        aggregator_str += " "*2 + "namepass = [\"" + plugin + suffix
-                        aggregator_str += " "*2 + "period = \"" + min_interval + "\"\n"
-                        aggregator_str += " "*2 + "drop_original = true\n"
-                        aggregator_str += " "*2 + "fieldpass = [" + ops_fields[:-2] + "]\n" #-2 to strip the last comma and space
-                        aggregator_str += " "*2 + "stats = [" + ops + "]\n"
-
-                    if non_rate_aggregate:
-                        aggregator_str += "[[aggregators.basicstats]]\n"
-                        aggregator_str += " "*2 + "namepass = [\"" + plugin + suffix
-                        aggregator_str += " "*2 + "period = \"" + min_interval + "\"\n"
-                        aggregator_str += " "*2 + "drop_original = true\n"
-                        aggregator_str += " "*2 + "fieldpass = [" + non_ops_fields[:-2] + "]\n" #-2 to strip the last comma and space
-                        aggregator_str += " "*2 + "stats = [\"mean\", \"max\", \"min\", \"sum\", \"count\"]\n\n"
-                
-                elif is_vmi_rate_counter:
-                    # Aggregator config for MDSD
-                    aggregator_str += "[[aggregators.basicstats]]\n"
-                    aggregator_str += " "*2 + "namepass = [\"" + plugin + "_mdsd\"]\n"
-                    aggregator_str += " "*2 + "period = \"" + min_interval + "\"\n"
-                    aggregator_str += " "*2 + "drop_original = true\n"
-                    aggregator_str += " "*2 + "fieldpass = [" + ops_fields[:-2].replace('\\','\\\\\\\\') + "]\n" #-2 to strip the last comma and space
-                    aggregator_str += " "*2 + "stats = [" + ops + "]\n\n"
-
-                    # Aggregator config for ME
-                    aggregator_str += "[[aggregators.mdmratemetrics]]\n"
-                    aggregator_str += " "*2 + "namepass = [\"" + plugin + "\"]\n"
-                    aggregator_str += " "*2 + "period = \"" + min_interval + "\"\n"
-                    aggregator_str += " "*2 + "drop_original = true\n"
-                    aggregator_str += " "*2 + "fieldpass = [" + ops_fields[:-2].replace('\\','\\\\\\\\') + "]\n" #-2 to strip the last comma and space
-                    aggregator_str += " "*2 + "stats = [\"rate\"]\n\n"
-
-                    
+                    non_ops_fields.append(aggregated_name)
+
+                #Add respective rename processor plugin based on the displayname
                 if is_lad:
-                    lad_specific_rename_str += "\n"
+                    lad_specific_rename.line()
+                    lad_specific_rename.table("processors.rename.replace", 2)
+                    lad_specific_rename.key("field", toml_string(field), 4)
+                    lad_specific_rename.key("dest", toml_string(field_config["ladtablekey"]), 4)
                 elif not is_vmi and not is_vmi_rate_counter:
-                    # no rename of fields as they are set in telegraf directly            
-                    ama_rename_str += "\n"
+                    # no rename of fields as they are set in telegraf directly
+                    ama_rename.line()
+                    ama_rename.table("processors.rename.replace", 2)
+                    ama_rename.key("field", toml_string(field), 4)
+                    ama_rename.key("dest", toml_string(field_config["displayName"]), 4)
+
+                # Avoid adding the rename logic for the redundant *_filesystem fields for diskio which were added specifically for OMI parity in LAD
+                # Had to re-use these six fields to avoid renaming issues since both Filesystem and Disk in OMI-LAD use them
+                # AMA only uses them once so only need this for LAD
+                if is_lad and field in excess_diskio_plugin_list_lad:
+                    # The field is dropped once per configuration file written for the plugin
+                    excess_diskio_field_drop_list.extend([field] * len(all_config_ids))
+                elif is_lad or (not is_vmi and not is_vmi_rate_counter):
+                    # no rename of fields for VMI as they are set in telegraf directly
+                    metricsext_rename.line()
+                    metricsext_rename.table("processors.rename.replace", 2)
+                    metricsext_rename.key("field", toml_string(field), 4)
+                    metricsext_rename.key("dest", toml_string(plugin + "/" + field), 4)
+
+            #Add respective operations for aggregators
+            aggregator = TomlBuilder()
+            if not is_vmi and not is_vmi_rate_counter:
+                suffix = "_total" if is_lad else "_mdsd_la_perf"
+
+                if ops_fields:
+                    aggregator.table("aggregators.basicstats")
+                    aggregator.key("namepass", toml_array([plugin + suffix]))
+                    aggregator.key("period", toml_string(min_interval))
+                    aggregator.key("drop_original", "true")
+                    aggregator.key("fieldpass", toml_array(ops_fields))
+                    aggregator.key("stats", toml_array(ops))
+
+                if non_ops_fields:
+                    aggregator.table("aggregators.basicstats")
+                    aggregator.key("namepass", toml_array([plugin + suffix]))
+                    aggregator.key("period", toml_string(min_interval))
+                    aggregator.key("drop_original", "true")
+                    aggregator.key("fieldpass", toml_array(non_ops_fields))
+                    aggregator.key("stats", toml_array(["mean", "max", "min", "sum", "count"]))
+                    aggregator.line()
+
+            elif is_vmi_rate_counter:
+                escaped_ops_fields = [ops_field.replace('\\','\\\\\\\\') for ops_field in ops_fields]
+                # Aggregator config for MDSD
+                aggregator.table("aggregators.basicstats")
+                aggregator.key("namepass", toml_array([plugin + "_mdsd"]))
+                aggregator.key("period", toml_string(min_interval))
+                aggregator.key("drop_original", "true")
+                aggregator.key("fieldpass", toml_array(escaped_ops_fields))
+                aggregator.key("stats", toml_array(ops))
+                aggregator.line()
+
+                # Aggregator config for ME
+                aggregator.table("aggregators.mdmratemetrics")
+                aggregator.key("namepass", toml_array([plugin]))
+                aggregator.key("period", toml_string(min_interval))
+                aggregator.key("drop_original", "true")
+                aggregator.key("fieldpass", toml_array(escaped_ops_fields))
+                aggregator.key("stats", toml_array(["rate"]))
+                aggregator.line()
 
-                # Using fields[: -2] here to get rid of the last ", " at the end of the string
-                input_str += " "*2 + "fieldpass = ["+fields[:-2]+"]\n"
-                if plugin == "cpu":
-                    input_str += " "*2 + "report_active = true\n"
-                
-                # Rate interval needs to be atleast twice the regular sourcing interval for aggregation to work. 
-                # Since we want all the VMI metrics to be sent at the same interval as selected by the customer, To overcome the twice the min internval limitation, 
-                # We are sourcing the VMI metrics that need to be aggregated at half the selected frequency 
-                rated_min_interval = str(int(min_interval[:-1]) // 2) + "s" 
-                input_str += " "*2 + "interval = " + "\"" + rated_min_interval + "\"\n\n"
-
-                telegraf_plugin = plugin
-                if is_vmi:
-                    splitResult = plugin.split('_')
-                    telegraf_plugin = splitResult[0]
-
-                input_str += "\n"
-                input_str += " "*2 + "[inputs." + telegraf_plugin + ".tags]\n"
-                input_str += " "*4 + "configurationId=\"" + configId + "\"\n\n"            
-                config_file["data"] = input_str + "\n" +  metricsext_rename_str + "\n" + ama_rename_str + "\n" + lad_specific_rename_str + "\n"  +aggregator_str
+            if is_lad:
+                lad_specific_rename.line()
+            elif not is_vmi and not is_vmi_rate_counter:
+                # no rename of fields as they are set in telegraf directly
+                ama_rename.line()
+
+            if is_vmi or is_vmi_rate_counter:
+                input_plugin = plugin.split('_')[0]
+            else:
+                input_plugin = plugin
+
+            telegraf_plugin = plugin
+            if is_vmi:
+                telegraf_plugin = plugin.split('_')[0]
+
+            inputs = TomlBuilder()
+            inputs.table("inputs." + input_plugin)
+            inputs.key("fieldpass", toml_array(fields))
+            if plugin == "cpu":
+                inputs.key("report_active", "true")
+
+            # Rate interval needs to be atleast twice the regular sourcing interval for aggregation to work.
+            # Since we want all the VMI metrics to be sent at the same interval as selected by the customer, To overcome the twice the min internval limitation,
+            # We are sourcing the VMI metrics that need to be aggregated at half the selected frequency
+            rated_min_interval = str(int(min_interval[:-1]) // 2) + "s"
+            inputs.key("interval", toml_string(rated_min_interval))
+            inputs.line()
+            inputs.line()
+            inputs.line("[inputs." + telegraf_plugin + ".tags]", 2)
+
+            # Only the configurationId tag differs between the configuration files of a plugin, so the rest is rendered once
+            input_str = inputs.build()
+            processors_str = "\n" + metricsext_rename.build() + "\n" + ama_rename.build() + "\n" + lad_specific_rename.build() + "\n" + aggregator.build()
+            if consolidate and len(all_config_ids) > 1:
+                # The fields and interval of the input do not depend on the configuration ID, so one input collects
+                # the data of all of them and the router copies each metric once per configuration ID
+                consolidation_id = omiclass + "-" + plugin
+                config_file = {"filename" : consolidation_id + ".conf"}
+                config_file["data"] = input_str + " "*4 + ConsolidationTagKey + "=\"" + consolidation_id + "\"\n\n" + processors_str + \
+                                      get_consolidation_router(consolidation_id, all_config_ids)
+                output.append(config_file)
+                continue
+
+            for configId in all_config_ids:
+                config_file = {"filename" : omiclass+"-"+plugin+"-"+configId+".conf"}
+                config_file["data"] = input_str + " "*4 + "configurationId=\"" + configId + "\"\n\n" + processors_str
                 output.append(config_file)
-                config_file = {}
 
     """
     Sample telegraf TOML file output
@@ -407,62 +484,70 @@ def parse_config(data, me_url, mdsd_url, is_lad, az_resource_id, subscription_id
 
     ## Get the log folder directory from HandlerEnvironment.json and use that for the telegraf default logging
     logFolder, _ = get_handler_vars()
-    for measurement in storage_namepass_list:
-        storage_namepass_str += "\"" + measurement + "\", "
-
 
     # Telegraf basic agent and output config
-    agentconf = "[agent]\n"
-    agentconf += "  interval = \"10s\"\n"
-    agentconf += "  round_interval = true\n"
-    agentconf += "  metric_batch_size = 1000\n"
-    agentconf += "  metric_buffer_limit = 1000000\n"
-    agentconf += "  collection_jitter = \"0s\"\n"
-    agentconf += "  flush_interval = \"10s\"\n"
-    agentconf += "  flush_jitter = \"0s\"\n"
-    agentconf += "  logtarget = \"file\"\n"
-    agentconf += "  quiet = true\n"
-    agentconf += "  logfile = \"" + logFolder + "/telegraf.log\"\n"
-    agentconf += "  logfile_rotation_max_size = \"100MB\"\n"
-    agentconf += "  logfile_rotation_max_archives = 5\n"
-    agentconf += "\n# Configuration for adding gloabl tags\n"
-    agentconf += "[global_tags]\n"
+    agent = TomlBuilder()
+    agent.line("[agent]")
+    agent.key("interval", toml_string("10s"))
+    agent.key("round_interval", "true")
+    agent.key("metric_batch_size", "1000")
+    agent.key("metric_buffer_limit", "1000000")
+    agent.key("collection_jitter", toml_string("0s"))
+    agent.key("flush_interval", toml_string("10s"))
+    agent.key("flush_jitter", toml_string("0s"))
+    agent.key("logtarget", toml_string("file"))
+    agent.key("quiet", "true")
+    agent.key("logfile", toml_string(logFolder + "/telegraf.log"))
+    agent.key("logfile_rotation_max_size", toml_string("100MB"))
+    agent.key("logfile_rotation_max_archives", "5")
+    agent.line()
+    agent.line("# Configuration for adding gloabl tags")
+    agent.line("[global_tags]")
     if is_lad:
-        agentconf += "  DeploymentId= \"${DeploymentId}\"\n"
-    agentconf += "  \"microsoft.subscriptionId\"= \"" + subscription_id + "\"\n"
-    agentconf += "  \"microsoft.resourceGroupName\"= \"" + resource_group + "\"\n"
-    agentconf += "  \"microsoft.regionName\"= \"" + region + "\"\n"
-    agentconf += "  \"microsoft.resourceId\"= \"" + az_resource_id + "\"\n"
+        agent.line("DeploymentId= \"${DeploymentId}\"", 2)
+    agent.line("\"microsoft.subscriptionId\"= " + toml_string(subscription_id), 2)
+    agent.line("\"microsoft.resourceGroupName\"= " + toml_string(resource_group), 2)
+    agent.line("\"microsoft.regionName\"= " + toml_string(region), 2)
+    agent.line("\"microsoft.resourceId\"= " + toml_string(az_resource_id), 2)
     if virtual_machine_name != "":
-        agentconf += "  \"VMInstanceId\"= \"" + virtual_machine_name + "\"\n"    
+        agent.line("\"VMInstanceId\"= " + toml_string(virtual_machine_name), 2)
     if has_me_output or is_lad:
-        agentconf += "\n# Configuration for sending metrics to MetricsExtension\n"
+        agent.line()
+        agent.line("# Configuration for sending metrics to MetricsExtension")
 
         # for AMA we use Sockets to write to ME but for LAD we continue using UDP
         # because we support a lot more counters in AMA path and ME is not able to handle it with UDP
         if is_lad:
-            agentconf += "[[outputs.influxdb]]\n"
+            agent.table("outputs.influxdb")
         else:
-            agentconf += "[[outputs.socket_writer]]\n"
-        agentconf += "  namedrop = [" + storage_namepass_str[:-2] + "]\n"
+            agent.table("outputs.socket_writer")
+        agent.key("namedrop", toml_array(storage_namepass_list))
         if is_lad:
-            agentconf += "  fielddrop = [" + excess_diskio_field_drop_list_str[:-2] + "]\n"
-        
+            agent.key("fielddrop", toml_array(excess_diskio_field_drop_list))
+
         if is_lad:
-            agentconf += "  urls = [\"" + str(me_url) + "\"]\n\n"
-            agentconf += "  udp_payload = \"2048B\"\n\n"
+            agent.key("urls", toml_array([str(me_url)]))
+            agent.line()
+            agent.key("udp_payload", toml_string("2048B"))
+            agent.line()
         else:
-            agentconf += "  data_format = \"influx\"\n"
-            agentconf += "  address = \"" + str(me_url) + "\"\n\n"
+            agent.key("data_format", toml_string("influx"))
+            agent.key("address", toml_string(str(me_url)))
+            agent.line()
     if has_mdsd_output:
-        agentconf += "\n# Configuration for sending metrics to MDSD\n"
-        agentconf += "[[outputs.socket_writer]]\n"
-        agentconf += "  namepass = [" + storage_namepass_str[:-2] + "]\n"
-        agentconf += "  data_format = \"influx\"\n"
-        agentconf += "  address = \"" + str(mdsd_url) + "\"\n\n"
-    agentconf += "\n# Configuration for outputing metrics to file. Uncomment to enable.\n"
-    agentconf += "#[[outputs.file]]\n"
-    agentconf += "#  files = [\"./metrics_to_file.out\"]\n\n"
+        agent.line()
+        agent.line("# Configuration for sending metrics to MDSD")
+        agent.table("outputs.socket_writer")
+        agent.key("namepass", toml_array(storage_namepass_list))
+        agent.key("data_format", toml_string("influx"))
+        agent.key("address", toml_string(str(mdsd_url)))
+        agent.line()
+    agent.line()
+    agent.line("# Configuration for outputing metrics to file. Uncomment to enable.")
+    agent.line("#[[outputs.file]]")
+    agent.line("#  files = [\"./metrics_to_file.out\"]")
+    agent.line()
+    agentconf = agent.build()
 
     agent_file = {"filename":"telegraf.conf", "data": agentconf}
     output.append(agent_file)
@@ -495,6 +580,70 @@ def write_configs(configs, telegraf_conf_dir, telegraf_d_conf_dir):
             f.write(configfile["data"])
 
 
+def get_config_path(configfile, telegraf_conf_dir, telegraf_d_conf_dir):
+    """
+    Return the path a config entry created by parse_config is written to
+    """
+    if configfile["filename"] == "telegraf.conf" or configfile["filename"] == "intermediate.json":
+        return telegraf_conf_dir + configfile["filename"]
+    return telegraf_d_conf_dir + configfile["filename"]
+
+
+def get_file_hash(path):
+    """
+    Return the sha256 of the file content, or None if it cannot be read
+    """
+    try:
+        with open(path, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except (IOError, OSError):
+        return None
+
+
+def write_configs_incremental(configs, telegraf_conf_dir, telegraf_d_conf_dir):
+    """
+    Apply the telegraf config created by config parser method to the telegraf config location on disk,
+    writing only the files whose content hash changed and removing only the stale module configs,
+    so that telegraf can keep running with the configs that did not change
+    :param configs: Telegraf config data parsed by the parse_config method above
+    :param telegraf_conf_dir: Path where the telegraf.conf is written to on the disk
+    :param telegraf_d_conf_dir: Path where the individual module telegraf configs are written to on the disk
+    :return: TelegrafConfigRestart if telegraf.conf changed, TelegrafConfigReload if only module configs changed,
+             TelegrafConfigUnchanged otherwise
+    """
+    for conf_dir in [telegraf_conf_dir, telegraf_d_conf_dir]:
+        if not os.path.exists(conf_dir):
+            os.makedirs(conf_dir)
+
+    action = TelegrafConfigUnchanged
+    written = set()
+    for configfile in configs:
+        path = get_config_path(configfile, telegraf_conf_dir, telegraf_d_conf_dir)
+        written.add(os.path.basename(path))
+        data = configfile["data"].encode("utf-8")
+        if get_file_hash(path) == hashlib.sha256(data).hexdigest():
+            continue
+
+        # telegraf only loads *.conf files, so it never picks up the partially written temporary file
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+
+        if configfile["filename"] == "telegraf.conf":
+            action = TelegrafConfigRestart
+        elif configfile["filename"] != "intermediate.json" and action != TelegrafConfigRestart:
+            action = TelegrafConfigReload
+
+    for filename in os.listdir(telegraf_d_conf_dir):
+        if filename not in written:
+            os.remove(telegraf_d_conf_dir + filename)
+            if filename.endswith(".conf") and action != TelegrafConfigRestart:
+                action = TelegrafConfigReload
+
+    return action
+
+
 
 def get_handler_vars():
     """
@@ -709,6 +858,46 @@ def start_telegraf(is_lad):
     return True, log_messages
 
 
+def reload_telegraf(is_lad):
+    """
+    Make the running telegraf reload its configs with SIGHUP, without stopping metric collection
+    This method is called by the main extension code when apply_config returns TelegrafConfigReload
+    :param is_lad: boolean whether the extension is LAD or not (AMA)
+    """
+    if is_lad:
+        telegraf_bin = metrics_constants.lad_telegraf_bin
+    else:
+        telegraf_bin = metrics_constants.ama_telegraf_bin
+
+    if not is_running(is_lad):
+        return False, "Telegraf is not running. Failed to reload telegraf configs."
+
+    if metrics_utils.is_systemd():
+        telegraf_service_name = get_telegraf_service_name(is_lad)
+        code = os.system("systemctl kill -s HUP {0}".format(telegraf_service_name))
+        if code != 0:
+            return False, "Unable to reload telegraf service: {0}.service. Run systemctl status {0}.service for more info.".format(telegraf_service_name)
+        return True, "Successfully reloaded telegraf configs"
+
+    _, configFolder = get_handler_vars()
+    telegraf_pid_path = configFolder + "/telegraf_configs/telegraf_pid.txt"
+    reloaded = False
+    if os.path.isfile(telegraf_pid_path):
+        with open(telegraf_pid_path, "r") as f:
+            for pid in f.readlines():
+                # Verify the pid actually belongs to telegraf
+                cmd_path = os.path.join("/proc", str(pid.strip("\n")), "cmdline")
+                if os.path.exists(cmd_path):
+                    with open(cmd_path, "r") as cmd_f:
+                        cmdline = cmd_f.readlines()
+                        if cmdline and cmdline[0].find(telegraf_bin) >= 0:
+                            os.kill(int(pid), signal.SIGHUP)
+                            reloaded = True
+    if not reloaded:
+        return False, "Could not find telegraf process to reload."
+    return True, "Successfully reloaded telegraf configs"
+
+
 def get_telegraf_service_path(is_lad):
     """
     Utility method to get the service path in case /lib/systemd/system doesnt exist on the OS
@@ -738,49 +927,17 @@ def get_telegraf_service_name(is_lad):
         return metrics_constants.telegraf_service_name
         
 
-def handle_config(config_data, me_url, mdsd_url, is_lad):
+def get_imds_dimensions(is_lad):
     """
-    The main method to perfom the task of parsing the config , writing them to disk, setting up, stopping, removing and starting telegraf
-    :param config_data: Parsed Metrics Configuration from which telegraf config is created
-    :param me_url: The url to which telegraf will send metrics to for MetricsExtension
-    :param mdsd_url: The url to which telegraf will send metrics to for MDSD
+    Query IMDS for the resource id, subscription id, resource group, region and VM name used as dimensions of the telegraf metrics
     :param is_lad: Boolean value for whether the extension is Lad or not (AMA)
     """
 
     # Making the imds call to get resource id, sub id, resource group and region for the dimensions for telegraf metrics
-    retries = 1
-    max_retries = 3
-    sleep_time = 5
-    imdsurl = ""
-    is_arc = False
-
-    if is_lad:
-        imdsurl = "http://169.254.169.254/metadata/instance?api-version=2019-03-11"
-    else:
-        if metrics_utils.is_arc_installed():
-            imdsurl = metrics_utils.get_arc_endpoint()
-            imdsurl += "/metadata/instance?api-version=2019-11-01"
-            is_arc = True
-        else:
-            imdsurl = "http://169.254.169.254/metadata/instance?api-version=2019-03-11"
-
-
-    data = None
-    while retries <= max_retries:
-
-        req = urllib.Request(imdsurl, headers={'Metadata':'true'})
-        res = urllib.urlopen(req)
-        data = json.loads(res.read().decode('utf-8', 'ignore'))
-
-        if "compute" not in data:
-            retries += 1
-        else:
-            break
-
-        time.sleep(sleep_time)
-
-    if retries > max_retries:
-        raise Exception("Unable to find 'compute' key in imds query response. Reached max retry limit of - {0} times. Failed to setup Telegraf.".format(max_retries))
+    try:
+        data = imds_client.get_imds_instance(is_lad)
+    except Exception as e:
+        raise Exception("{0} Failed to setup Telegraf.".format(e))
 
     if "resourceId" not in data["compute"]:
         raise Exception("Unable to find 'resourceId' key in imds query response. Failed to setup Telegraf.")
@@ -821,9 +978,13 @@ def handle_config(config_data, me_url, mdsd_url, is_lad):
 
     region = data["compute"]["location"]
 
-    #call the method to first parse the configs
-    output, namespaces = parse_config(config_data, me_url, mdsd_url, is_lad, az_resource_id, subscription_id, resource_group, region, virtual_machine_name)
+    return az_resource_id, subscription_id, resource_group, region, virtual_machine_name
 
+
+def get_telegraf_paths(is_lad):
+    """
+    Return the telegraf binary, config directory, agent config and module config directory paths
+    """
     _, configFolder = get_handler_vars()
     if is_lad:
         telegraf_bin = metrics_constants.lad_telegraf_bin
@@ -833,7 +994,23 @@ def handle_config(config_data, me_url, mdsd_url, is_lad):
     telegraf_conf_dir = configFolder + "/telegraf_configs/"
     telegraf_agent_conf = telegraf_conf_dir + "telegraf.conf"
     telegraf_d_conf_dir = telegraf_conf_dir + "telegraf.d/"
+    return telegraf_bin, telegraf_conf_dir, telegraf_agent_conf, telegraf_d_conf_dir
+
+
+def handle_config(config_data, me_url, mdsd_url, is_lad):
+    """
+    The main method to perfom the task of parsing the config , writing them to disk, setting up, stopping, removing and starting telegraf
+    :param config_data: Parsed Metrics Configuration from which telegraf config is created
+    :param me_url: The url to which telegraf will send metrics to for MetricsExtension
+    :param mdsd_url: The url to which telegraf will send metrics to for MDSD
+    :param is_lad: Boolean value for whether the extension is Lad or not (AMA)
+    """
+    az_resource_id, subscription_id, resource_group, region, virtual_machine_name = get_imds_dimensions(is_lad)
+
+    #call the method to first parse the configs
+    output, namespaces = parse_config(config_data, me_url, mdsd_url, is_lad, az_resource_id, subscription_id, resource_group, region, virtual_machine_name)
 
+    telegraf_bin, telegraf_conf_dir, telegraf_agent_conf, telegraf_d_conf_dir = get_telegraf_paths(is_lad)
 
     #call the method to write the configs
     write_configs(output, telegraf_conf_dir, telegraf_d_conf_dir)
@@ -846,3 +1023,32 @@ def handle_config(config_data, me_url, mdsd_url, is_lad):
             return False, []
 
     return True, namespaces
+
+
+def apply_config(config_data, me_url, mdsd_url, is_lad, consolidate=False):
+    """
+    Same as handle_config, but only writes the configs that changed and tells the caller how telegraf picks them up
+    :param config_data: Parsed Metrics Configuration from which telegraf config is created
+    :param me_url: The url to which telegraf will send metrics to for MetricsExtension
+    :param mdsd_url: The url to which telegraf will send metrics to for MDSD
+    :param is_lad: Boolean value for whether the extension is Lad or not (AMA)
+    :param consolidate: Collect each plugin once for all configuration IDs, see parse_config
+    :return: (success, namespaces, action) where action is one of TelegrafConfigUnchanged, TelegrafConfigReload
+             or TelegrafConfigRestart
+    """
+    az_resource_id, subscription_id, resource_group, region, virtual_machine_name = get_imds_dimensions(is_lad)
+
+    output, namespaces = parse_config(config_data, me_url, mdsd_url, is_lad, az_resource_id, subscription_id, resource_group, region, virtual_machine_name, consolidate)
+
+    telegraf_bin, telegraf_conf_dir, telegraf_agent_conf, telegraf_d_conf_dir = get_telegraf_paths(is_lad)
+
+    action = write_configs_incremental(output, telegraf_conf_dir, telegraf_d_conf_dir)
+
+    # The unit file only depends on the paths, so it is set up again only along with a restart
+    if metrics_utils.is_systemd() and (action == TelegrafConfigRestart or not os.path.isfile(get_telegraf_service_path(is_lad))):
+        telegraf_service_setup = setup_telegraf_service(is_lad, telegraf_bin, telegraf_d_conf_dir, telegraf_agent_conf)
+        if not telegraf_service_setup:
+            return False, [], TelegrafConfigRestart
+        action = TelegrafConfigRestart
+
+    return True, namespaces, action
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""
+Benchmark of telegraf_config_handler.parse_config against synthetic DCRs.
+
+Usage: python benchmark_parse_config.py [repeats] [counters ...]
+
+Every DCR entry takes its counter from name_map in turn, so the larger DCRs
+spread the same counters over more configuration IDs and intervals. The
+output of each run is compared byte for byte, through its digest, with the
+output of the original string concatenating generator, and the median and
+best generation times are printed as JSON.
+"""
+
+import hashlib
+import json
+import os
+import sys
+import time
+
+# Add parent dir to path so we can import the modules under test
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from telegraf_utils.telegraf_config_handler import parse_config
+from telegraf_utils.telegraf_name_map import name_map
+
+ME_URL = "unix:///var/run/me/me_influx.socket"
+MDSD_URL = "unix:///var/run/mdsd/mdsd_influx.socket"
+AZ_RESOURCE_ID = "/subscriptions/sub1/resourceGroups/rg1/providers/Microsoft.Compute/virtualMachines/vm1"
+SUBSCRIPTION_ID = "sub1"
+RESOURCE_GROUP = "rg1"
+REGION = "westus2"
+VM_NAME = "vm1_0"
+
+# sha256 of the parse_config output before the generator was reworked, keyed by the number of counters
+ExpectedDigests = {
+    10: "3d32b49328f6fb4f5d5913f92b00a23e59407544ea082eda17ddb88f670a1d2b",
+    1000: "69b3a8813e445b3c4223d924d99da6d212471857e69ae54d31518aef57ee1053",
+    10000: "00e9acef52b86521f813be5c5feb7154ed121cd385df263727a62b83db4ebde8",
+}
+
+
+def make_dcr(counters):
+    """
+    Build a deterministic AMA DCR with the given number of counter entries
+    """
+    names = sorted(name for name, entry in name_map.items() if "module" in entry)
+    sinks = [["mdsd", "me"], ["me"], ["mdsd"]]
+    data = []
+    for i in range(counters):
+        batch = i // len(names)
+        data.append({
+            "displayName": names[i % len(names)],
+            "interval": "{0}s".format(15 * (1 + (i + batch) % 4)),
+            "sink": sinks[(i + batch) % len(sinks)],
+            "configurationId": ["dcr-{0}".format(batch), "dcr-shared-{0}".format(i % 3)],
+        })
+    return data
+
+
+def get_digest(output, namespaces):
+    digest = hashlib.sha256()
+    for config in output:
+        digest.update(config["filename"].encode("utf-8") + b"\0")
+        digest.update(config["data"].encode("utf-8") + b"\0")
+    digest.update(json.dumps(namespaces).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def benchmark(repeats, sizes):
+    report = {}
+    for counters in sizes:
+        data = make_dcr(counters)
+        times = []
+        for _ in range(repeats):
+            start_time = time.time()
+            output, namespaces = parse_config(data, ME_URL, MDSD_URL, False, AZ_RESOURCE_ID,
+                                              SUBSCRIPTION_ID, RESOURCE_GROUP, REGION, VM_NAME)
+            times.append(time.time() - start_time)
+        times.sort()
+        digest = get_digest(output, namespaces)
+        report[counters] = {
+            "files": len(output),
+            "median": times[len(times) // 2],
+            "best": times[0],
+            "digest": digest,
+            "identical": ExpectedDigests[counters] == digest if counters in ExpectedDigests else None,
+        }
+    return report
+
+
+def main():
+    args = [int(a) for a in sys.argv[1:]]
+    repeats = args[0] if args else 5
+    sizes = args[1:] or [10, 1000, 10000]
+    report = benchmark(repeats, sizes)
+    print(json.dumps(report, indent=2, sort_keys=True))
+    if any(result["identical"] is False for result in report.values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
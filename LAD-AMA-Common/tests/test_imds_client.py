@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+"""
+Unit tests for metrics_ext_utils/imds_client.py, against a local HTTP stand-in for IMDS
+"""
+
+import sys
+import os
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest.mock import patch, MagicMock
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+# Mock Linux-only modules before importing the handler
+for mod_name in ('grp', 'pwd'):
+    if mod_name not in sys.modules:
+        sys.modules[mod_name] = MagicMock()
+
+import metrics_ext_utils.imds_client as imds_client
+from metrics_ext_utils.metrics_ext_handler import get_imds_values
+from telegraf_utils.telegraf_config_handler import get_imds_dimensions
+
+InstanceDocument = {
+    "compute": {
+        "resourceId": "/subscriptions/sub1/resourceGroups/rg1/providers/Microsoft.Compute/virtualMachines/vm1",
+        "subscriptionId": "sub1",
+        "resourceGroupName": "rg1",
+        "location": "westus2",
+        "azEnvironment": "AzurePublicCloud",
+        "name": "vm1",
+        "vmScaleSetName": "",
+    }
+}
+
+
+class FakeImdsHandler(BaseHTTPRequestHandler):
+    """Serves the next queued response body, or the instance document once the queue is empty."""
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append((self.path, self.headers.get("Metadata")))
+        body = server.responses.pop(0) if server.responses else json.dumps(InstanceDocument)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(body.encode("utf-8"))
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ImdsClientTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = HTTPServer(("127.0.0.1", 0), FakeImdsHandler)
+        self.server.requests = []
+        self.server.responses = []
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={"poll_interval": 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+        self.tmp_dir = tempfile.mkdtemp()
+        url = "http://127.0.0.1:{0}/metadata/instance?api-version=2019-03-11".format(self.server.server_port)
+        self.patchers = [
+            patch.object(imds_client, "ImdsInstanceUrl", url),
+            patch.object(imds_client, "ImdsCachePath", os.path.join(self.tmp_dir, "imds.json")),
+            patch.object(imds_client, "InstanceCache", {}),
+            patch.object(imds_client, "InstanceUrls", {}),
+            patch.object(imds_client.metrics_utils, "is_arc_installed", return_value=False),
+            patch.object(imds_client.time, "sleep"),
+        ]
+        for patcher in self.patchers:
+            patcher.start()
+        self.sleep = imds_client.time.sleep
+
+    def tearDown(self):
+        for patcher in reversed(self.patchers):
+            patcher.stop()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dir)
+
+
+class TestGetImdsInstance(ImdsClientTestCase):
+
+    def test_queries_imds_once_per_process(self):
+        self.assertEqual(imds_client.get_imds_instance(True), InstanceDocument)
+        self.assertEqual(imds_client.get_imds_instance(True), InstanceDocument)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(self.server.requests[0][1], "true")
+
+    def test_arc_is_checked_once_per_process(self):
+        imds_client.get_imds_instance(False)
+        imds_client.get_imds_instance(False)
+        self.assertEqual(imds_client.metrics_utils.is_arc_installed.call_count, 1)
+        imds_client.get_imds_instance(False, refresh=True)
+        self.assertEqual(imds_client.metrics_utils.is_arc_installed.call_count, 2)
+
+    def test_disk_cache_is_shared_between_processes(self):
+        imds_client.get_imds_instance(True)
+        imds_client.InstanceCache.clear()
+        self.assertEqual(imds_client.get_imds_instance(False), InstanceDocument)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(oct(os.stat(imds_client.ImdsCachePath).st_mode & 0o777), oct(0o600))
+
+    def test_expired_cache_is_refreshed(self):
+        imds_client.get_imds_instance(True)
+        imds_client.InstanceCache.clear()
+        with open(imds_client.ImdsCachePath) as f:
+            cache = json.load(f)
+        cache["timestamp"] -= imds_client.ImdsCacheTtlSeconds + 1
+        with open(imds_client.ImdsCachePath, "w") as f:
+            json.dump(cache, f)
+        imds_client.get_imds_instance(True)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_corrupted_cache_is_ignored(self):
+        with open(imds_client.ImdsCachePath, "w") as f:
+            f.write("{not json")
+        self.assertEqual(imds_client.get_imds_instance(True), InstanceDocument)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_refresh_skips_the_caches(self):
+        imds_client.get_imds_instance(True)
+        imds_client.get_imds_instance(True, refresh=True)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_null_and_incomplete_responses_are_retried_with_backoff(self):
+        self.server.responses = ["null", "{}", "not json"]
+        self.assertEqual(imds_client.get_imds_instance(True), InstanceDocument)
+        self.assertEqual(len(self.server.requests), 4)
+        self.assertEqual(self.sleep.call_count, 3)
+        delays = [c[0][0] for c in self.sleep.call_args_list]
+        for attempt, delay in enumerate(delays):
+            self.assertGreaterEqual(delay, imds_client.ImdsBackoffBaseSeconds * (2 ** attempt) / 2.0)
+            self.assertLessEqual(delay, imds_client.ImdsBackoffBaseSeconds * (2 ** attempt))
+
+    def test_failure_raises_and_is_not_cached(self):
+        self.server.responses = ["null"] * imds_client.ImdsMaxAttempts
+        with self.assertRaises(Exception) as cm:
+            imds_client.get_imds_instance(True)
+        self.assertIn("'compute'", str(cm.exception))
+        self.assertEqual(len(self.server.requests), imds_client.ImdsMaxAttempts)
+        self.assertFalse(os.path.exists(imds_client.ImdsCachePath))
+        self.assertEqual(imds_client.get_imds_instance(True), InstanceDocument)
+
+    def test_max_attempts(self):
+        self.server.responses = ["null"]
+        with self.assertRaises(Exception):
+            imds_client.get_imds_instance(False, max_attempts=1)
+        self.assertEqual(len(self.server.requests), 1)
+        self.sleep.assert_not_called()
+
+
+class TestGetBackoffDelay(unittest.TestCase):
+
+    def test_delay_is_capped(self):
+        for _ in range(20):
+            self.assertLessEqual(imds_client.get_backoff_delay(10), imds_client.ImdsBackoffMaxSeconds)
+            self.assertGreaterEqual(imds_client.get_backoff_delay(10), imds_client.ImdsBackoffMaxSeconds / 2.0)
+
+
+class TestImdsCallers(ImdsClientTestCase):
+
+    def test_me_and_telegraf_setup_share_one_query(self):
+        az_resource_id, subscription_id, location, az_environment, data = get_imds_values(True)
+        self.assertEqual(location, "westus2")
+        self.assertEqual(az_environment, "AzurePublicCloud")
+        dimensions = get_imds_dimensions(True)
+        self.assertEqual(dimensions[0], az_resource_id)
+        self.assertEqual(dimensions[1], subscription_id)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_get_imds_values_reports_null_response(self):
+        self.server.responses = ["null"] * imds_client.ImdsMaxAttempts
+        with self.assertRaises(Exception) as cm:
+            get_imds_values(True)
+        self.assertIn("Failed to set up ME.", str(cm.exception))
+
+
+if __name__ == '__main__':
+    unittest.main()
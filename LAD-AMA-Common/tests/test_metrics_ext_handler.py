@@ -217,5 +217,35 @@ class TestGetHandlerVars(unittest.TestCase):
         self.assertEqual(config_folder, "/etc/azure/ext")
 
 
+class TestGetMsiTokenManager(unittest.TestCase):
+    """Tests for get_msi_token_manager."""
+
+    @patch('metrics_ext_utils.metrics_ext_handler.get_handler_vars', return_value=("", "/etc/azure/ext"))
+    @patch('metrics_ext_utils.metrics_ext_handler.MsiTokenManagers', {})
+    def test_one_manager_per_identity(self, mock_handler_vars):
+        from metrics_ext_utils.metrics_ext_handler import get_msi_token_manager
+        manager = get_msi_token_manager()
+        self.assertIs(get_msi_token_manager(), manager)
+        self.assertIsNot(get_msi_token_manager("object_id", "1234"), manager)
+        self.assertEqual(manager.token_path, "/etc/azure/ext/metrics_configs/AuthToken-MSI.json")
+
+    @patch('metrics_ext_utils.metrics_ext_handler.get_handler_vars', return_value=("", "/etc/azure/ext"))
+    @patch('metrics_ext_utils.metrics_ext_handler.MsiTokenManagers', {})
+    @patch('metrics_ext_utils.metrics_ext_handler.metrics_utils.is_arc_installed', return_value=False)
+    @patch('metrics_ext_utils.metrics_ext_handler.fetch_MSI_token')
+    def test_fetches_from_the_vm_identity_endpoint(self, mock_fetch, mock_arc, mock_handler_vars):
+        from metrics_ext_utils.metrics_ext_handler import get_msi_token_manager
+        mock_fetch.return_value = {"access_token": "a", "expires_on": "1"}
+        self.assertEqual(get_msi_token_manager("mi_res_id", "/id", is_lad=False).fetch(), mock_fetch.return_value)
+        mock_fetch.assert_called_once_with("mi_res_id", "/id")
+
+    @patch('metrics_ext_utils.metrics_ext_handler.urllib.urlopen')
+    def test_fetch_msi_token_sets_a_request_timeout(self, mock_urlopen):
+        from metrics_ext_utils.metrics_ext_handler import fetch_MSI_token, MsiTokenRequestTimeoutSeconds
+        mock_urlopen.return_value.read.return_value = b'{"access_token": "a", "expires_on": "1"}'
+        self.assertEqual(fetch_MSI_token()["access_token"], "a")
+        self.assertEqual(mock_urlopen.call_args[1]["timeout"], MsiTokenRequestTimeoutSeconds)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+"""
+Unit tests for metrics_ext_utils/msi_token_manager.py
+"""
+
+import sys
+import os
+import json
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from metrics_ext_utils.msi_token_manager import MsiTokenManager, parse_token
+
+Lifetime = 86400
+
+
+class FakeClock(object):
+    def __init__(self, now=1000000):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class FakeIdentityEndpoint(object):
+    """Hands out tokens valid for Lifetime seconds from the fake clock, or fails while failing is set."""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.calls = 0
+        self.failing = False
+        self.gate = None
+
+    def __call__(self):
+        self.calls += 1
+        if self.gate is not None:
+            self.gate.wait(5)
+        if self.failing:
+            raise Exception("identity endpoint unavailable")
+        return {
+            "access_token": "token{0}".format(self.calls),
+            "expires_in": str(Lifetime),
+            "expires_on": str(self.clock() + Lifetime),
+            "token_type": "Bearer",
+        }
+
+
+class MsiTokenManagerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.token_path = os.path.join(self.tmp_dir, "AuthToken-MSI.json")
+        self.clock = FakeClock()
+        self.fetch = FakeIdentityEndpoint(self.clock)
+        self.manager = MsiTokenManager(self.token_path, self.fetch, clock=self.clock)
+
+    def tearDown(self):
+        self.manager.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def read_token_file(self):
+        with open(self.token_path) as f:
+            return json.load(f)
+
+
+class TestParseToken(unittest.TestCase):
+
+    def test_parses_string_epochs(self):
+        self.assertEqual(parse_token({"access_token": "a", "expires_on": "1700000000", "expires_in": "86399"}),
+                         (1700000000, 86399))
+
+    def test_expires_in_is_optional(self):
+        self.assertEqual(parse_token({"access_token": "a", "expires_on": 1700000000}), (1700000000, None))
+
+    def test_rejects_incomplete_responses(self):
+        for data in [None, "expires_on", {}, {"access_token": "a"}, {"access_token": "a", "expires_on": "soon"}]:
+            with self.assertRaises(ValueError):
+                parse_token(data)
+
+
+class TestGetToken(MsiTokenManagerTestCase):
+
+    def test_fetches_and_persists_token(self):
+        token = self.manager.get_token()
+        self.assertEqual(token["access_token"], "token1")
+        self.assertEqual(self.read_token_file(), token)
+        self.assertEqual(os.listdir(self.tmp_dir), ["AuthToken-MSI.json"])
+
+    def test_refreshes_after_half_of_the_lifetime(self):
+        self.manager.get_token()
+        self.clock.now += Lifetime / 2 - 1
+        self.assertEqual(self.manager.get_token()["access_token"], "token1")
+        self.clock.now += 1
+        self.assertEqual(self.manager.get_token()["access_token"], "token2")
+        self.assertEqual(self.read_token_file()["access_token"], "token2")
+
+    def test_valid_token_file_is_reused(self):
+        self.manager.get_token()
+        manager = MsiTokenManager(self.token_path, self.fetch, clock=self.clock)
+        self.assertEqual(manager.get_token()["access_token"], "token1")
+        self.assertEqual(self.fetch.calls, 1)
+
+    def test_expired_token_file_is_replaced(self):
+        with open(self.token_path, "w") as f:
+            json.dump({"access_token": "old", "expires_on": str(self.clock.now - 1)}, f)
+        self.assertEqual(self.manager.get_token()["access_token"], "token1")
+
+    def test_failed_refresh_keeps_the_valid_token(self):
+        self.manager.get_token()
+        self.clock.now += Lifetime * 3 / 4
+        self.fetch.failing = True
+        self.assertEqual(self.manager.get_token()["access_token"], "token1")
+        self.assertEqual(self.read_token_file()["access_token"], "token1")
+        # The next attempt waits for the retry interval
+        self.manager.get_token()
+        self.assertEqual(self.fetch.calls, 2)
+        self.clock.now += self.manager.retry_interval
+        self.fetch.failing = False
+        self.assertEqual(self.manager.get_token()["access_token"], "token3")
+
+    def test_no_usable_token_raises(self):
+        self.fetch.failing = True
+        with self.assertRaises(Exception) as cm:
+            self.manager.get_token()
+        self.assertIn("identity endpoint unavailable", str(cm.exception))
+        success, expiry, log_messages = self.manager.ensure_token()
+        self.assertFalse(success)
+        self.assertIn("identity endpoint unavailable", log_messages)
+        self.assertFalse(os.path.exists(self.token_path))
+
+    def test_invalid_response_is_not_persisted(self):
+        self.manager.get_token()
+        self.clock.now += Lifetime / 2
+        self.manager.fetch = lambda: {"expires_on": "1"}
+        self.assertEqual(self.manager.get_token()["access_token"], "token1")
+        self.assertEqual(self.read_token_file()["access_token"], "token1")
+        self.assertEqual(self.manager.get_metrics()["failures"], 1)
+
+    def test_token_file_mode_is_kept(self):
+        self.manager.get_token()
+        os.chmod(self.token_path, 0o640)
+        self.clock.now += Lifetime / 2
+        self.manager.get_token()
+        self.assertEqual(os.stat(self.token_path).st_mode & 0o777, 0o640)
+
+    def test_missing_token_file_is_restored(self):
+        self.manager.ensure_token()
+        # The handler recreates the ME config directory on reconfiguration
+        shutil.rmtree(self.tmp_dir)
+        os.makedirs(self.tmp_dir)
+        success, expiry, log_messages = self.manager.ensure_token()
+        self.assertTrue(success)
+        self.assertEqual(self.read_token_file()["access_token"], "token1")
+        self.assertEqual(self.fetch.calls, 1)
+
+    def test_ensure_token_returns_expiry(self):
+        success, expiry, log_messages = self.manager.ensure_token()
+        self.assertTrue(success)
+        self.assertEqual(expiry, str(self.clock.now + Lifetime))
+        self.assertEqual(log_messages, "")
+
+
+class TestSingleFlight(MsiTokenManagerTestCase):
+
+    def test_concurrent_callers_share_one_fetch(self):
+        self.fetch.gate = threading.Event()
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.manager.get_token())) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        while self.fetch.calls == 0:
+            time.sleep(0.01)
+        self.fetch.gate.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.fetch.calls, 1)
+        self.assertEqual(len(results), 8)
+        self.assertTrue(all(token["access_token"] == "token1" for token in results))
+
+
+class TestBackgroundRefresh(MsiTokenManagerTestCase):
+
+    def test_next_wakeup(self):
+        self.fetch.failing = True
+        self.manager.ensure_token()
+        self.assertEqual(self.manager.get_next_wakeup(), self.manager.retry_interval)
+        self.fetch.failing = False
+        self.clock.now += self.manager.retry_interval
+        self.manager.get_token()
+        self.assertEqual(self.manager.get_next_wakeup(), Lifetime / 2)
+
+    def test_start_fetches_and_stop_joins(self):
+        self.manager.start()
+        deadline = time.time() + 5
+        while self.manager.get_metrics()["refreshes"] == 0 and time.time() < deadline:
+            time.sleep(0.01)
+        self.manager.start()
+        self.manager.stop()
+        self.assertIsNone(self.manager.thread)
+        self.assertEqual(self.fetch.calls, 1)
+        self.assertEqual(self.read_token_file()["access_token"], "token1")
+
+    def test_stop_does_not_wait_for_a_hung_fetch(self):
+        errors = []
+        self.manager.log_error = errors.append
+        self.fetch.gate = threading.Event()
+        self.manager.start()
+        while self.fetch.calls == 0:
+            time.sleep(0.01)
+        thread = self.manager.thread
+        start_time = time.time()
+        self.manager.stop(timeout=0.1)
+        self.assertLess(time.time() - start_time, 2)
+        self.assertIsNone(self.manager.thread)
+        self.assertIn("did not stop", errors[0])
+        # The thread left behind exits once its fetch returns
+        self.fetch.gate.set()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+
+    def test_metrics(self):
+        self.fetch.failing = True
+        self.manager.ensure_token()
+        self.fetch.failing = False
+        self.clock.now += self.manager.retry_interval
+        self.manager.get_token()
+        metrics = self.manager.get_metrics()
+        self.assertEqual(metrics["refreshes"], 1)
+        self.assertEqual(metrics["failures"], 1)
+        self.assertEqual(metrics["consecutiveFailures"], 0)
+        self.assertEqual(metrics["expiresOnEpoch"], self.clock.now + Lifetime)
+        self.assertEqual(metrics["lastRefreshEpoch"], self.clock.now)
+        self.assertIsNotNone(metrics["lastRefreshLatencySeconds"])
+        self.assertIn("identity endpoint unavailable", metrics["lastError"])
+
+
+if __name__ == '__main__':
+    unittest.main()
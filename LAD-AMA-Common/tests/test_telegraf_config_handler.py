@@ -6,13 +6,23 @@ Unit tests for telegraf_config_handler.parse_config
 import sys
 import os
 import json
+import re
+import shutil
+import tempfile
 import unittest
 from unittest.mock import patch, MagicMock
 
+try:
+    import tomllib # Python 3.11+
+except ImportError:
+    tomllib = None
+
 # Add parent dir to path so we can import the modules under test
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from telegraf_utils.telegraf_config_handler import parse_config, write_configs
+from telegraf_utils.telegraf_config_handler import parse_config, write_configs, write_configs_incremental
+from telegraf_utils.telegraf_config_handler import TelegrafConfigUnchanged, TelegrafConfigReload, TelegrafConfigRestart
+from telegraf_utils.telegraf_config_handler import ConsolidationTagKey
 
 
 def make_counter(display_name, interval="60s", sink=None, config_ids=None):
@@ -339,6 +349,93 @@ class TestParseConfigTelegrafConf(unittest.TestCase):
         self.assertIn(REGION, telegraf_conf["data"])
 
 
+class TestParseConfigOutputUnchanged(unittest.TestCase):
+    """The reworked generator must produce the same bytes as the original one."""
+
+    @patch('telegraf_utils.telegraf_config_handler.get_handler_vars')
+    def test_synthetic_dcrs_match_recorded_digests(self, mock_handler):
+        from tests.benchmark_parse_config import ExpectedDigests, make_dcr, get_digest
+        mock_handler.return_value = ("", "")
+        for counters in [10, 1000]:
+            output, namespaces = parse_config(make_dcr(counters), ME_URL, MDSD_URL, False, AZ_RESOURCE_ID,
+                                              SUBSCRIPTION_ID, RESOURCE_GROUP, REGION, "vm1_0")
+            self.assertEqual(get_digest(output, namespaces), ExpectedDigests[counters])
+
+
+@unittest.skipIf(tomllib is None, "tomllib requires Python 3.11+")
+class TestParseConfigConsolidation(unittest.TestCase):
+    """Consolidated inputs must emit the same metrics, per configuration ID, as one input per configuration ID."""
+
+    def _parse(self, data, consolidate):
+        with patch('telegraf_utils.telegraf_config_handler.get_handler_vars', return_value=("", "")):
+            output, namespaces = parse_config(data, ME_URL, MDSD_URL, False, AZ_RESOURCE_ID,
+                                              SUBSCRIPTION_ID, RESOURCE_GROUP, REGION, "vm1_0", consolidate)
+        return dict((c["filename"], c["data"]) for c in output), namespaces
+
+    def _get_emitted_metrics(self, configs):
+        """
+        Return the set of (plugin, field, interval, configurationId) every input of the module files emits,
+        resolving consolidated inputs through their starlark router, and the number of input blocks per file
+        """
+        metrics = set()
+        inputs_per_file = {}
+        for filename, data in configs.items():
+            if filename in ("telegraf.conf", "intermediate.json"):
+                continue
+            conf = tomllib.loads(data)
+            routes = {}
+            for router in conf.get("processors", {}).get("starlark", []):
+                config_ids = json.loads(re.search(r"for configuration_id in (\[.*\]):", router["source"]).group(1))
+                for consolidation_id in router["tagpass"][ConsolidationTagKey]:
+                    routes[consolidation_id] = config_ids
+            for plugin, blocks in conf["inputs"].items():
+                for block in blocks:
+                    inputs_per_file[filename] = inputs_per_file.get(filename, 0) + 1
+                    tags = block["tags"]
+                    if ConsolidationTagKey in tags:
+                        config_ids = routes[tags[ConsolidationTagKey]]
+                    else:
+                        config_ids = [tags["configurationId"]]
+                    for field in block.get("fieldpass", []):
+                        for config_id in config_ids:
+                            metrics.add((plugin, field, block["interval"], config_id))
+        return metrics, inputs_per_file
+
+    def test_emitted_metrics_match(self):
+        from tests.benchmark_parse_config import make_dcr
+        data = make_dcr(200)
+        separate, separate_namespaces = self._parse(data, False)
+        consolidated, consolidated_namespaces = self._parse(data, True)
+        separate_metrics, separate_inputs = self._get_emitted_metrics(separate)
+        consolidated_metrics, consolidated_inputs = self._get_emitted_metrics(consolidated)
+        self.assertTrue(separate_metrics)
+        self.assertEqual(consolidated_metrics, separate_metrics)
+        self.assertEqual(consolidated_namespaces, separate_namespaces)
+        self.assertEqual(consolidated["telegraf.conf"], separate["telegraf.conf"])
+        self.assertEqual(consolidated["intermediate.json"], separate["intermediate.json"])
+        # One input per plugin instead of one per plugin and configuration ID
+        self.assertTrue(all(count == 1 for count in consolidated_inputs.values()))
+        self.assertGreater(sum(separate_inputs.values()), sum(consolidated_inputs.values()))
+
+    def test_single_configuration_id_is_not_consolidated(self):
+        data = [make_counter("Available MBytes Memory", config_ids=["configId1"])]
+        separate, _ = self._parse(data, False)
+        consolidated, _ = self._parse(data, True)
+        self.assertEqual(consolidated, separate)
+        self.assertNotIn("processors.starlark", "".join(consolidated.values()))
+
+    def test_router_replaces_consolidation_tag(self):
+        data = [make_counter("Available MBytes Memory", config_ids=["configId1", "configId2"])]
+        consolidated, _ = self._parse(data, True)
+        module_files = [f for f in consolidated if f not in ("telegraf.conf", "intermediate.json")]
+        self.assertEqual(module_files, ["memory-mem.conf"])
+        conf = tomllib.loads(consolidated["memory-mem.conf"])
+        self.assertEqual(conf["inputs"]["mem"][0]["tags"], {ConsolidationTagKey: "memory-mem"})
+        source = conf["processors"]["starlark"][0]["source"]
+        self.assertIn('copy.tags.pop("consolidationId")', source)
+        self.assertIn('copy.tags["configurationId"] = configuration_id', source)
+
+
 class TestWriteConfigs(unittest.TestCase):
     """Tests for write_configs function."""
 
@@ -370,5 +467,56 @@ class TestWriteConfigs(unittest.TestCase):
         mock_rmtree.assert_called_once_with("/etc/telegraf/")
 
 
+class TestWriteConfigsIncremental(unittest.TestCase):
+    """Tests for write_configs_incremental function."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.conf_dir = os.path.join(self.tmpdir, "telegraf_configs") + "/"
+        self.d_conf_dir = self.conf_dir + "telegraf.d/"
+        self.configs = [
+            {"filename": "telegraf.conf", "data": "agent config"},
+            {"filename": "intermediate.json", "data": "{}"},
+            {"filename": "memory-mem-dcr1.conf", "data": "mem config"},
+            {"filename": "memory-swap-dcr1.conf", "data": "swap config"},
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _apply(self, configs):
+        return write_configs_incremental(configs, self.conf_dir, self.d_conf_dir)
+
+    def test_first_write_requires_restart(self):
+        self.assertEqual(self._apply(self.configs), TelegrafConfigRestart)
+        self.assertEqual(sorted(os.listdir(self.d_conf_dir)), ["memory-mem-dcr1.conf", "memory-swap-dcr1.conf"])
+        with open(self.conf_dir + "telegraf.conf") as f:
+            self.assertEqual(f.read(), "agent config")
+
+    def test_unchanged_configs_are_not_rewritten(self):
+        self._apply(self.configs)
+        mtime = os.stat(self.d_conf_dir + "memory-mem-dcr1.conf").st_mtime_ns
+        self.assertEqual(self._apply(self.configs), TelegrafConfigUnchanged)
+        self.assertEqual(os.stat(self.d_conf_dir + "memory-mem-dcr1.conf").st_mtime_ns, mtime)
+
+    def test_module_changes_only_require_reload(self):
+        self._apply(self.configs)
+        with open(self.conf_dir + "telegraf_pid.txt", "w") as f:
+            f.write("1234\n")
+        configs = [c for c in self.configs if c["filename"] != "memory-swap-dcr1.conf"]
+        configs.append({"filename": "cpu-cpu-dcr2.conf", "data": "cpu config"})
+        self.assertEqual(self._apply(configs), TelegrafConfigReload)
+        self.assertEqual(sorted(os.listdir(self.d_conf_dir)), ["cpu-cpu-dcr2.conf", "memory-mem-dcr1.conf"])
+        # Files next to telegraf.conf, like the pid file, are left alone
+        self.assertTrue(os.path.exists(self.conf_dir + "telegraf_pid.txt"))
+
+    def test_agent_config_change_requires_restart(self):
+        self._apply(self.configs)
+        configs = [dict(c) for c in self.configs]
+        configs[0]["data"] = "new agent config"
+        configs[2]["data"] = "new mem config"
+        self.assertEqual(self._apply(configs), TelegrafConfigRestart)
+
+
 if __name__ == '__main__':
     unittest.main()
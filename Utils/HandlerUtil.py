@@ -93,12 +93,15 @@ class HandlerContext:
 
 class HandlerUtility:
     def __init__(self, log, error, s_name=None, l_name=None, extension_version=None, logFileName='extension.log',
-                 console_logger=None, file_logger=None):
+                 console_logger=None, file_logger=None, protected_settings_cache=None):
         self._log = log
         self._log_to_con = console_logger
         self._log_to_file = file_logger
         self._error = error
         self._logFileName = logFileName
+        # Optional cache of decrypted protectedSettings, with get(seq_no, thumbprint, settings)
+        # and put(seq_no, thumbprint, settings, decrypted) methods
+        self._protected_settings_cache = protected_settings_cache
         if s_name is None or l_name is None or extension_version is None:
             (l_name, s_name, extension_version) = self._get_extension_info()
 
@@ -201,8 +204,13 @@ class HandlerUtility:
                 cms_cmd = 'openssl cms -inform DER -decrypt -recip {0} -inkey {1}'.format(cert,pkey)
                 smime_cmd = 'openssl smime -inform DER -decrypt -recip {0} -inkey {1}'.format(cert,pkey)
 
+                seq_no = self._context._seq_no if getattr(self, '_context', None) else None
                 protected_settings_str = ''
-                for decrypt_cmd in [cms_cmd, smime_cmd]:
+                if self._protected_settings_cache is not None:
+                    protected_settings_str = self._protected_settings_cache.get(seq_no, thumb, protectedSettings) or ''
+                    if protected_settings_str:
+                        self.log('Using cached decrypted protectedSettings.')
+                for decrypt_cmd in ([] if protected_settings_str else [cms_cmd, smime_cmd]):
                     try:
                         # waagent.RunSendStdin returns a tuple (return code, stdout)
                         output = waagent.RunSendStdin(decrypt_cmd, unencodedSettings)
@@ -212,6 +220,8 @@ class HandlerUtility:
                                 self.log('Decrypted protectedSettings using openssl cms.')
                             else:
                                 self.log('Decrypted protectedSettings using openssl smime fallback.')
+                            if self._protected_settings_cache is not None:
+                                self._protected_settings_cache.put(seq_no, thumb, protectedSettings, protected_settings_str)
                             break
                         else:
                             rc = output[0] if output else 'N/A'